@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'preprocessing'))
+
+from corrections import _corner_shift, ecc_warp
+
+# band-to-band misalignment of the synthetic target
+TRUE_WARP = np.float32([
+    [1.004, 0.003, 6.5],
+    [-0.002, 0.998, -4.2],
+    [1.5e-06, -1.0e-06, 1.0],
+])
+
+def synthetic_pair(size, seed=0):
+    """
+        Build a 16-bit reference texture and a target warped by TRUE_WARP. Both are cropped
+        from a larger warped texture, so the target has no black border.
+    """
+    margin = size // 10
+    big = size + 2 * margin
+    rng = np.random.default_rng(seed)
+    noise = rng.random((big // 8, big // 8)).astype(np.float32)
+    texture = cv2.resize(noise, (big, big), interpolation=cv2.INTER_CUBIC)
+    texture = cv2.GaussianBlur(texture, (0, 0), 3)
+    texture = cv2.normalize(texture, None, 0, 60000, cv2.NORM_MINMAX).astype(np.uint16)
+
+    # TRUE_WARP is expressed in crop coordinates
+    offset = np.float64([[1, 0, margin], [0, 1, margin], [0, 0, 1]])
+    warp = offset @ TRUE_WARP.astype(np.float64) @ np.linalg.inv(offset)
+    warped = cv2.warpPerspective(texture, warp, (big, big))
+    crop = (slice(margin, margin + size), slice(margin, margin + size))
+    return texture[crop], warped[crop]
+
+def main():
+    parser = argparse.ArgumentParser(description="ECC alignment benchmark")
+    parser.add_argument('--size', type=int, default=1500)
+    parser.add_argument('--iterations', type=int, default=25)
+    args = parser.parse_args()
+
+    reference, target = synthetic_pair(args.size)
+    # warm start: a slightly different estimate, as from the previous frame of the flight line
+    warm = TRUE_WARP.copy()
+    warm[0, 2] += 1.0
+    warm[1, 2] -= 0.8
+
+    runs = [
+        ('full resolution', {}),
+        ('pyramid 3', {'levels': 3}),
+        ('pyramid 4', {'levels': 4}),
+        ('pyramid 3, warm start', {'levels': 3, 'warp_matrix': warm}),
+        ('pyramid 3, warm, tol 0.5px', {'levels': 3, 'warp_matrix': warm, 'tolerance': 0.5}),
+    ]
+    baseline = None
+    for label, kwargs in runs:
+        start = time.perf_counter()
+        warp_matrix, stats = ecc_warp(reference, target, number_of_iterations=args.iterations, **kwargs)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = elapsed
+        error = _corner_shift(TRUE_WARP, warp_matrix, reference.shape)
+        print(f"{label:<28} {1000 * elapsed:8.1f} ms  x{baseline / elapsed:5.2f}  "
+              f"cc {stats['cc']:.4f}  corner error {error:6.3f} px  "
+              f"levels solved {len(stats['levels'])}  early exit {stats['early_exit']}")
+
+if __name__ == "__main__":
+    main()
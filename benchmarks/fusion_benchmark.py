@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'preprocessing'))
+
+from fusion import fuse, stack_scenes
+
+def notebook_gram_schmidt_fusion_rgb(multispectral, pseudo_rgb, alpha=2):
+    """
+        gram_schmidt_fusion_rgb of notebooks/fuse_imgs.ipynb, kept verbatim as the reference.
+    """
+    pseudo_rgb = pseudo_rgb.astype(np.float32)
+    multispectral = multispectral.astype(np.float32)
+
+    intensity_rgb = np.mean(pseudo_rgb, axis=-1, keepdims=True)
+    intensity_ms = np.mean(multispectral, axis=-1, keepdims=True)
+    ratio = (alpha * intensity_ms) / (intensity_rgb + 1e-8)
+
+    fused = pseudo_rgb * ratio
+    fused = np.clip(fused, 0, 255).astype(np.uint8)
+    return fused
+
+def notebook_index(a, b):
+    """
+        calculate_ndvi / calculate_ndre of notebooks/vegetation_index.ipynb, on arrays.
+    """
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    numerator = a - b
+    denominator = a + b
+    index = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+    return (((index + 1) / 2) * 255).astype(np.uint8)
+
+def notebook_fuse(scene):
+    """
+        The per-capture products as the notebooks build them.
+    """
+    ms = np.dstack((scene['G'], np.asarray(scene['RGB']) * 0.125, scene['NIR'], scene['R'], scene['RE']))
+    pseudo_rgb = np.dstack((scene['R'], scene['G'], scene['NIR']))
+    return {
+        'fused': notebook_gram_schmidt_fusion_rgb(ms, pseudo_rgb),
+        'ndvi': notebook_index(scene['NIR'], scene['R']),
+        'ndre': notebook_index(scene['NIR'], scene['RE']),
+    }
+
+def synthetic_scene(size, seed):
+    """
+        A capture with smooth 16-bit multispectral bands and an 8-bit RGB frame, including dark
+        pixels (zero denominators) and saturated fused values.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    scene = {}
+    for band, phase in zip(('G', 'NIR', 'R', 'RE'), (0.0, 1.1, 2.3, 3.7)):
+        level = 120 * (1 + np.sin(7 * x + phase) * np.cos(5 * y - phase))
+        noise = rng.integers(0, 40, (size, size))
+        scene[band] = (level + noise).astype(np.uint16)
+    scene['R'][:8, :8] = 0
+    scene['NIR'][:8, :8] = 0
+    scene['RGB'] = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    return scene
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized fusion benchmark and golden-output check")
+    parser.add_argument('--size', type=int, default=1500)
+    parser.add_argument('--scenes', type=int, default=8)
+    parser.add_argument('--check', action='store_true', help='Only run the golden-output check')
+    args = parser.parse_args()
+
+    scenes = [synthetic_scene(args.size, seed) for seed in range(args.scenes)]
+    products = ('fused', 'ndvi', 'ndre')
+
+    # golden output: the batched module must reproduce the notebooks exactly
+    batched = fuse(stack_scenes(scenes), products)
+    mismatches = 0
+    for i, scene in enumerate(scenes):
+        expected = notebook_fuse(scene)
+        for product in products:
+            differing = np.count_nonzero(batched[product][i] != expected[product])
+            if differing:
+                print(f"scene {i} {product}: {differing} pixels differ from the notebook")
+                mismatches += differing
+    print(f"golden check: {'OK' if not mismatches else 'FAILED'} ({args.scenes} scenes of {args.size}x{args.size})")
+    if args.check:
+        sys.exit(1 if mismatches else 0)
+
+    start = time.perf_counter()
+    for scene in scenes:
+        notebook_fuse(scene)
+    notebook_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for scene in scenes:
+        fuse(scene, products)
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fuse(stack_scenes(scenes), products)
+    batched_time = time.perf_counter() - start
+
+    for label, elapsed in (('notebook', notebook_time), ('fusion, per scene', single_time), ('fusion, batched', batched_time)):
+        print(f"{label:<18} {1000 * elapsed / args.scenes:8.1f} ms/scene")
+
+if __name__ == "__main__":
+    main()
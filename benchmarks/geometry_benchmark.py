@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'preprocessing'))
+
+from calibration_cache import CalibrationCache
+from corrections import (
+    _vignette_params,
+    align_phase_rotation,
+    correct_crop,
+    undistort,
+    undistort_align,
+    vignette_factor,
+)
+from tranforms import crop_center
+
+# calibration in the format read by corrections.py, close to a DJI multispectral band
+INFO_DICT = {
+    'Calibrated Optical Center X': '1305.5',
+    'Calibrated Optical Center Y': '968.2',
+    'Vignetting Data': '0.000118, 2.1e-07, -3.5e-10, 4.2e-13, -2.1e-16, 3.8e-20',
+    'Dewarp Data': '2019-07-30;2240.2,2240.8,10.6,-7.3,-0.0285,0.0161,-0.00041,0.00033,-0.0041',
+    'Calibrated H Matrix': '0.9986,-0.0021,8.47,0.0019,0.9991,-5.12,1.2e-07,-3.1e-07,1.0',
+}
+
+def _time(label, run, img, repeat):
+    """
+        Time one correction path.
+        Parameters:
+            - label: Name printed in the report.
+            - run: Callable taking the image and returning the corrected image.
+            - img: Input image.
+            - repeat: Number of runs.
+        Returns:
+            - out: The output of the last run.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = run(img)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {1000 * elapsed / repeat:8.2f} ms/img  {repeat / elapsed:8.1f} img/s")
+    return out
+
+# tolerances of the one-pass paths against the two-step path they replace: interpolating once
+# instead of twice moves pixels by a few levels (of 65535). Within EDGE_BAND pixels of the
+# black fill the two-step path mixes the fill of its first warp into the second, so those
+# pixels are left out, and the valid areas may differ along their edge
+MAX_ABS_DIFF = 32
+EDGE_BAND = 2
+MAX_VALID_MISMATCH = 0.01
+
+def _compare(label, reference, new_img):
+    """
+        Print the difference between two outputs where both have valid pixels.
+        Returns:
+            - ok: True if the outputs agree within MAX_ABS_DIFF away from the edge of the
+              valid area, and are valid on the same pixels up to MAX_VALID_MISMATCH.
+    """
+    assert reference.shape == new_img.shape, (reference.shape, new_img.shape)
+    valid = (reference > 0) & (new_img > 0)
+    mismatch = ((reference > 0) != (new_img > 0)).mean()
+    kernel = np.ones((2 * EDGE_BAND + 1, 2 * EDGE_BAND + 1), np.uint8)
+    inner = cv2.erode(valid.astype(np.uint8), kernel, borderValue=1).astype(bool)
+    diff = np.abs(reference.astype(np.int32) - new_img.astype(np.int32))
+    ok = bool(diff[inner].max() <= MAX_ABS_DIFF and mismatch <= MAX_VALID_MISMATCH)
+    print(f"{label:<28} valid pixels: {valid.mean():.3f} (mismatch {mismatch:.4f})  "
+          f"mean abs diff: {diff[valid].mean():.2f}  max abs diff inside: {diff[inner].max()} "
+          f"(tolerance {MAX_ABS_DIFF} of 65535)  {'OK' if ok else 'FAILED'}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Correction pipeline benchmark and remap correctness check")
+    parser.add_argument('--rows', type=int, default=1944)
+    parser.add_argument('--cols', type=int, default=2592)
+    parser.add_argument('--crop', type=int, default=1500)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the one-pass paths against the two-step path (exit code 1 on failure)')
+    args = parser.parse_args()
+    if args.check:
+        args.repeat = 1
+
+    # smooth 16-bit texture, so the comparison measures geometry rather than aliasing
+    y, x = np.mgrid[0:args.rows, 0:args.cols]
+    img = (20000 + 12000 * np.sin(x / 40.) * np.cos(y / 55.)).astype(np.uint16)
+
+    centerX, centerY, k = _vignette_params(INFO_DICT)
+
+    def vignette(raw):
+        # vig_correct without the file read
+        return (raw * vignette_factor(raw.shape[0], raw.shape[1], centerX, centerY, k)).astype('uint16')
+
+    def vignette_cached(raw):
+        return (raw * cache.vignette_map(raw.shape, centerX, centerY, k)).astype('uint16')
+
+    cache = CalibrationCache()
+
+    print("undistort + alignment")
+    two_step = _time('undistort + warp', lambda raw: align_phase_rotation(undistort(raw, INFO_DICT), INFO_DICT), img, args.repeat)
+    _time('remap (uncached)', lambda raw: undistort_align(raw, INFO_DICT), img, args.repeat)
+    one_pass = _time('remap (cached)', lambda raw: undistort_align(raw, INFO_DICT, cache=cache), img, args.repeat)
+    ok = _compare('remap vs two-step', two_step, one_pass)
+
+    print(f"vignette + undistort + alignment + {args.crop} crop")
+    original = _time('original', lambda raw: crop_center(
+        align_phase_rotation(undistort(vignette(raw), INFO_DICT), INFO_DICT), args.crop), img, args.repeat)
+    _time('cached maps', lambda raw: crop_center(
+        undistort_align(vignette_cached(raw), INFO_DICT, cache=cache), args.crop), img, args.repeat)
+    _time('fused crop (uncached)', lambda raw: correct_crop(raw, INFO_DICT, args.crop), img, args.repeat)
+    fused = _time('fused crop (cached)', lambda raw: correct_crop(raw, INFO_DICT, args.crop, cache=cache), img, args.repeat)
+    ok &= _compare('fused vs original', original, fused)
+
+    print(f"geometry check: {'OK' if ok else 'FAILED'}")
+    if args.check:
+        sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
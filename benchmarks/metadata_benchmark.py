@@ -0,0 +1,55 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'preprocessing'))
+
+from metadata import ExifToolSession, get_xml_metadata
+from xmp import CALIBRATION_TAGS, read_dji_metadata
+
+def _time(label, read, paths):
+    """
+        Time one metadata reader over all the paths.
+        Parameters:
+            - label: Name printed in the report.
+            - read: Callable taking an image path and returning an infoDict.
+            - paths: List of image paths.
+        Returns:
+            - infoDicts: The dictionaries returned by the reader.
+    """
+    start = time.perf_counter()
+    infoDicts = [read(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {elapsed:8.3f} s  {1000 * elapsed / len(paths):8.2f} ms/img")
+    return infoDicts
+
+def main():
+    parser = argparse.ArgumentParser(description="Metadata reader benchmark")
+    parser.add_argument('--dir', type=str, required=True, help='Directory with sample images')
+    parser.add_argument('--pattern', type=str, default='*.TIF', help='Glob pattern of the images')
+    parser.add_argument('--limit', type=int, default=200, help='Maximum number of images')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.dir, args.pattern)))[:args.limit]
+    if not paths:
+        sys.exit(f"No images matching {args.pattern} in {args.dir}")
+    print(f"{len(paths)} images")
+
+    reference = _time('exiftool subprocess', get_xml_metadata, paths)
+    with ExifToolSession() as session:
+        _time('exiftool stay_open', session.get_metadata, paths)
+    fast = _time('in-process XMP', read_dji_metadata, paths)
+
+    # the fast reader must agree with ExifTool on every calibration tag and on the serial
+    # number the warp registry keys are built from
+    mismatches = sum(
+        ref.get(tag) != new.get(tag)
+        for ref, new in zip(reference, fast)
+        for tag in CALIBRATION_TAGS + ('Serial Number',)
+    )
+    print(f"calibration and serial tag mismatches: {mismatches}")
+
+if __name__ == "__main__":
+    main()
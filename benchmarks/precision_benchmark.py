@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'preprocessing'))
+
+import corrections
+from corrections import _vignette_params, ecc_edges, set_precision, vig_correct
+from geometry_benchmark import INFO_DICT
+
+def legacy_vig_correct(image_path, infoDict):
+    """
+        vig_correct as it was before the precision policy (float64 meshgrid and powers).
+    """
+    centerX, centerY, k = _vignette_params(infoDict)
+    np_img = np.array(Image.open(image_path), dtype=np.uint16)
+    rows, cols = np_img.shape[:2]
+    y_coords, x_coords = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+    r = np.sqrt((x_coords - centerX)**2 + (y_coords - centerY)**2)
+    correction_factor = k[5] * r**6 + k[4] * r**5 + k[3] * r**4 + k[2] * r**3 + k[1] * r**2 + k[0] * r + 1.0
+    return (np_img * correction_factor).astype('uint16')
+
+def _measure(label, run, repeat):
+    """
+        Print the mean time and the peak NumPy allocation of a callable.
+        Returns:
+            - out: The output of the last run.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<26} {1000 * elapsed / repeat:8.2f} ms  peak {peak / 2**20:8.1f} MiB")
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="float32 vs float64 precision benchmark")
+    parser.add_argument('--rows', type=int, default=1944)
+    parser.add_argument('--cols', type=int, default=2592)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    y, x = np.mgrid[0:args.rows, 0:args.cols]
+    img = (20000 + 12000 * np.sin(x / 40.) * np.cos(y / 55.)).astype(np.uint16)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, 'band.TIF')
+        Image.fromarray(img).save(image_path)
+
+        print(f"16-bit frame {args.cols}x{args.rows}")
+        reference = _measure('vig_correct (legacy)', lambda: legacy_vig_correct(image_path, INFO_DICT), args.repeat)
+        outputs = {}
+        for dtype in (np.float64, np.float32):
+            set_precision(dtype)
+            name = np.dtype(dtype).name
+            outputs[name] = _measure(f'vig_correct ({name})', lambda: vig_correct(image_path, INFO_DICT), args.repeat)
+            _measure(f'ecc_edges ({name})', lambda: ecc_edges(img), args.repeat)
+        set_precision(np.float32)
+
+    for name, out in outputs.items():
+        diff = np.abs(reference.astype(np.int32) - out.astype(np.int32))
+        print(f"vig_correct {name} vs legacy: max abs diff {diff.max()} (of 65535)")
+    print(f"default precision: {np.dtype(corrections.PRECISION).name}")
+
+if __name__ == "__main__":
+    main()
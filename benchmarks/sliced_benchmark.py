@@ -0,0 +1,103 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'models'))
+
+from sliced import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, sliced_detect, slice_windows
+
+class FakeDetector:
+    """
+        Detector returning the part of known objects that falls inside each tile, as a model
+        would see an object cut by the tile edge. The tiles come in the order of
+        slice_windows, which tells which window each one is.
+    """
+    channels = 3
+    names = None
+
+    def __init__(self, objects, shape, tile_size, overlap):
+        self.objects = np.asarray(objects, dtype=np.float32).reshape(-1, 6)
+        self.windows = iter(slice_windows(shape, tile_size, overlap))
+
+    def __call__(self, tiles, conf=0.25, iou=0.7):
+        detections = []
+        for _ in tiles:
+            x, y, w, h = next(self.windows)
+            boxes = self.objects.copy()
+            boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]] - x, 0, w)
+            boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]] - y, 0, h)
+            visible = (boxes[:, 2] - boxes[:, 0] > 1) & (boxes[:, 3] - boxes[:, 1] > 1)
+            detections.append(boxes[visible])
+        return detections
+
+def run(objects, shape, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, merge='nms'):
+    scene = np.zeros(shape + (3,), dtype=np.uint8)
+    detector = FakeDetector(objects, shape, tile_size, overlap)
+    return sliced_detect(detector, scene, tile_size, overlap, batch=4, merge=merge)
+
+def _iou(a, b):
+    w = max(min(a[2], b[2]) - max(a[0], b[0]), 0)
+    h = max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - w * h
+    return w * h / union
+
+# (label, scene shape, objects as x1, y1, x2, y2, confidence, class); with the default 1500 px
+# tiles and 0.2 overlap the seams are at 1200-1500 and 2400-2700, so every object must come out
+# as exactly one box matching it, whether a tile sees it whole or it is cut by every tile
+CASES = (
+    ('inside one tile', (1500, 2700), [[100, 100, 300, 300, 0.9, 0]]),
+    ('small, across a seam', (1500, 2700), [[1450, 600, 1550, 700, 0.9, 0]]),
+    ('wider than the overlap, across a seam', (1500, 2700), [[1100, 600, 1600, 900, 0.9, 0]]),
+    ('wider than the overlap, across a seam (700 px)', (1500, 2700), [[1100, 600, 1800, 900, 0.9, 0]]),
+    ('wider than the overlap, across a seam (900 px)', (1500, 2700), [[1000, 600, 1900, 900, 0.9, 0]]),
+    ('taller than the overlap, across a seam', (2700, 1500), [[600, 1000, 900, 1900, 0.9, 0]]),
+    ('wider than the overlap, at the scene edge', (1500, 2700), [[1000, 0, 1900, 300, 0.9, 0]]),
+    ('wider than the overlap, across a corner', (2700, 2700), [[1100, 1100, 1600, 1600, 0.9, 0]]),
+    ('wider than the overlap, across a corner (900 px)', (2700, 2700), [[1000, 1000, 1900, 1900, 0.9, 0]]),
+    ('wider than a tile step, across two seams', (1500, 3900), [[1000, 600, 2900, 900, 0.9, 0]]),
+    ('two classes side by side, across a seam', (1500, 2700),
+     [[1000, 600, 1900, 900, 0.9, 0], [1000, 950, 1900, 1250, 0.8, 1]]),
+    ('wide and small, across a seam', (1500, 2700),
+     [[1000, 600, 1900, 900, 0.9, 0], [1300, 1000, 1400, 1100, 0.8, 0]]),
+)
+
+# IoU of each object with its detection
+MIN_IOU = 0.9
+
+def main():
+    parser = argparse.ArgumentParser(description="Sliced inference edge handling check and merge benchmark")
+    parser.add_argument('--check', action='store_true', help='Only run the edge handling check')
+    parser.add_argument('--objects', type=int, default=2000)
+    args = parser.parse_args()
+
+    failures = 0
+    for merge in ('nms', 'wbf'):
+        for label, shape, objects in CASES:
+            detections, _ = run(objects, shape, merge=merge)
+            matched = all(any(d[5] == o[5] and _iou(d, o) >= MIN_IOU for d in detections) for o in objects)
+            ok = len(detections) == len(objects) and matched
+            failures += not ok
+            print(f"{merge} {label:<52} {len(detections)} detection(s), expected {len(objects)}  "
+                  f"{'OK' if ok else 'FAILED'}")
+    print(f"edge check: {'OK' if not failures else 'FAILED'}")
+    if args.check:
+        sys.exit(1 if failures else 0)
+
+    # merge time on a dense orthomosaic
+    rng = np.random.default_rng(0)
+    shape = (6000, 6000)
+    xy = rng.uniform(0, 5900, (args.objects, 2))
+    size = rng.uniform(30, 400, (args.objects, 2))
+    objects = np.column_stack((xy, np.minimum(xy + size, 6000), rng.uniform(0.3, 1, args.objects),
+                               rng.integers(0, 10, args.objects)))
+    for merge in ('nms', 'wbf'):
+        start = time.perf_counter()
+        detections, stats = run(objects, shape, merge=merge)
+        print(f"{merge}: {stats['tiles']} tiles, {args.objects} objects -> {len(detections)} detections "
+              f"in {time.perf_counter() - start:.2f} s")
+
+if __name__ == "__main__":
+    main()
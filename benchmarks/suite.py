@@ -0,0 +1,365 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'src', 'preprocessing'))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'src', 'models'))
+
+from corrections import align_images_using_ecc, align_phase_rotation, undistort, vig_correct
+from ecc_benchmark import synthetic_pair
+from geometry_benchmark import INFO_DICT
+from tranforms import crop_center, zoom_center
+
+# frame of the DJI multispectral bands that INFO_DICT was taken from
+REFERENCE_SHAPE = (1944, 2592)
+PREPROCESSING_CASES = ('vig_correct', 'undistort', 'align_phase_rotation', 'align_images_using_ecc',
+                       'crop_center', 'zoom_center')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+# relative slowdown of the median flagged by compare
+DEFAULT_THRESHOLD = 0.10
+# fast calls are looped until a sample lasts this long, so timer resolution does not show
+MIN_SAMPLE_SECONDS = 0.005
+
+def synthetic_frame(rows, cols, seed=0):
+    """
+        Build a 16-bit band: smooth texture, sensor noise and the radial falloff that
+        vig_correct compensates.
+        Parameters:
+            - rows, cols: Frame size.
+            - seed: Seed of the noise.
+        Returns:
+            - frame: (rows, cols) uint16 array.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    texture = 20000 + 12000 * np.sin(x / 40.) * np.cos(y / 55.)
+    r2 = ((x - cols / 2) ** 2 + (y - rows / 2) ** 2) / ((rows / 2) ** 2 + (cols / 2) ** 2)
+    frame = texture * (1 - 0.35 * r2) + rng.normal(0, 300, (rows, cols))
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+def synthetic_calibration(rows, cols, seed=0):
+    """
+        Build the calibration of one band for a frame of any size: INFO_DICT scaled from
+        REFERENCE_SHAPE, with the optical centre, the principal point and the homography
+        jittered per seed as they differ between the bands of a camera.
+        Parameters:
+            - rows, cols: Frame size.
+            - seed: Band seed.
+        Returns:
+            - infoDict: Calibration dictionary in the format read by corrections.py.
+    """
+    rng = np.random.default_rng(seed)
+    scale = cols / REFERENCE_SHAPE[1]
+    centerX = float(INFO_DICT['Calibrated Optical Center X']) * scale + rng.normal(0, 4)
+    centerY = float(INFO_DICT['Calibrated Optical Center Y']) * rows / REFERENCE_SHAPE[0] + rng.normal(0, 4)
+
+    # r is in pixels, so the coefficient of r^i scales with 1 / scale^i
+    k = [float(elem.strip(',')) for elem in INFO_DICT['Vignetting Data'].split()]
+    vignetting = ', '.join(f"{coefficient / scale ** (i + 1):.6g}" for i, coefficient in enumerate(k))
+
+    date, dewarp = INFO_DICT['Dewarp Data'].split(';')
+    dewarp = [float(elem) for elem in dewarp.split(',')]
+    dewarp[:4] = [value * scale for value in dewarp[:4]]
+    dewarp[2:4] = [value + rng.normal(0, 2) for value in dewarp[2:4]]
+
+    H = np.asarray([float(elem) for elem in INFO_DICT['Calibrated H Matrix'].split(',')]).reshape(3, 3)
+    H[:2, :2] += rng.normal(0, 1e-3, (2, 2))
+    H[:2, 2] = H[:2, 2] * scale + rng.normal(0, 2, 2)
+    H[2, :2] /= scale
+
+    return {
+        'Calibrated Optical Center X': f"{centerX:.1f}",
+        'Calibrated Optical Center Y': f"{centerY:.1f}",
+        'Vignetting Data': vignetting,
+        'Dewarp Data': f"{date};" + ','.join(f"{value:.6g}" for value in dewarp),
+        'Calibrated H Matrix': ','.join(f"{value:.6g}" for value in H.ravel()),
+    }
+
+def parse_size(size):
+    """
+        Parse a 'COLSxROWS' frame size (or a single side, for a square frame).
+        Returns:
+            - shape: (rows, cols).
+    """
+    cols, _, rows = size.partition('x')
+    return int(rows or cols), int(cols)
+
+def build_case(case, size, tmp_dir, model=None, threads=None):
+    """
+        Prepare the inputs of one case and return the call to time. The preparation (frame
+        synthesis, file writes, model loading) is not timed.
+        Parameters:
+            - case: One of PREPROCESSING_CASES, or 'yolo'.
+            - size: Frame size ('COLSxROWS'), or the inference size for 'yolo'.
+            - tmp_dir: Directory for the input files.
+            - model: Detector path for 'yolo' (see inference.load_detector), or a model
+              .yaml to run an untrained model built offline.
+            - threads: CPU threads of the detector.
+        Returns:
+            - run: Callable without arguments.
+    """
+    rows, cols = parse_size(size)
+    if case == 'yolo':
+        from inference import TorchDetector, load_detector
+
+        detector = TorchDetector(model, rows, threads) if model.endswith('.yaml') else load_detector(model, rows, threads)
+        image = cv2.cvtColor(cv2.normalize(synthetic_frame(rows, cols), None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U),
+                             cv2.COLOR_GRAY2RGB if detector.channels == 3 else cv2.COLOR_GRAY2BGRA)
+        return lambda: detector([image])
+
+    frame = synthetic_frame(rows, cols)
+    infoDict = synthetic_calibration(rows, cols)
+    if case == 'vig_correct':
+        # vig_correct reads the band itself, so the decode is part of the case
+        image_path = os.path.join(tmp_dir, f'band_{os.getpid()}_{size}.TIF')
+        Image.fromarray(frame).save(image_path)
+        return lambda: vig_correct(image_path, infoDict)
+    if case == 'undistort':
+        return lambda: undistort(frame, infoDict)
+    if case == 'align_phase_rotation':
+        return lambda: align_phase_rotation(frame, infoDict)
+    if case == 'align_images_using_ecc':
+        # square pair, as the bands are aligned after the centre crop
+        reference, target = synthetic_pair(min(rows, cols))
+        return lambda: align_images_using_ecc(reference, target)
+    if case == 'crop_center':
+        return lambda: crop_center(frame, min(1500, rows, cols))
+    if case == 'zoom_center':
+        return lambda: zoom_center(frame, 1.3)
+    raise ValueError(f"Unknown case: {case}")
+
+def _time_case(case, size, repeat, warmup, model=None, threads=None):
+    """
+        Build a case and time repeat samples after warmup untimed calls. A sample is one call,
+        or as many calls as needed to last MIN_SAMPLE_SECONDS for the fast cases.
+        Returns:
+            - samples: Mean wall time of a call in each sample, in seconds.
+    """
+    if threads is not None:
+        cv2.setNumThreads(threads)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run = build_case(case, size, tmp_dir, model, threads)
+        for _ in range(warmup):
+            run()
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_SAMPLE_SECONDS:
+                break
+            number *= 10
+        samples = [elapsed / number]
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            samples.append((time.perf_counter() - start) / number)
+    return samples
+
+def measure(case, size, workers=1, repeat=5, warmup=1, model=None):
+    """
+        Time a case on workers processes running it concurrently, each repeat times. With
+        several workers the cores are shared between them (threads = cores // workers), as in
+        batch.py, so the throughput shows how the case scales over a flight.
+        Parameters:
+            - case, size, model: See build_case.
+            - workers: Number of concurrent processes (1: in this process).
+            - repeat: Timed calls per worker.
+            - warmup: Untimed calls per worker before them.
+        Returns:
+            - result: Dictionary with the median, p95 and min latency in ms, and the
+              throughput in calls per second over all workers.
+    """
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else None
+    start = time.perf_counter()
+    if workers == 1:
+        samples = _time_case(case, size, repeat, warmup, model, threads)
+        wall = sum(samples)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_time_case, case, size, repeat, warmup, model, threads) for _ in range(workers)]
+            per_worker = [future.result() for future in futures]
+        samples = [sample for worker in per_worker for sample in worker]
+        # the workers ran side by side: the slowest one bounds the timed part
+        wall = max(sum(worker) for worker in per_worker)
+    samples = np.array(samples) * 1000
+    return {
+        'case': case,
+        'size': size,
+        'workers': workers,
+        'repeat': repeat,
+        'median_ms': float(np.median(samples)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'min_ms': float(samples.min()),
+        'throughput': len(samples) / wall,
+        'total_seconds': time.perf_counter() - start,
+    }
+
+def environment():
+    """
+        Return what the results depend on besides the code: commit, machine and libraries.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARK_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+def result_key(result):
+    return f"{result['case']}/{result['size']}/w{result['workers']}"
+
+def run_suite(cases, sizes, workers, repeat=5, warmup=1, model=None, imgsz=(640, 1024)):
+    """
+        Run every case over every size and worker count.
+        Parameters:
+            - cases: Cases to run (PREPROCESSING_CASES and/or 'yolo').
+            - sizes: Frame sizes of the preprocessing cases ('COLSxROWS').
+            - workers: Worker counts.
+            - repeat, warmup: See measure.
+            - model: Detector of the 'yolo' case. The case is skipped without one.
+            - imgsz: Inference sizes of the 'yolo' case.
+        Returns:
+            - report: Dictionary with the environment and the results by key
+              (case/size/wWORKERS), ready for json.dump.
+    """
+    report = {'environment': environment(), 'results': {}, 'skipped': {}}
+    for case in cases:
+        case_sizes = [str(size) for size in imgsz] if case == 'yolo' else sizes
+        for size in case_sizes:
+            for count in workers:
+                key = f"{case}/{size}/w{count}"
+                if case == 'yolo' and model is None:
+                    report['skipped'][key] = 'no --model'
+                    continue
+                try:
+                    result = measure(case, size, count, repeat, warmup, model)
+                except ImportError as e:
+                    report['skipped'][key] = f"{type(e).__name__}: {e}"
+                    print(f"{key:<44} skipped ({e})")
+                    continue
+                report['results'][key] = result
+                print(f"{key:<44} {result['median_ms']:10.3f} ms  p95 {result['p95_ms']:10.3f} ms  "
+                      f"{result['throughput']:8.1f} /s")
+    return report
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+        Compare two reports of run_suite, case by case.
+        Parameters:
+            - baseline, current: Reports (loaded JSON).
+            - threshold: Relative slowdown of the median latency, or drop of the throughput,
+              flagged as a regression.
+        Returns:
+            - rows: List of (key, baseline median, current median, relative change, status),
+              status being 'regression', 'improvement', 'ok', 'new' or 'removed'.
+    """
+    rows = []
+    old_results, new_results = baseline['results'], current['results']
+    for key in sorted(set(old_results) | set(new_results)):
+        old, new = old_results.get(key), new_results.get(key)
+        if old is None or new is None:
+            rows.append((key, old and old['median_ms'], new and new['median_ms'], None,
+                         'new' if old is None else 'removed'))
+            continue
+        change = new['median_ms'] / old['median_ms'] - 1
+        throughput_drop = 1 - new['throughput'] / old['throughput']
+        if change > threshold or throughput_drop > threshold:
+            status = 'regression'
+        elif change < -threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((key, old['median_ms'], new['median_ms'], change, status))
+    return rows
+
+def _run_main(args):
+    report = run_suite(args.cases, args.sizes, args.workers, args.repeat, args.warmup, args.model, args.imgsz)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = report['environment']['commit'] or datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{name}{'-dirty' if report['environment']['dirty'] else ''}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results: {output}")
+
+def _compare_main(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    old_env, new_env = baseline['environment'], current['environment']
+    print(f"baseline {old_env['commit']} ({old_env['date']})  vs  current {new_env['commit']} ({new_env['date']})")
+    if (old_env['processor'], old_env['cpu_count']) != (new_env['processor'], new_env['cpu_count']):
+        print("warning: the reports come from different machines")
+
+    rows = compare(baseline, current, args.threshold)
+    regressions = 0
+    for key, old, new, change, status in rows:
+        old_text = '-' if old is None else f"{old:.3f}"
+        new_text = '-' if new is None else f"{new:.3f}"
+        change_text = '' if change is None else f"{100 * change:+7.1f}%"
+        print(f"{key:<44} {old_text:>10} {new_text:>10} ms {change_text:>9}  {status}")
+        regressions += status == 'regression'
+    print(f"{regressions} regression(s) over {100 * args.threshold:.0f}%")
+    # non-zero exit status, so a CI job can fail on it
+    sys.exit(1 if regressions else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessing, alignment and inference benchmark suite")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the suite and store the results as JSON')
+    run_parser.add_argument('--cases', nargs='+', default=list(PREPROCESSING_CASES) + ['yolo'],
+                            choices=list(PREPROCESSING_CASES) + ['yolo'])
+    run_parser.add_argument('--sizes', nargs='+', default=['1296x972', '2592x1944'], help='Frame sizes, COLSxROWS')
+    run_parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, os.cpu_count() or 1}))
+    run_parser.add_argument('--repeat', type=int, default=5, help='Timed calls per worker')
+    run_parser.add_argument('--warmup', type=int, default=1, help='Untimed calls per worker')
+    run_parser.add_argument('--model', type=str, default=None,
+                            help='Detector of the yolo case (best.pt/.onnx/..., or e.g. yolo11n.yaml for an '
+                                 'untrained model); the case is skipped without it')
+    run_parser.add_argument('--imgsz', nargs='+', type=int, default=[640, 1024], help='Inference sizes of the yolo case')
+    run_parser.add_argument('--output', type=str, default=None, help='JSON file (default: results/<commit>.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='Flag the regressions between two result files')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help='Relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        _run_main(args)
+    else:
+        _compare_main(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import argparse
+import os
+import random
+import re
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from labels import INVALID, load_index, write_label_file
+
+# defaults of the notebooks/data_augmentation.py transform
+CROP_SIZE = 500
+MIN_AREA = 2500
+MIN_VISIBILITY = 0.3
+
+# augmented copies are named <stem>_aug<suffix>, then <stem>_aug1<suffix>, <stem>_aug2<suffix>...
+AUG_PATTERN = re.compile(r'_aug\d*$')
+
+# per-process state, created once by _init_worker
+_worker = {}
+
+def build_transform(crop_size=CROP_SIZE, min_area=MIN_AREA, min_visibility=MIN_VISIBILITY):
+    """
+        Build the albumentations pipeline of the offline augmentation: a random crop, a
+        horizontal flip and a brightness/contrast change. Boxes cut below min_area pixels or
+        min_visibility of their area by the crop are dropped.
+    """
+    import albumentations as A
+
+    return A.Compose(
+        [
+            A.RandomCrop(width=crop_size, height=crop_size, p=1.0),
+            A.HorizontalFlip(p=0.5),
+            A.RandomBrightnessContrast(p=0.5),
+        ],
+        bbox_params=A.BboxParams(
+            format='yolo',
+            min_area=min_area,
+            min_visibility=min_visibility,
+            label_fields=['class_labels']
+        )
+    )
+
+def seed_transform(transform, seed):
+    """
+        Seed every random generator the transform may draw from, so the same seed gives the
+        same augmentation whatever the albumentations version and the worker running it.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    if hasattr(transform, 'set_random_seed'):
+        transform.set_random_seed(seed)
+
+def sample_seed(seed, dataset, name, copy):
+    """
+        Seed of one augmented copy, stable across runs and processes.
+        Parameters:
+            - seed: Seed of the run.
+            - dataset: Dataset name.
+            - name: File name of the source image.
+            - copy: Index of the copy.
+        Returns:
+            - seed: 32-bit integer.
+    """
+    return zlib.crc32(f"{seed}/{dataset}/{name}/{copy}".encode())
+
+def output_paths(img_path, copy):
+    """
+        Return the image and label paths of an augmented copy of img_path.
+    """
+    images_dir, name = os.path.split(img_path)
+    stem, suffix = os.path.splitext(name)
+    aug_stem = f"{stem}_aug{copy if copy else ''}"
+    labels_dir = os.path.join(os.path.dirname(images_dir), 'labels')
+    return os.path.join(images_dir, aug_stem + suffix), os.path.join(labels_dir, aug_stem + '.txt')
+
+def _init_worker(crop_size, min_area, min_visibility):
+    """
+        Build the transform once per worker process.
+    """
+    # one OpenCV thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    _worker['transform'] = build_transform(crop_size, min_area, min_visibility)
+
+def _augment_one(task):
+    """
+        Write the missing augmented copies of one image.
+        Parameters:
+            - task: (dataset name, image path, class ids, boxes, number of copies, seed); the
+              labels come from the label index of the split.
+        Returns:
+            - counts: Dictionary with the number of copies 'written', 'skipped' (already on
+              disk), 'empty' (the crop kept no box) and 'errors', and the error message.
+    """
+    dataset, img_path, class_labels, bboxes, copies, seed = task
+    counts = {'written': 0, 'skipped': 0, 'empty': 0, 'errors': 0, 'error': None}
+    todo = []
+    for copy in range(copies):
+        aug_img_path, aug_label_path = output_paths(img_path, copy)
+        # the label is written last, so it only exists once the copy is complete
+        if os.path.exists(aug_label_path) and os.path.exists(aug_img_path):
+            counts['skipped'] += 1
+        else:
+            todo.append((copy, aug_img_path, aug_label_path))
+    if not todo:
+        return counts
+
+    # every transform treats the channels alike, so the image stays in OpenCV's BGR order
+    image = cv2.imread(img_path)
+    if image is None:
+        counts['errors'] += len(todo)
+        counts['error'] = f"{os.path.basename(img_path)}: could not read it"
+        return counts
+
+    transform = _worker['transform']
+    for copy, aug_img_path, aug_label_path in todo:
+        try:
+            seed_transform(transform, sample_seed(seed, dataset, os.path.basename(img_path), copy))
+            transformed = transform(image=image, bboxes=bboxes, class_labels=class_labels)
+            # the crop removed every box: nothing to learn from
+            if len(transformed['bboxes']) == 0:
+                counts['empty'] += 1
+                continue
+            if not cv2.imwrite(aug_img_path, transformed['image']):
+                raise OSError(f"could not write {aug_img_path}")
+            write_label_file(aug_label_path, transformed['class_labels'], transformed['bboxes'])
+            counts['written'] += 1
+        except Exception as e:
+            counts['errors'] += 1
+            counts['error'] = f"{os.path.basename(img_path)}: {type(e).__name__}: {e}"
+    return counts
+
+def list_sources(index):
+    """
+        Return the images of a split that can be augmented: not augmented copies themselves,
+        with a label file whose labels are valid.
+        Parameters:
+            - index: LabelIndex of the split.
+        Returns:
+            - sources: List of (position in the index, image path).
+            - rejected: List of messages for the images left out because of their labels.
+    """
+    sources = []
+    rejected = []
+    valid = index.valid & ~index.issues['missing']
+    for i, path in enumerate(index.image_paths):
+        if AUG_PATTERN.search(os.path.splitext(os.path.basename(path))[0]):
+            continue
+        if valid[i]:
+            sources.append((i, path))
+        else:
+            issue = next(issue for issue in ('missing',) + INVALID if index.issues[issue][i])
+            rejected.append(f"{index.files[i]}: {issue} labels")
+    return sources, rejected
+
+def retention(shapes, crop_size=CROP_SIZE):
+    """
+        Expected fraction of the objects of an image kept by the random crop: the share of the
+        image area it covers.
+        Parameters:
+            - shapes: int array of shape (images, 2) with the height and width of each image.
+        Returns:
+            - retention: float array of shape (images,).
+    """
+    shapes = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+    return np.minimum(1, crop_size / np.maximum(shapes[:, 0], 1)) * np.minimum(1, crop_size / np.maximum(shapes[:, 1], 1))
+
+def balanced_copies(class_counts, keep, target=None, max_copies=5):
+    """
+        Decide how many augmented copies each image gets so that the expected number of
+        objects of every class reaches target, with as few copies as possible.
+        The classes are served from the rarest. The copies of a class go first to the images
+        where it is the largest share of the objects, so they add little to the other classes,
+        one copy per image per round until the class reaches the target or every image holding
+        it has max_copies.
+        Parameters:
+            - class_counts: int array of shape (images, classes), see LabelIndex.image_class_counts.
+            - keep: float array of shape (images,), expected fraction of the objects of an image
+              in one copy (retention).
+            - target: Objects per class to reach (default: the count of the most common class).
+            - max_copies: Maximum copies of one image.
+        Returns:
+            - copies: int array of shape (images,).
+            - expected: float array of shape (classes,), the expected objects of each class
+              with the copies.
+    """
+    counts = np.asarray(class_counts, dtype=np.float64)
+    expected = counts.sum(0)
+    if target is None:
+        target = expected.max() if len(expected) else 0
+    gain = counts * np.asarray(keep, dtype=np.float64)[:, None]
+    shares = counts / np.maximum(counts.sum(1, keepdims=True), 1)
+    copies = np.zeros(len(counts), dtype=np.int64)
+
+    for c in np.argsort(expected, kind='stable'):
+        holders = np.flatnonzero(counts[:, c])
+        holders = holders[np.argsort(-shares[holders, c], kind='stable')]
+        for _ in range(max_copies):
+            if expected[c] >= target:
+                break
+            for i in holders:
+                if expected[c] >= target:
+                    break
+                if copies[i] < max_copies:
+                    copies[i] += 1
+                    expected += gain[i]
+    return copies, expected
+
+def augment_datasets(dataset_dirs, split='train', copies=1, seed=0, workers=None, crop_size=CROP_SIZE,
+                     min_area=MIN_AREA, min_visibility=MIN_VISIBILITY, balance=False, target=None):
+    """
+        Write augmented copies of the images of one split of several datasets, next to them.
+        The images are spread over a process pool. Every copy has its own seed, derived from
+        the run seed, the dataset, the file name and the copy index, so a run is reproducible
+        and its result does not depend on the number of workers. Copies already on disk are
+        skipped, so an interrupted run can be resumed.
+        Parameters:
+            - dataset_dirs: Dataset directories, each with a <split>/images and <split>/labels.
+            - split: Split to augment.
+            - copies: Augmented copies per image, or the maximum per image with balance.
+            - seed: Seed of the run.
+            - workers: Number of worker processes (default: os.cpu_count()).
+            - crop_size, min_area, min_visibility: See build_transform.
+            - balance: Give each image the number of copies chosen by balanced_copies from the
+              class counts of the label index, instead of the same number to every image.
+            - target: Objects per class to reach with balance (default: the most common class).
+        Returns:
+            - stats: Dictionary with the number of source images, the counts of _augment_one
+              summed over every image, the errors, the elapsed time and, per dataset, the
+              scheduled copies and the objects per class before and (expected) after.
+    """
+    tasks = []
+    rejected = []
+    schedules = {}
+    for dataset_dir in dataset_dirs:
+        dataset = os.path.basename(os.path.normpath(dataset_dir))
+        index = load_index(os.path.join(dataset_dir, split))
+        sources, dataset_rejected = list_sources(index)
+        rejected.extend(dataset_rejected)
+        positions = np.array([i for i, _ in sources], dtype=np.int64)
+        class_counts = index.image_class_counts()[positions]
+        keep = retention(index.shapes[positions], crop_size)
+        if balance:
+            image_copies, expected = balanced_copies(class_counts, keep, target, copies)
+        else:
+            image_copies = np.full(len(sources), copies, dtype=np.int64)
+            expected = class_counts.sum(0) + (class_counts * keep[:, None] * copies).sum(0)
+        schedules[dataset] = {'copies': int(image_copies.sum()), 'objects': class_counts.sum(0).tolist(),
+                              'expected': np.round(expected, 1).tolist()}
+
+        for (i, path), image_copy_count in zip(sources, image_copies.tolist()):
+            if image_copy_count:
+                cls, bboxes = index.labels(i)
+                tasks.append((dataset, path, cls[:, 0].astype(int).tolist(), bboxes.tolist(), image_copy_count, seed))
+
+    stats = {'images': len(tasks), 'written': 0, 'skipped': 0, 'empty': 0, 'errors': len(rejected),
+             'messages': rejected, 'schedules': schedules}
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(crop_size, min_area, min_visibility)) as executor:
+        for i, counts in enumerate(executor.map(_augment_one, tasks, chunksize=8), 1):
+            for key in ('written', 'skipped', 'empty', 'errors'):
+                stats[key] += counts[key]
+            if counts['error']:
+                stats['messages'].append(counts['error'])
+            if i % 500 == 0:
+                print(f"{i}/{len(tasks)} images")
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline augmentation of YOLO datasets (random crop, flip, brightness/contrast)")
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument('--base', type=str, help='Directory with one subdirectory per dataset')
+    sources.add_argument('--datasets', type=str, nargs='+', help='Dataset directories')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--copies', type=int, default=1, help='Augmented copies per image (maximum with --balance)')
+    parser.add_argument('--balance', action='store_true', help='Give more copies to the images of rare classes')
+    parser.add_argument('--target', type=int, default=None, help='Objects per class to reach with --balance '
+                                                                 '(default: the most common class)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--crop-size', type=int, default=CROP_SIZE)
+    parser.add_argument('--min-area', type=float, default=MIN_AREA)
+    parser.add_argument('--min-visibility', type=float, default=MIN_VISIBILITY)
+    args = parser.parse_args()
+
+    if args.base:
+        dataset_dirs = sorted(os.path.join(args.base, name) for name in os.listdir(args.base)
+                              if os.path.isdir(os.path.join(args.base, name, args.split, 'images')))
+    else:
+        dataset_dirs = args.datasets
+
+    stats = augment_datasets(dataset_dirs, args.split, args.copies, args.seed, args.workers,
+                             args.crop_size, args.min_area, args.min_visibility, args.balance, args.target)
+    for dataset, schedule in stats['schedules'].items():
+        print(f"{dataset}: {schedule['copies']} copies scheduled")
+        print(f"  {'class':>5} {'objects':>8} {'expected':>9}")
+        for c, (objects, expected) in enumerate(zip(schedule['objects'], schedule['expected'])):
+            print(f"  {c:>5} {objects:>8} {expected:>9.0f}")
+    for message in stats['messages']:
+        print(f"Error augmenting {message}")
+    copies = stats['written'] + stats['skipped'] + stats['empty'] + stats['errors']
+    print(f"{len(dataset_dirs)} datasets, {stats['images']} images: {stats['written']} copies written, "
+          f"{stats['skipped']} already there, {stats['empty']} without boxes, {stats['errors']} failed "
+          f"in {stats['seconds']:.1f} s ({copies / max(stats['seconds'], 1e-9):.1f} copies/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.jpg', '.jpeg', '.png')
+
+# label index of a split, next to its images/ and labels/
+LABEL_INDEX = 'label_index.npz'
+LABEL_INDEX_VERSION = 2
+
+# one row per object
+LABEL_DTYPE = np.dtype([
+    ('cls', np.int32),
+    ('x', np.float32),
+    ('y', np.float32),
+    ('w', np.float32),
+    ('h', np.float32),
+])
+
+# problems reported by validate, per image; the last three make the labels of an image unusable
+ISSUES = ('missing', 'empty', 'duplicates', 'malformed', 'out_of_range', 'unreadable')
+INVALID = ('malformed', 'out_of_range', 'unreadable')
+
+def list_split_images(split_dir):
+    """
+        List the images of a split (split_dir/images) in sorted order.
+    """
+    return sorted(path for path in glob.glob(os.path.join(split_dir, 'images', '*'))
+                  if path.lower().endswith(IMAGE_EXTENSIONS))
+
+def label_path(split_dir, imgPath):
+    """
+        Return the label file of an image of a split.
+    """
+    stem = os.path.splitext(os.path.basename(imgPath))[0]
+    return os.path.join(split_dir, 'labels', f"{stem}.txt")
+
+def parse_labels(text):
+    """
+        Parse the content of a YOLO detection label file.
+        Parameters:
+            - text: File content, one 'class x y w h' row per object.
+        Returns:
+            - labels: float32 array of shape (n, 5).
+        Raises:
+            - ValueError: If the rows do not have 5 numbers each.
+    """
+    tokens = text.split()
+    if len(tokens) % 5:
+        raise ValueError(f"{len(tokens)} values, not a multiple of 5")
+    return np.array(tokens, dtype=np.float32).reshape(-1, 5)
+
+def read_label_file(label_path):
+    """
+        Read a YOLO detection label file.
+        Parameters:
+            - label_path: Path to the .txt file; a missing file means no objects.
+        Returns:
+            - labels: float32 array of shape (n, 5) with class, x, y, w, h (normalized).
+    """
+    if not os.path.exists(label_path):
+        return np.zeros((0, 5), dtype=np.float32)
+    with open(label_path) as f:
+        return parse_labels(f.read())
+
+def write_label_file(label_path, cls, bboxes):
+    """
+        Write a YOLO detection label file.
+        Parameters:
+            - label_path: Path to the .txt file.
+            - cls: Class ids, of shape (n,) or (n, 1).
+            - bboxes: Normalized x, y, w, h, of shape (n, 4).
+    """
+    cls = np.asarray(cls).reshape(-1).astype(np.int64)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    row = '%d ' + ' '.join(['%.6f'] * 4) + '\n'
+    with open(label_path, 'w') as f:
+        f.write(''.join(row % (c, *box) for c, box in zip(cls.tolist(), bboxes.tolist())))
+
+def validate(rows, offsets, nc=None):
+    """
+        Check the labels of a split in one pass over all its rows.
+        Parameters:
+            - rows: float32 array of shape (n, 5) with the rows of every image, concatenated.
+            - offsets: int64 array of shape (images + 1): the rows of image i are
+              rows[offsets[i]:offsets[i + 1]].
+            - nc: Number of classes; class ids are only checked against it when given.
+        Returns:
+            - issues: Dictionary with boolean arrays of shape (images,): 'empty' (no rows),
+              'duplicates' (repeated rows) and 'out_of_range' (a class that is negative, not
+              an integer or >= nc, a coordinate outside [0, 1] or a non-positive size, or a
+              value that is not finite).
+    """
+    counts = np.diff(offsets)
+    image_of_row = np.repeat(np.arange(len(counts)), counts)
+
+    cls, coords = rows[:, 0], rows[:, 1:]
+    bad = ~np.isfinite(rows).all(1) | (cls < 0) | (cls != np.floor(cls)) | (coords < 0).any(1) | (coords > 1).any(1) | (coords[:, 2:] <= 0).any(1)
+    if nc is not None:
+        bad |= cls >= nc
+
+    # rows equal to the previous row of the same image, once sorted
+    keyed = np.column_stack((image_of_row, rows))
+    keyed = keyed[np.lexsort(keyed.T[::-1])]
+    repeated = (keyed[1:] == keyed[:-1]).all(1)
+
+    return {
+        'empty': counts == 0,
+        'duplicates': np.bincount(keyed[1:, 0][repeated].astype(np.int64), minlength=len(counts)) > 0,
+        'out_of_range': np.bincount(image_of_row[bad], minlength=len(counts)) > 0,
+    }
+
+def directory_key(split_dir):
+    """
+        Return the cache key of a split: the index version and the modification times of its
+        images/ and labels/ directories, which change whenever a file is added, removed or
+        replaced (but not when a label file is edited in place: rebuild the index then).
+    """
+    key = [LABEL_INDEX_VERSION]
+    for name in ('images', 'labels'):
+        path = os.path.join(split_dir, name)
+        key.append(os.stat(path).st_mtime_ns if os.path.isdir(path) else 0)
+    return np.array(key, dtype=np.int64)
+
+class LabelIndex:
+    """
+        Label index
+        All the labels of a split in one structured array (LABEL_DTYPE), with the offsets of
+        the rows of each image, the image shapes and the problems found by validate. It is
+        built once by reading every label file and saved next to the split, so opening it
+        again only loads a few arrays.
+
+        Usage:
+            index = load_index('dataset/train')
+            cls, bboxes = index.labels(0)
+            print(index.class_counts())
+    """
+
+    def __init__(self, split_dir, files, shapes, offsets, rows, issues, orphans, key):
+        self.split_dir = split_dir
+        self.files = list(files)
+        self.shapes = shapes
+        self.offsets = offsets
+        self.rows = rows
+        self.issues = issues
+        self.orphans = list(orphans)
+        self.key = key
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def image_paths(self):
+        return [os.path.join(self.split_dir, 'images', name) for name in self.files]
+
+    @property
+    def valid(self):
+        """
+            Boolean array: images whose labels can be used.
+        """
+        invalid = np.zeros(len(self), dtype=bool)
+        for issue in INVALID:
+            invalid |= self.issues[issue]
+        return ~invalid
+
+    def labels(self, i):
+        """
+            Return the labels of image i, as PackedStore.labels.
+            Returns:
+                - cls: float32 array of shape (n, 1) with the class ids.
+                - bboxes: float32 array of shape (n, 4) with normalized x, y, w, h.
+        """
+        rows = self.rows[self.offsets[i]:self.offsets[i + 1]]
+        bboxes = np.column_stack((rows['x'], rows['y'], rows['w'], rows['h'])).reshape(-1, 4)
+        return rows['cls'].astype(np.float32).reshape(-1, 1), bboxes
+
+    def image_class_counts(self, nc=None):
+        """
+            Return the number of objects of each class in each image. The rows of invalid
+            images and the classes outside [0, nc) are not counted.
+            Returns:
+                - counts: int64 array of shape (images, classes).
+        """
+        image_of_row = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        cls = self.rows['cls']
+        keep = self.valid[image_of_row] & (cls >= 0)
+        nc = nc or (int(cls[keep].max()) + 1 if keep.any() else 0)
+        keep &= cls < nc
+        counts = np.zeros((len(self), nc), dtype=np.int64)
+        np.add.at(counts, (image_of_row[keep], cls[keep]), 1)
+        return counts
+
+    def class_counts(self, nc=None):
+        """
+            Return the number of objects of each class in the split.
+        """
+        return self.image_class_counts(nc).sum(0)
+
+    def summary(self):
+        """
+            Return the number of images with each issue and of orphaned label files.
+        """
+        summary = {'images': len(self), 'objects': len(self.rows)}
+        summary.update({issue: int(self.issues[issue].sum()) for issue in ISSUES})
+        summary['orphaned_labels'] = len(self.orphans)
+        return summary
+
+    @classmethod
+    def build(cls, split_dir, nc=None):
+        """
+            Read every label file and image header of a split.
+            Parameters:
+                - split_dir: Split directory with the images/ and labels/ subdirectories.
+                - nc: Number of classes, see validate.
+            Returns:
+                - index: LabelIndex.
+        """
+        key = directory_key(split_dir)
+        imgPaths = list_split_images(split_dir)
+        labels_dir = os.path.join(split_dir, 'labels')
+        label_files = set(os.listdir(labels_dir)) if os.path.isdir(labels_dir) else set()
+
+        issues = {issue: np.zeros(len(imgPaths), dtype=bool) for issue in ISSUES}
+        shapes = np.zeros((len(imgPaths), 2), dtype=np.int32)
+        tokens = {}
+        counts = np.zeros(len(imgPaths), dtype=np.int64)
+        stems = set()
+        for i, imgPath in enumerate(imgPaths):
+            try:
+                with Image.open(imgPath) as image:
+                    shapes[i] = image.height, image.width
+            except OSError:
+                issues['unreadable'][i] = True
+
+            stem = os.path.splitext(os.path.basename(imgPath))[0]
+            stems.add(stem)
+            if f"{stem}.txt" not in label_files:
+                issues['missing'][i] = True
+                continue
+            with open(os.path.join(labels_dir, f"{stem}.txt")) as f:
+                image_tokens = f.read().split()
+            if len(image_tokens) % 5:
+                issues['malformed'][i] = True
+                continue
+            tokens[i] = image_tokens
+            counts[i] = len(image_tokens) // 5
+
+        # every number of the split is converted at once
+        try:
+            values = np.array([t for image_tokens in tokens.values() for t in image_tokens], dtype=np.float32)
+        except ValueError:
+            # some file has a token that is not a number: find it, then convert the others
+            for i, image_tokens in tokens.items():
+                try:
+                    np.array(image_tokens, dtype=np.float32)
+                except ValueError:
+                    issues['malformed'][i] = True
+                    counts[i] = 0
+            values = np.array([t for i, image_tokens in tokens.items() if not issues['malformed'][i]
+                               for t in image_tokens], dtype=np.float32)
+        values = values.reshape(-1, 5)
+        offsets = np.zeros(len(imgPaths) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        checks = validate(values, offsets, nc)
+        issues['empty'] = checks['empty'] & ~issues['missing'] & ~issues['malformed']
+        issues['duplicates'] = checks['duplicates']
+        issues['out_of_range'] = checks['out_of_range']
+
+        rows = np.zeros(len(values), dtype=LABEL_DTYPE)
+        rows['cls'] = values[:, 0]
+        for j, field in enumerate(('x', 'y', 'w', 'h'), 1):
+            rows[field] = values[:, j]
+
+        orphans = sorted(name for name in label_files if name.endswith('.txt') and name[:-4] not in stems)
+        files = [os.path.basename(path) for path in imgPaths]
+        return cls(split_dir, files, shapes, offsets, rows, issues, orphans, key)
+
+    def save(self, path=None):
+        """
+            Save the index (default: split_dir/LABEL_INDEX), atomically.
+        """
+        path = path or os.path.join(self.split_dir, LABEL_INDEX)
+        tmp_path = f"{path[:-4]}.tmp.npz"
+        np.savez(tmp_path, key=self.key, files=np.array(self.files, dtype=str), shapes=self.shapes,
+                 offsets=self.offsets, rows=self.rows, orphans=np.array(self.orphans, dtype=str),
+                 **{f"issue_{issue}": self.issues[issue] for issue in ISSUES})
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, split_dir, path=None):
+        """
+            Load a saved index.
+            Returns:
+                - index: LabelIndex, or None if there is none or it is out of date.
+        """
+        path = path or os.path.join(split_dir, LABEL_INDEX)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            if not np.array_equal(data['key'], directory_key(split_dir)):
+                return None
+            issues = {issue: data[f"issue_{issue}"] for issue in ISSUES}
+            return cls(split_dir, data['files'].tolist(), data['shapes'], data['offsets'], data['rows'], issues,
+                       data['orphans'].tolist(), data['key'])
+
+def load_index(split_dir, rebuild=False, nc=None):
+    """
+        Return the label index of a split, building and saving it when it is missing or its
+        directories changed since it was saved.
+        Parameters:
+            - split_dir: Split directory with the images/ and labels/ subdirectories.
+            - rebuild: Build the index even if the saved one is up to date.
+            - nc: Number of classes, see validate (only used when building).
+        Returns:
+            - index: LabelIndex.
+    """
+    index = None if rebuild else LabelIndex.load(split_dir)
+    if index is None:
+        index = LabelIndex.build(split_dir, nc)
+        try:
+            index.save()
+        except OSError:
+            # read-only dataset: use the index without caching it
+            pass
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and check the label index of the splits of a YOLO dataset")
+    parser.add_argument('--dataset', type=str, required=True, help='Dataset directory with one subdirectory per split')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--nc', type=int, default=None, help='Number of classes, to check the class ids')
+    parser.add_argument('--rebuild', action='store_true', help='Ignore the saved index')
+    parser.add_argument('--verbose', action='store_true', help='List the files with each issue')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        split_dir = os.path.join(args.dataset, split)
+        if not os.path.isdir(os.path.join(split_dir, 'images')):
+            print(f"Skipping {split}: no images directory")
+            continue
+        start = time.perf_counter()
+        index = load_index(split_dir, rebuild=args.rebuild, nc=args.nc)
+        elapsed = time.perf_counter() - start
+        print(f"{split}: {json.dumps(index.summary())} in {elapsed * 1000:.1f} ms")
+        if args.verbose:
+            for issue in ISSUES:
+                for i in np.flatnonzero(index.issues[issue]):
+                    print(f"  {issue}: {index.files[i]}")
+            for name in index.orphans:
+                print(f"  orphaned label: {name}")
+
+if __name__ == "__main__":
+    main()
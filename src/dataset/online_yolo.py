@@ -0,0 +1,189 @@
+import collections
+import math
+from copy import deepcopy
+
+import cv2
+import numpy as np
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+
+from augment import CROP_SIZE, MIN_AREA, MIN_VISIBILITY, build_transform
+from packed_yolo import PackedDetectionValidator, PackedYOLODataset, _packed_datasets, _swap_dataset
+
+# decoded images kept by each data loader worker
+DEFAULT_CACHE_BYTES = 512 * 2**20
+# new crops drawn for a sample whose crop kept no box, before falling back to the full image
+MAX_RETRIES = 10
+
+class DecodeCache:
+    """
+        Decode cache
+        Least recently used cache of decoded images, bounded in bytes. Each data loader worker
+        holds its own copy, so the budget is per worker.
+
+        Usage:
+            cache = DecodeCache(512 * 2**20)
+            image = cache.get(path)
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, flags=cv2.IMREAD_COLOR):
+        self.max_bytes = max_bytes
+        self.flags = flags
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = collections.OrderedDict()
+
+    def get(self, path):
+        """
+            Return the decoded image of path, decoding it with cv2.imread on a miss.
+        """
+        image = self._images.get(path)
+        if image is not None:
+            self._images.move_to_end(path)
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = cv2.imread(path, self.flags)
+        if image is None:
+            raise FileNotFoundError(f"Image Not Found {path}")
+        # read-only, so an augmentation working in place cannot change the cached pixels
+        image.flags.writeable = False
+        if image.nbytes <= self.max_bytes:
+            self._images[path] = image
+            self.bytes += image.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= evicted.nbytes
+        return image
+
+class OnlineAugmentation:
+    """
+        Online augmentation
+        Mixin of a YOLODataset that appends `copies` augmented versions of every training image,
+        drawn again each time they are loaded, instead of reading the _aug files written by
+        augment.py. An augmented sample goes through the same albumentations transform as
+        augment.py, starting from the full resolution image, and then through the usual
+        ultralytics pipeline. The full resolution images come from the packed store of the
+        split when there is one, and from a DecodeCache otherwise.
+    """
+    copies = 0
+
+    def __init__(self, *args, copies=1, crop_size=CROP_SIZE, min_area=MIN_AREA, min_visibility=MIN_VISIBILITY,
+                 cache_bytes=DEFAULT_CACHE_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.copies = copies if self.augment else 0
+        self.transform = build_transform(crop_size, min_area, min_visibility)
+        self.decode_cache = DecodeCache(cache_bytes, getattr(self, 'cv2_flag', cv2.IMREAD_COLOR))
+
+    def __len__(self):
+        return len(self.labels) * (1 + self.copies)
+
+    def full_image(self, i):
+        """
+            Return image i at full resolution, read-only.
+        """
+        if getattr(self, 'store', None) is not None:
+            return self.store.image(i)
+        return self.decode_cache.get(self.im_files[i])
+
+    def get_image_and_label(self, index):
+        """
+            Return sample index: the images of the split first, then their augmented copies.
+        """
+        if index < len(self.labels):
+            return super().get_image_and_label(index)
+
+        index %= len(self.labels)
+        label = deepcopy(self.labels[index])
+        label.pop('shape', None)
+        image = self.full_image(index)
+        for _ in range(MAX_RETRIES):
+            transformed = self.transform(image=image, bboxes=label['bboxes'], class_labels=label['cls'][:, 0])
+            if len(transformed['bboxes']):
+                break
+        else:
+            # no crop kept a box: train on the image itself
+            return super().get_image_and_label(index)
+
+        im = transformed['image']
+        h0, w0 = im.shape[:2]
+        # resize like BaseDataset.load_image in augment mode
+        r = self.imgsz / max(h0, w0)
+        if r != 1:
+            w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
+            im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+        elif not im.flags.writeable:
+            im = im.copy()
+        if im.ndim == 2:
+            im = im[..., None]
+
+        label['img'] = im
+        label['ori_shape'] = (h0, w0)
+        label['resized_shape'] = im.shape[:2]
+        label['ratio_pad'] = (im.shape[0] / h0, im.shape[1] / w0)
+        label['bboxes'] = np.array(transformed['bboxes'], dtype=np.float32).reshape(-1, 4)
+        label['cls'] = np.array(transformed['class_labels'], dtype=np.float32).reshape(-1, 1)
+        label['segments'] = []
+        return self.update_labels_info(label)
+
+class OnlineYOLODataset(OnlineAugmentation, YOLODataset):
+    """
+        YOLODataset with online augmentation, reading the image files.
+    """
+
+class OnlinePackedYOLODataset(OnlineAugmentation, PackedYOLODataset):
+    """
+        PackedYOLODataset with online augmentation, reading the packed store.
+    """
+
+class OnlineAugmentationTrainer(DetectionTrainer):
+    """
+        DetectionTrainer building its training split with online augmentation. The options
+        are class attributes, set by online_trainer.
+
+        Usage:
+            model.train(data='data.yaml', trainer=online_trainer(copies=1), ...)
+    """
+    copies = 1
+    packed = False
+    options = {}
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        if mode != 'train':
+            if self.packed:
+                with _packed_datasets():
+                    return super().build_dataset(img_path, mode, batch)
+            return super().build_dataset(img_path, mode, batch)
+
+        dataset = OnlinePackedYOLODataset if self.packed else OnlineYOLODataset
+
+        def factory(*args, **kwargs):
+            return dataset(*args, copies=self.copies, **self.options, **kwargs)
+
+        with _swap_dataset(factory):
+            return super().build_dataset(img_path, mode, batch)
+
+    def get_validator(self):
+        validator = super().get_validator()
+        if self.packed:
+            validator.__class__ = PackedDetectionValidator
+        return validator
+
+def online_trainer(copies=1, packed=False, crop_size=CROP_SIZE, min_area=MIN_AREA, min_visibility=MIN_VISIBILITY,
+                   cache_bytes=DEFAULT_CACHE_BYTES):
+    """
+        Return an OnlineAugmentationTrainer subclass with these options, to pass as trainer=.
+        Parameters:
+            - copies: Augmented samples per training image and epoch.
+            - packed: Read the packed stores of the splits.
+            - crop_size, min_area, min_visibility: See augment.build_transform.
+            - cache_bytes: Budget of the DecodeCache of each data loader worker.
+        Returns:
+            - trainer: Trainer class.
+    """
+    options = {'crop_size': crop_size, 'min_area': min_area, 'min_visibility': min_visibility,
+               'cache_bytes': cache_bytes}
+    return type('OnlineAugmentationTrainer', (OnlineAugmentationTrainer,),
+                {'copies': copies, 'packed': packed, 'options': options})
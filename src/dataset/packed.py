@@ -0,0 +1,207 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+
+from labels import load_index
+
+# name of the packed store directory, next to the images/ and labels/ of a split
+PACKED_DIR = 'packed'
+PACKED_VERSION = 1
+
+# one row per image: where its pixels start in images.bin, its shape and its labels
+INDEX_DTYPE = np.dtype([
+    ('offset', np.int64),
+    ('height', np.int32),
+    ('width', np.int32),
+    ('channels', np.int32),
+    ('label_start', np.int64),
+    ('label_count', np.int32),
+])
+
+def _read_flags(channels):
+    """
+        Return the cv2.imread flags decoding an image like ultralytics does for that many channels.
+    """
+    return {1: cv2.IMREAD_GRAYSCALE, 3: cv2.IMREAD_COLOR}.get(channels, cv2.IMREAD_UNCHANGED)
+
+def pack_split(split_dir, channels=3, output_dir=None):
+    """
+        Pack one split of a YOLO dataset into a memory-mappable store.
+        The decoded pixels of every image are written one after the other to a single
+        images.bin file; index.npy holds the offset and shape of each image and the position of
+        its rows in labels.npy, so training reads an image as a slice of the mapped file
+        instead of decoding a TIFF/PNG every epoch.
+        Parameters:
+            - split_dir: Split directory with the images/ and labels/ subdirectories.
+            - channels: Number of channels the images are decoded to, as the 'channels' of
+              data.yaml (3: BGR, 1: grayscale, other: unchanged).
+            - output_dir: Store directory (default: split_dir/packed). The store is built in a
+              temporary directory next to it and only replaces it once complete, so a store
+              being packed or interrupted is never picked up.
+        Returns:
+            - output_dir: The store directory.
+    """
+    output_dir = os.path.normpath(output_dir or os.path.join(split_dir, PACKED_DIR))
+    label_index = load_index(split_dir)
+    imgPaths = label_index.image_paths
+    if not imgPaths:
+        raise FileNotFoundError(f"No images found in {os.path.join(split_dir, 'images')}")
+    malformed = [label_index.files[i] for i in np.flatnonzero(label_index.issues['malformed'])]
+    if malformed:
+        raise ValueError(f"Malformed label files for {malformed[:5]} ({len(malformed)} images)")
+
+    index = np.zeros(len(imgPaths), dtype=INDEX_DTYPE)
+    labels = []
+    dtype = None
+    offset = 0
+    label_start = 0
+
+    tmp_dir = f"{output_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        with open(os.path.join(tmp_dir, 'images.bin'), 'wb') as f:
+            for i, imgPath in enumerate(imgPaths):
+                img = cv2.imread(imgPath, _read_flags(channels))
+                if img is None:
+                    raise ValueError(f"Could not read {imgPath}")
+                if img.ndim == 2:
+                    img = img[..., None]
+                if dtype is None:
+                    dtype = img.dtype
+                elif img.dtype != dtype:
+                    raise ValueError(f"{imgPath} is {img.dtype}, the other images are {dtype}")
+
+                cls, bboxes = label_index.labels(i)
+                image_labels = np.concatenate((cls, bboxes), axis=1)
+
+                index[i] = (offset, img.shape[0], img.shape[1], img.shape[2], label_start, len(image_labels))
+                f.write(np.ascontiguousarray(img).tobytes())
+                offset += img.size
+                labels.append(image_labels)
+                label_start += len(image_labels)
+
+        np.save(os.path.join(tmp_dir, 'index.npy'), index)
+        np.save(os.path.join(tmp_dir, 'labels.npy'), np.concatenate(labels))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': PACKED_VERSION,
+                'dtype': np.dtype(dtype).name,
+                'channels': channels,
+                'files': [os.path.relpath(path, split_dir) for path in imgPaths],
+            }, f, indent=1)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # a directory cannot replace a non-empty one, so the old store is moved aside first;
+    # in between, find_store sees no store and the images are decoded from their files
+    old_dir = f"{output_dir}.{os.getpid()}.old"
+    if os.path.exists(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return output_dir
+
+def find_store(img_path):
+    """
+        Return the packed store of an images directory (the img_path of data.yaml), or None.
+        Parameters:
+            - img_path: Images directory of a split, e.g. dataset/train/images.
+        Returns:
+            - store_dir: Path to split/packed if it holds a complete store, else None.
+    """
+    if not isinstance(img_path, str) or not os.path.isdir(img_path):
+        return None
+    store_dir = os.path.join(os.path.dirname(os.path.normpath(img_path)), PACKED_DIR)
+    return store_dir if os.path.exists(os.path.join(store_dir, 'images.bin')) else None
+
+class PackedStore:
+    """
+        Packed store
+        Read-only access to a split packed by pack_split. The pixels are memory-mapped, so
+        image(i) is a read-only view into the page cache: nothing is decoded or copied until
+        the caller resizes it, or copies it before modifying it in place.
+
+        Usage:
+            store = PackedStore('dataset/train/packed')
+            img = store.image(0)
+            cls, bboxes = store.labels(0)
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.split_dir = os.path.dirname(os.path.normpath(store_dir))
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != PACKED_VERSION:
+            raise ValueError(f"{store_dir} has version {meta['version']}, expected {PACKED_VERSION}; pack it again")
+
+        self.channels = meta['channels']
+        self.files = [os.path.join(self.split_dir, path) for path in meta['files']]
+        self.index = np.load(os.path.join(store_dir, 'index.npy'))
+        self._labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        self._pixels = np.memmap(os.path.join(store_dir, 'images.bin'), dtype=np.dtype(meta['dtype']), mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def image(self, i):
+        """
+            Return image i as a (height, width, channels) view of the mapped file.
+        """
+        offset, height, width, channels = (int(v) for v in self.index[['offset', 'height', 'width', 'channels']][i])
+        return self._pixels[offset:offset + height * width * channels].reshape(height, width, channels)
+
+    def shape(self, i):
+        """
+            Return the (height, width) of image i without touching its pixels.
+        """
+        return int(self.index['height'][i]), int(self.index['width'][i])
+
+    def labels(self, i):
+        """
+            Return the labels of image i.
+            Returns:
+                - cls: float32 array of shape (n, 1) with the class ids.
+                - bboxes: float32 array of shape (n, 4) with normalized x, y, w, h.
+        """
+        start = int(self.index['label_start'][i])
+        rows = self._labels[start:start + int(self.index['label_count'][i])]
+        return rows[:, :1], rows[:, 1:]
+
+@functools.lru_cache(maxsize=None)
+def open_store(store_dir):
+    """
+        Return the PackedStore of a directory, opened once per process, so consecutive
+        training runs on the same split (e.g. a sweep over architectures) share its index,
+        labels and mapping.
+    """
+    return PackedStore(store_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a YOLO dataset into memory-mapped stores")
+    parser.add_argument('--dataset', type=str, required=True, help='Dataset directory with one subdirectory per split')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--channels', type=int, default=3, help='Channels to decode, as in data.yaml')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        split_dir = os.path.join(args.dataset, split)
+        if not os.path.isdir(os.path.join(split_dir, 'images')):
+            print(f"Skipping {split}: no images directory")
+            continue
+        start = time.perf_counter()
+        store_dir = pack_split(split_dir, channels=args.channels)
+        store = PackedStore(store_dir)
+        size = os.path.getsize(os.path.join(store_dir, 'images.bin'))
+        print(f"{split}: {len(store)} images, {size / 2**30:.2f} GiB in {time.perf_counter() - start:.1f} s -> {store_dir}")
+
+if __name__ == "__main__":
+    main()
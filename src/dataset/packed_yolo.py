@@ -0,0 +1,166 @@
+import contextlib
+import math
+import os
+
+import cv2
+import numpy as np
+from ultralytics.data import YOLODataset, build
+from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+from ultralytics.utils import LOGGER
+
+from labels import load_index
+from packed import find_store, open_store
+
+def _split_dir(img_path):
+    """
+        Return the split directory of an images directory, or None if img_path is not one.
+    """
+    if not isinstance(img_path, str) or not os.path.isdir(img_path):
+        return None
+    return os.path.dirname(os.path.normpath(img_path))
+
+def _label_dict(im_file, shape, cls, bboxes):
+    """
+        Return the label dictionary of one image, as YOLODataset.get_labels builds it.
+    """
+    return {
+        'im_file': im_file,
+        'shape': shape,
+        'cls': cls.copy(),
+        'bboxes': bboxes.copy(),
+        'segments': [],
+        'keypoints': None,
+        'normalized': True,
+        'bbox_format': 'xywh',
+    }
+
+class PackedYOLODataset(YOLODataset):
+    """
+        Packed YOLO dataset
+        YOLODataset that reads the images and labels of a split from its packed store
+        (packed.pack_split) instead of decoding the image files and scanning the label files.
+        Splits without a store, or whose store does not match the images directory, decode
+        the image files and take their labels from the label index (labels.load_index).
+    """
+
+    def __init__(self, *args, img_path=None, **kwargs):
+        self.store = None
+        store_dir = find_store(img_path)
+        if store_dir is not None:
+            self.store = open_store(store_dir)
+        super().__init__(*args, img_path=img_path, **kwargs)
+
+    def get_labels(self):
+        """
+            Build the label dictionaries from the store, or from the label index without one.
+        """
+        if self.store is not None and (sorted(map(os.path.basename, self.im_files))
+                                       != sorted(map(os.path.basename, self.store.files))):
+            LOGGER.warning(f"{self.store.store_dir} does not hold the {len(self.im_files)} images of the split "
+                           f"({len(self.store)} packed); ignoring it. Run packed.py again.")
+            self.store = None
+        if self.store is None:
+            return self._indexed_labels()
+
+        self.im_files = list(self.store.files)
+        return [_label_dict(im_file, self.store.shape(i), *self.store.labels(i)) for i, im_file in enumerate(self.im_files)]
+
+    def _indexed_labels(self):
+        """
+            Build the label dictionaries from the label index of the split (labels.load_index),
+            leaving out the images with unusable labels, or scan the label files if the index
+            does not cover the images ultralytics found.
+        """
+        split_dir = _split_dir(self.img_path)
+        index = load_index(split_dir) if split_dir is not None else None
+        if index is None or sorted(map(os.path.basename, self.im_files)) != index.files:
+            return super().get_labels()
+
+        valid = index.valid
+        if not valid.all():
+            LOGGER.warning(f"{split_dir}: ignoring {int((~valid).sum())} images with malformed or out of range "
+                           f"labels; run labels.py --verbose to list them")
+        image_paths = index.image_paths
+        self.im_files = [image_paths[i] for i in np.flatnonzero(valid)]
+        return [_label_dict(image_paths[i], tuple(int(v) for v in index.shapes[i]), *index.labels(i))
+                for i in np.flatnonzero(valid)]
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        """
+            Load image i from the store, resized like BaseDataset.load_image.
+        """
+        if self.store is None or self.ims[i] is not None:
+            return super().load_image(i, rect_mode, **kwargs)
+
+        im = self.store.image(i)
+        h0, w0 = im.shape[:2]
+        if rect_mode:  # resize long side to imgsz while maintaining aspect ratio
+            r = self.imgsz / max(h0, w0)
+            if r != 1:
+                w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
+                im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+        elif not (h0 == w0 == self.imgsz):  # resize by stretching image to square imgsz
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        if im.ndim == 2:
+            im = im[..., None]
+        if self.augment and not im.flags.writeable:
+            # still a view of the store: augmentations such as RandomHSV work in place
+            im = im.copy()
+
+        # same buffer of recent images for mosaic as the base class
+        if self.augment and self.cache != 'ram':
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+
+        return im, (h0, w0), im.shape[:2]
+
+@contextlib.contextmanager
+def _swap_dataset(dataset):
+    """
+        Make ultralytics' build_yolo_dataset create its datasets with dataset (a YOLODataset
+        subclass or a function taking the same arguments).
+    """
+    original = build.YOLODataset
+    build.YOLODataset = dataset
+    try:
+        yield
+    finally:
+        build.YOLODataset = original
+
+def _packed_datasets():
+    """
+        Make ultralytics' build_yolo_dataset create PackedYOLODataset instances.
+    """
+    return _swap_dataset(PackedYOLODataset)
+
+class PackedDetectionTrainer(DetectionTrainer):
+    """
+        DetectionTrainer reading the packed stores of the splits.
+
+        Usage:
+            model.train(data='data.yaml', trainer=PackedDetectionTrainer, ...)
+    """
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        with _packed_datasets():
+            return super().build_dataset(img_path, mode, batch)
+
+    def get_validator(self):
+        validator = super().get_validator()
+        validator.__class__ = PackedDetectionValidator
+        return validator
+
+class PackedDetectionValidator(DetectionValidator):
+    """
+        DetectionValidator reading the packed stores of the splits.
+
+        Usage:
+            model.val(data='data.yaml', validator=PackedDetectionValidator, ...)
+    """
+
+    def build_dataset(self, img_path, mode='val', batch=None):
+        with _packed_datasets():
+            return super().build_dataset(img_path, mode, batch)
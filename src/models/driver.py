@@ -0,0 +1,470 @@
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import mlflow
+import torch
+from ultralytics import YOLO
+from ultralytics.data.utils import check_det_dataset
+
+from registry import load_registry
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../dataset"))
+from online_yolo import online_trainer
+from packed_yolo import PackedDetectionTrainer, PackedDetectionValidator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../preprocessing"))
+from instrument import current_rss
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."))
+EXPERIMENT = "cerrado_tree_identifier"
+# seconds between two samples of the resident memory of a CPU run
+RSS_SAMPLE_INTERVAL = 0.05
+
+@contextlib.contextmanager
+def _phase(timings, name):
+    """
+        Record the wall time of a block in timings[name], in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+def _parse_device(device):
+    """
+        Return a CUDA index as an int ('0' -> 0) and any other device ('cpu') unchanged.
+    """
+    return int(device) if isinstance(device, str) and device.isdigit() else device
+
+def _is_cuda(device):
+    return device != 'cpu' and torch.cuda.is_available()
+
+def _start_mlflow():
+    os.environ["ULTRALYTICS_MLFLOW"] = "True"
+    mlflow.set_tracking_uri(f"file://{os.path.join(PROJECT_ROOT, 'mlruns')}")
+    mlflow.set_experiment(EXPERIMENT)
+
+def _set_tags(tags):
+    """
+        Set MLflow tags given as 'key:value,key:value'.
+    """
+    if tags:
+        for tag in tags.split(','):
+            key, value = tag.split(':')
+            mlflow.set_tag(key, value)
+
+def _metric_name(key, prefix=''):
+    return prefix + key.replace("metrics/", "").replace("(", "").replace(")", "").replace(" ", "_")
+
+class _PeakMemory:
+    """
+        Peak memory of one run, in bytes: the allocated CUDA memory on a GPU; on CPU, the
+        highest resident memory of the process during the run above its resident memory at
+        the start, sampled by a thread. ru_maxrss never goes down, so in a worker running
+        several runs it would report the peak of an earlier one.
+
+        Usage:
+            with _PeakMemory(device) as peak:
+                model.train(...)
+                record['peak_memory'] = peak.stop()
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.peak = None
+
+    def __enter__(self):
+        if _is_cuda(self.device):
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return self
+        self._start = self._max = current_rss()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stopped.wait(RSS_SAMPLE_INTERVAL):
+            self._max = max(self._max, current_rss())
+
+    def stop(self):
+        """
+            Stop measuring and return the peak; later calls return the same value.
+        """
+        if self.peak is None:
+            if _is_cuda(self.device):
+                self.peak = torch.cuda.max_memory_allocated(self.device)
+            else:
+                self._stopped.set()
+                self._thread.join()
+                self.peak = max(self._max, current_rss()) - self._start
+        return self.peak
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+def free_memory():
+    """
+        Release the memory of a finished run before the next one starts: collect the Python
+        objects still holding tensors, then return the cached CUDA blocks to the driver.
+    """
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+def train_run(model_name, entry, data, name, device=0, epochs=150, batch=8, imgsz=1000, patience=30,
+              tags=None, phase=None, packed=False, online=0):
+    """
+        Train one architecture on one dataset and log it to MLflow.
+        Parameters:
+            - model_name: Registry name of the architecture, e.g. 'yolo11n'.
+            - entry: Its registry entry (registry.load_registry).
+            - data: Path to data.yaml.
+            - name: Run name.
+            - device: CUDA index or 'cpu'.
+            - epochs, batch, imgsz, patience: Training options.
+            - tags: MLflow tags as 'key:value,key:value'.
+            - phase: project_phase tag and runs/<runs>/<phase> folder (default: the registry's).
+            - packed: Read the packed stores of the splits (src/dataset/packed.py).
+            - online: Augmented copies of each training image drawn on the fly every epoch
+              (src/dataset/online_yolo.py), instead of _aug files; 0 to turn it off.
+        Returns:
+            - record: Dictionary with the run parameters, the metrics, the path of best.pt, the
+              wall time of each phase ('load', 'train', 'log') and the peak memory.
+    """
+    phase = phase or entry['phase']
+    timings = {}
+    record = {'model': model_name, 'data': data, 'name': name, 'device': str(device), 'mode': 'train'}
+
+    _start_mlflow()
+    if mlflow.active_run():
+        mlflow.end_run()
+
+    with _PeakMemory(device) as peak, mlflow.start_run(run_name=name):
+        with _phase(timings, 'load'):
+            model = YOLO(os.path.join(PROJECT_ROOT, "models", entry['weights']))
+
+        _set_tags(tags)
+        mlflow.set_tag("model_version", entry['version'])
+        mlflow.set_tag("project_phase", phase)
+
+        options = {}
+        if entry['early_stopping']:
+            options['patience'] = patience
+        trainer = PackedDetectionTrainer if packed else None
+        if online:
+            trainer = online_trainer(copies=online, packed=packed)
+        with _phase(timings, 'train'):
+            results = model.train(
+                trainer=trainer,
+                data=data,
+                epochs=epochs,
+                batch=batch,
+                imgsz=imgsz,
+                name=name,
+                exist_ok=True,
+                save=True,
+                plots=True,
+                device=device,
+                project=os.path.join(PROJECT_ROOT, f"runs/{entry['runs']}/{phase}"),
+                **options
+            )
+
+        with _phase(timings, 'log'):
+            record['metrics'] = {}
+            if results is not None:
+                for k, v in results.results_dict.items():
+                    record['metrics'][_metric_name(k)] = float(v)
+                    mlflow.log_metric(_metric_name(k), float(v))
+            save_dir = str(model.trainer.save_dir)
+            record['weights'] = os.path.join(save_dir, "weights", "best.pt")
+            mlflow.log_artifacts(save_dir)
+
+        record['peak_memory'] = peak.stop()
+        record['timings'] = timings
+        for phase_name, seconds in timings.items():
+            mlflow.log_metric(f"time_{phase_name}_s", seconds)
+        mlflow.log_metric("peak_memory_mb", record['peak_memory'] / 2**20)
+
+    del model, results
+    free_memory()
+    return record
+
+def eval_run(model_name, entry, weights, data, name, aug='no', tags=None, device=None, imgsz=1000, batch=None,
+             packed=False):
+    """
+        Evaluate trained weights on the test split and log it to MLflow.
+        Parameters:
+            - model_name: Registry name of the architecture.
+            - entry: Its registry entry.
+            - weights: Path to best.pt.
+            - data: Path to data.yaml.
+            - name: MLflow run name.
+            - aug: 'yes' or 'no', the is_augmented tag.
+            - tags: MLflow tags as 'key:value,key:value'.
+            - device: CUDA index or 'cpu' (default: chosen by ultralytics).
+            - imgsz: Image size.
+            - batch: Batch size (default: the registry's eval_batch).
+            - packed: Read the packed stores of the splits.
+        Returns:
+            - record: Dictionary with the run parameters, the test metrics, the wall time of
+              each phase ('load', 'test') and the peak memory.
+    """
+    timings = {}
+    record = {'model': model_name, 'data': data, 'name': name, 'device': str(device), 'mode': 'eval',
+              'weights': weights}
+    reports_dir = os.path.join(PROJECT_ROOT, 'reports', 'evaluations')
+
+    _start_mlflow()
+    with _PeakMemory(device) as peak:
+        with _phase(timings, 'load'):
+            model = YOLO(weights)
+
+        with mlflow.start_run(run_name=name):
+            mlflow.set_tag("model_version", entry.get('eval_version', entry['version']))
+            mlflow.set_tag("phase", "evaluation")
+            mlflow.set_tag("is_augmented", aug)
+            _set_tags(tags)
+
+            options = {} if device is None else {'device': device}
+            with _phase(timings, 'test'):
+                results = model.val(
+                    validator=PackedDetectionValidator if packed else None,
+                    data=data,
+                    split='test',
+                    imgsz=imgsz,
+                    batch=batch or entry['eval_batch'],
+                    project=reports_dir,
+                    name=name,
+                    save=True,
+                    plots=True,
+                    **options
+                )
+
+            record['metrics'] = {}
+            for k, v in results.results_dict.items():
+                record['metrics'][_metric_name(k, 'test_')] = float(v)
+                mlflow.log_metric(_metric_name(k, 'test_'), float(v))
+
+            record['peak_memory'] = peak.stop()
+            record['timings'] = timings
+            for phase_name, seconds in timings.items():
+                mlflow.log_metric(f"time_{phase_name}_s", seconds)
+
+    del model, results
+    free_memory()
+    return record
+
+def dataset_name(data):
+    """
+        Return the name of a dataset: the folder holding its data.yaml, e.g. 'fused-ndvi'.
+    """
+    return os.path.basename(os.path.dirname(os.path.abspath(data)))
+
+def plan_sweep(models, datasets, evaluate=False, **options):
+    """
+        List the runs of a sweep, grouped by dataset so consecutive runs read the same files
+        (and, with --packed, the same mapped stores) while they are still in the page cache.
+        Parameters:
+            - models: Registry names of the architectures.
+            - datasets: Paths to data.yaml files.
+            - evaluate: Also evaluate each trained model on the test split.
+            - options: Passed to train_run.
+        Returns:
+            - runs: List of run dictionaries.
+    """
+    return [dict(options, model=model, data=data, name=dataset_name(data), evaluate=evaluate)
+            for data in datasets for model in models]
+
+def execute(run, registry, device):
+    """
+        Run one entry of a sweep on a device, catching its errors so the sweep goes on.
+        Returns:
+            - records: The training record, followed by the test record if run['evaluate'].
+    """
+    run = dict(run)
+    model_name, evaluate = run.pop('model'), run.pop('evaluate')
+    entry = registry[model_name]
+    try:
+        record = train_run(model_name, entry, device=device, **run)
+        record['status'] = 'ok'
+    except Exception as e:
+        free_memory()
+        return [{'model': model_name, 'data': run['data'], 'name': run['name'], 'device': str(device),
+                 'mode': 'train', 'status': 'error', 'error': f"{type(e).__name__}: {e}"}]
+
+    if not evaluate:
+        return [record]
+    # same run names as execute_eval.sh
+    aug = 'no' if (run['phase'] or entry['phase']) == 'no_augmentation' else 'yes'
+    test_name = f"test_{'no_augmented' if aug == 'no' else 'augmented'}_{run['name']}"
+    try:
+        test_record = eval_run(model_name, entry, record['weights'], run['data'], test_name, aug=aug,
+                               tags=run['tags'], device=device, imgsz=run['imgsz'], packed=run['packed'])
+        test_record['status'] = 'ok'
+    except Exception as e:
+        free_memory()
+        test_record = {'model': model_name, 'data': run['data'], 'name': test_name, 'device': str(device),
+                       'mode': 'eval', 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    return [record, test_record]
+
+def _device_worker(device, registry, tasks, results):
+    """
+        Worker process owning one device: runs the queued sweep entries one after the other.
+    """
+    for run in iter(tasks.get, None):
+        results.put(execute(run, registry, device))
+
+def run_sweep(runs, registry, devices):
+    """
+        Run a sweep, one run at a time per device.
+        With a single device the runs execute in this process. With several, one process per
+        device takes the next run from a shared queue, so faster devices take more runs.
+        Parameters:
+            - runs: Run dictionaries (plan_sweep).
+            - registry: The model registry.
+            - devices: CUDA indices and/or 'cpu'.
+        Returns:
+            - records: Generator of run records, in completion order.
+    """
+    datasets = []
+    for run in runs:
+        if run['data'] not in datasets:
+            datasets.append(run['data'])
+    for data in datasets:
+        # fail early on a broken data.yaml, before any device starts training
+        check_det_dataset(data)
+
+    if len(devices) == 1:
+        for run in runs:
+            yield from execute(run, registry, devices[0])
+        return
+
+    context = multiprocessing.get_context('spawn')
+    tasks, results = context.Queue(), context.Queue()
+    for run in runs:
+        tasks.put(run)
+    workers = [context.Process(target=_device_worker, args=(device, registry, tasks, results)) for device in devices]
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+
+    received = 0
+    while received < len(runs):
+        try:
+            records = results.get(timeout=10)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                print(f"All device workers exited with {len(runs) - received} runs left")
+                break
+            continue
+        received += 1
+        yield from records
+    for worker in workers:
+        worker.join()
+
+def default_devices():
+    """
+        Return every CUDA device, or ['cpu'] without one.
+    """
+    count = torch.cuda.device_count()
+    return list(range(count)) if count else ['cpu']
+
+def _train_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--tags', type=str, help='Tags')
+    parser.add_argument('--patience', type=int, default=30, help='Early stopping')
+    parser.add_argument('--epochs', type=int, default=150)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--imgsz', type=int, default=1000)
+    parser.add_argument('--phase', type=str, default=None, help='project_phase tag (default: from the registry)')
+    parser.add_argument('--packed', action='store_true', help='Read the packed stores of the splits (src/dataset/packed.py)')
+    parser.add_argument('--online-augment', type=int, default=0, metavar='COPIES',
+                        help='Augmented copies per training image drawn on the fly (src/dataset/online_yolo.py)')
+    return parser
+
+def train_main(model_name):
+    """
+        Command line of src/models/<model>/train.py.
+    """
+    parser = _train_parser("YOLO Training & Validation Pipeline")
+    parser.add_argument('--data', type=str, required=True, help='Path to data.yaml')
+    parser.add_argument('--name', type=str, required=True, help='Unique run name')
+    parser.add_argument('--device', type=str, default='0', help="CUDA index or 'cpu'")
+    args = parser.parse_args()
+
+    record = train_run(model_name, load_registry()[model_name], args.data, args.name,
+                       device=_parse_device(args.device), epochs=args.epochs, batch=args.batch,
+                       imgsz=args.imgsz, patience=args.patience, tags=args.tags, phase=args.phase,
+                       packed=args.packed, online=args.online_augment)
+    print(json.dumps(record['timings']))
+
+def eval_main(model_name):
+    """
+        Command line of src/models/<model>/eval.py.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='Path for best.pt')
+    parser.add_argument('--data', type=str, required=True, help='Path for data.yaml')
+    parser.add_argument('--name', type=str, required=True, help='MLflow run name')
+    parser.add_argument('--tags', type=str, required=True)
+    parser.add_argument('--aug', type=str, required=True, help='yes ou no')
+    parser.add_argument('--device', type=str, default=None, help="CUDA index or 'cpu'")
+    parser.add_argument('--packed', action='store_true', help='Read the packed stores of the splits (src/dataset/packed.py)')
+    args = parser.parse_args()
+
+    record = eval_run(model_name, load_registry()[model_name], args.model, args.data, args.name, aug=args.aug,
+                      tags=args.tags, device=_parse_device(args.device), packed=args.packed)
+    print(json.dumps(record['timings']))
+
+def main():
+    parser = _train_parser("Train (and evaluate) several architectures on several datasets")
+    parser.add_argument('--data', type=str, nargs='+', required=True, help='Paths to data.yaml')
+    parser.add_argument('--models', type=str, nargs='+', default=None, help='Registry names (default: all)')
+    parser.add_argument('--devices', type=str, nargs='+', default=None, help="CUDA indices and/or 'cpu' (default: all GPUs)")
+    parser.add_argument('--evaluate', action='store_true', help='Evaluate each trained model on the test split')
+    parser.add_argument('--config', type=str, default=None, help='JSON file extending the model registry')
+    parser.add_argument('--report', type=str, default=None, help='JSON lines report (default: reports/sweeps/<time>.jsonl)')
+    args = parser.parse_args()
+
+    registry = load_registry(args.config)
+    models = args.models or list(registry)
+    unknown = [model for model in models if model not in registry]
+    if unknown:
+        parser.error(f"unknown models {unknown}, expected some of {sorted(registry)}")
+    devices = [_parse_device(device) for device in args.devices] if args.devices else default_devices()
+
+    runs = plan_sweep(models, args.data, evaluate=args.evaluate, epochs=args.epochs, batch=args.batch,
+                      imgsz=args.imgsz, patience=args.patience, tags=args.tags, phase=args.phase,
+                      packed=args.packed, online=args.online_augment)
+    report_path = args.report or os.path.join(PROJECT_ROOT, 'reports', 'sweeps', f"{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    print(f"{len(runs)} runs ({len(models)} models x {len(args.data)} datasets) on devices {devices}")
+
+    with open(report_path, 'w') as report:
+        for record in run_sweep(runs, registry, devices):
+            report.write(json.dumps(record) + '\n')
+            report.flush()
+            if record['status'] != 'ok':
+                print(f"{record['mode']} {record['model']} on {record['name']}: {record['error']}")
+                continue
+            mAP = record['metrics'].get('mAP50-95B', record['metrics'].get('test_mAP50-95B', float('nan')))
+            seconds = ' '.join(f"{phase}={value:.0f}s" for phase, value in record['timings'].items())
+            print(f"{record['mode']} {record['model']} on {record['name']} [{record['device']}]: "
+                  f"mAP50-95 {mAP:.3f}, {seconds}, peak {record['peak_memory'] / 2**30:.1f} GiB")
+    print(f"Report: {report_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+import abc
+import argparse
+import ast
+import glob
+import json
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+# ultralytics pads letterboxed images with this gray level
+PAD_VALUE = 114
+STRIDE = 32
+FORMATS = ('onnx', 'openvino', 'torchscript')
+IMAGE_PATTERNS = ('*.jpg', '*.JPG', '*.tif', '*.TIF', '*.png')
+
+def set_cpu_threads(threads):
+    """
+        Limit the threads used by PyTorch and OpenCV in this process. ONNX Runtime and
+        OpenVINO sessions get the same limit through their own options (load_detector).
+        Parameters:
+            - threads: Number of threads, or None to keep the library defaults.
+    """
+    if threads is None:
+        return
+    import torch
+
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+def model_imgsz(imgsz):
+    """
+        Return imgsz rounded up to a multiple of the model stride, as ultralytics does (1000 -> 1024).
+    """
+    return int(math.ceil(imgsz / STRIDE) * STRIDE)
+
+def letterbox(image, imgsz):
+    """
+        Resize an image to fit imgsz x imgsz keeping its aspect ratio, and pad the rest.
+        Parameters:
+            - image: (H, W, C) uint8 image.
+            - imgsz: Side of the square model input.
+        Returns:
+            - padded: (imgsz, imgsz, C) uint8 image.
+            - ratio: Scale from the image to the model input.
+            - pad: (left, top) padding, in model input pixels.
+    """
+    h, w = image.shape[:2]
+    ratio = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    left, top = (imgsz - new_w) // 2, (imgsz - new_h) // 2
+    padded = np.full((imgsz, imgsz) + image.shape[2:], PAD_VALUE, dtype=np.uint8)
+    padded[top:top + new_h, left:left + new_w] = image
+    return padded, ratio, (left, top)
+
+def preprocess(images, imgsz):
+    """
+        Build the model input of a batch of images.
+        Parameters:
+            - images: List of (H, W, C) uint8 images, RGB for 3-channel models.
+            - imgsz: Side of the square model input.
+        Returns:
+            - batch: (N, C, imgsz, imgsz) float32 array in [0, 1].
+            - transforms: (ratio, pad) of each image, for postprocess.
+    """
+    batch = []
+    transforms = []
+    for image in images:
+        padded, ratio, pad = letterbox(image if image.ndim == 3 else image[..., None], imgsz)
+        batch.append(padded.transpose(2, 0, 1))
+        transforms.append((ratio, pad))
+    batch = np.stack(batch).astype(np.float32)
+    batch /= 255
+    return batch, transforms
+
+def nms(boxes, scores, classes, iou=0.7):
+    """
+        Class-aware non-maximum suppression.
+        Parameters:
+            - boxes: (n, 4) x1, y1, x2, y2 boxes.
+            - scores: (n,) confidences.
+            - classes: (n,) class ids; boxes of different classes never suppress each other.
+            - iou: IoU above which the lower-scoring box is dropped.
+        Returns:
+            - keep: Indices of the kept boxes, by decreasing score.
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    xywh = np.concatenate((boxes[:, :2], boxes[:, 2:] - boxes[:, :2]), axis=1)
+    keep = cv2.dnn.NMSBoxesBatched(xywh.tolist(), scores.tolist(), classes.astype(int).tolist(), 0.0, iou)
+    keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+    return keep[np.argsort(-scores[keep], kind='stable')]
+
+def postprocess(predictions, transforms, shapes, conf=0.25, iou=0.7, max_det=300):
+    """
+        Turn raw YOLO outputs into detections in image coordinates.
+        Parameters:
+            - predictions: (N, 4 + classes, anchors) output of the model (cx, cy, w, h, scores).
+            - transforms: (ratio, pad) of each image (preprocess).
+            - shapes: (H, W) of each original image.
+            - conf: Minimum class confidence.
+            - iou: IoU threshold of the NMS.
+            - max_det: Maximum detections per image.
+        Returns:
+            - detections: List of (n, 6) float32 arrays with x1, y1, x2, y2, confidence, class.
+    """
+    detections = []
+    for prediction, (ratio, (left, top)), (h, w) in zip(predictions, transforms, shapes):
+        scores = prediction[4:]
+        classes = scores.argmax(axis=0)
+        confidences = scores[classes, np.arange(scores.shape[1])]
+        candidates = confidences > conf
+        cx, cy, bw, bh = prediction[:4, candidates]
+        boxes = np.stack((cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2), axis=1)
+        confidences, classes = confidences[candidates], classes[candidates]
+
+        keep = nms(boxes, confidences, classes, iou)[:max_det]
+        boxes = boxes[keep]
+        boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - left) / ratio).clip(0, w)
+        boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - top) / ratio).clip(0, h)
+        detections.append(np.concatenate(
+            (boxes, confidences[keep, None], classes[keep, None]), axis=1).astype(np.float32))
+    return detections
+
+def read_image(path, channels=3):
+    """
+        Read an image the way the model was trained on it (RGB for 3 channels).
+        Parameters:
+            - path: Path to the image.
+            - channels: Channels of the model input.
+        Returns:
+            - image: (H, W, C) uint8 image.
+    """
+    if channels == 3:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if channels == 3 else image
+
+class Detector(abc.ABC):
+    """
+        Detector
+        Runs a trained YOLO model, in any of the exported formats, on CPU. The subclasses only
+        implement forward(); the preprocessing (letterbox) and the postprocessing (NMS) are
+        shared, so every format is timed on the same work.
+
+        Usage:
+            detector = load_detector('best.onnx', imgsz=1000, threads=4)
+            detections = detector([cv2.imread(path)])
+    """
+    format = None
+
+    def __init__(self, path, imgsz=1000, threads=None):
+        self.path = path
+        self.imgsz = model_imgsz(imgsz)
+        self.threads = threads
+        self.names = None
+        self.channels = 3
+
+    @abc.abstractmethod
+    def forward(self, batch):
+        """
+            Run the model on a preprocessed (N, C, H, W) float32 batch.
+            Returns:
+                - predictions: (N, 4 + classes, anchors) float32 array.
+        """
+
+    def read_image(self, path):
+        """
+            Read an image the way the model was trained on it, see read_image.
+        """
+        return read_image(path, self.channels)
+
+    def __call__(self, images, conf=0.25, iou=0.7, max_det=300):
+        """
+            Detect objects in a batch of images.
+            Parameters:
+                - images: List of (H, W, C) uint8 images (read_image).
+                - conf, iou, max_det: See postprocess.
+            Returns:
+                - detections: List of (n, 6) arrays with x1, y1, x2, y2, confidence, class.
+        """
+        batch, transforms = preprocess(images, self.imgsz)
+        predictions = self.forward(batch)
+        return postprocess(predictions, transforms, [image.shape[:2] for image in images], conf, iou, max_det)
+
+class TorchDetector(Detector):
+    """
+        PyTorch baseline: the .pt checkpoint, run by torch on CPU.
+    """
+    format = 'pytorch'
+
+    def __init__(self, path, imgsz=1000, threads=None):
+        super().__init__(path, imgsz, threads)
+        import torch
+        from ultralytics import YOLO
+
+        set_cpu_threads(threads)
+        yolo = YOLO(path)
+        self.names = yolo.names
+        self.model = yolo.model.float().eval()
+        self.channels = self.model.yaml.get('channels', 3) if hasattr(self.model, 'yaml') else 3
+        self._torch = torch
+
+    def forward(self, batch):
+        with self._torch.inference_mode():
+            out = self.model(self._torch.from_numpy(batch))
+        return (out[0] if isinstance(out, (list, tuple)) else out).numpy()
+
+class TorchScriptDetector(Detector):
+    format = 'torchscript'
+
+    def __init__(self, path, imgsz=1000, threads=None):
+        super().__init__(path, imgsz, threads)
+        import torch
+
+        set_cpu_threads(threads)
+        extra_files = {'config.txt': ''}
+        self.model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files).eval()
+        if extra_files['config.txt']:
+            metadata = json.loads(extra_files['config.txt'])
+            self.names = {int(k): v for k, v in metadata.get('names', {}).items()}
+            self.channels = metadata.get('channels', 3)
+        self._torch = torch
+
+    def forward(self, batch):
+        with self._torch.inference_mode():
+            out = self.model(self._torch.from_numpy(batch))
+        return (out[0] if isinstance(out, (list, tuple)) else out).numpy()
+
+class OnnxDetector(Detector):
+    format = 'onnx'
+
+    def __init__(self, path, imgsz=1000, threads=None):
+        super().__init__(path, imgsz, threads)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if 'names' in metadata:
+            self.names = ast.literal_eval(metadata['names'])
+        self.channels = int(metadata.get('channels', 3))
+        size = self.session.get_inputs()[0].shape[2]
+        if isinstance(size, int):
+            # exported with a fixed input size
+            self.imgsz = size
+
+    def forward(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+class OpenVinoDetector(Detector):
+    format = 'openvino'
+
+    def __init__(self, path, imgsz=1000, threads=None):
+        super().__init__(path, imgsz, threads)
+        import openvino as ov
+        import yaml
+
+        core = ov.Core()
+        xml = glob.glob(os.path.join(path, '*.xml'))[0] if os.path.isdir(path) else path
+        config = {'INFERENCE_NUM_THREADS': threads} if threads is not None else {}
+        self.model = core.compile_model(core.read_model(xml), 'CPU', config)
+        metadata_path = os.path.join(os.path.dirname(xml), 'metadata.yaml')
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = yaml.safe_load(f)
+            self.names = metadata.get('names')
+            self.channels = metadata.get('channels', 3)
+
+    def forward(self, batch):
+        return self.model(batch)[self.model.output(0)]
+
+def load_detector(path, imgsz=1000, threads=None):
+    """
+        Load a trained model for CPU inference, picking the backend from the file name.
+        Parameters:
+            - path: best.pt, best.torchscript, best.onnx or the best_openvino_model folder.
+            - imgsz: Inference size (rounded up to a multiple of 32).
+            - threads: CPU threads of the backend (default: the library default).
+        Returns:
+            - detector: A Detector.
+    """
+    if path.endswith('.pt'):
+        return TorchDetector(path, imgsz, threads)
+    if path.endswith('.torchscript'):
+        return TorchScriptDetector(path, imgsz, threads)
+    if path.endswith('.onnx'):
+        return OnnxDetector(path, imgsz, threads)
+    if path.rstrip('/').endswith('_openvino_model') or path.endswith('.xml'):
+        return OpenVinoDetector(path, imgsz, threads)
+    raise ValueError(f"Unknown model format: {path}")
+
+def export_model(weights, formats=('onnx',), imgsz=1000):
+    """
+        Export a trained best.pt for CPU inference.
+        Parameters:
+            - weights: Path to the .pt checkpoint.
+            - formats: Some of FORMATS.
+            - imgsz: Inference size (rounded up to a multiple of 32).
+        Returns:
+            - paths: Dictionary format -> exported file or folder, next to the weights.
+    """
+    from ultralytics import YOLO
+
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown formats {sorted(unknown)}, expected some of {FORMATS}")
+
+    paths = {}
+    for model_format in formats:
+        # ONNX and OpenVINO with a dynamic batch, so tiles can be batched
+        dynamic = model_format in ('onnx', 'openvino')
+        paths[model_format] = str(YOLO(weights).export(format=model_format, imgsz=model_imgsz(imgsz), device='cpu',
+                                                       dynamic=dynamic, half=False))
+    return paths
+
+def list_images(source):
+    """
+        Return the image paths of a file or directory, sorted.
+    """
+    if os.path.isfile(source):
+        return [source]
+    paths = set()
+    for pattern in IMAGE_PATTERNS:
+        paths.update(glob.glob(os.path.join(source, pattern)))
+    return sorted(paths)
+
+def benchmark(detector, imgPaths, runs=50, warmup=3, batch=1):
+    """
+        Time end-to-end detection (preprocessing, model and NMS) on decoded images.
+        Parameters:
+            - detector: A Detector.
+            - imgPaths: Images to cycle through.
+            - runs: Number of timed batches.
+            - warmup: Untimed batches run first.
+            - batch: Images per batch.
+        Returns:
+            - stats: Dictionary with the format, images/s and the p50/p95 latency per batch in ms.
+    """
+    images = [detector.read_image(path) for path in imgPaths[:max(batch, min(len(imgPaths), 16))]]
+    batches = [[images[(i * batch + j) % len(images)] for j in range(batch)] for i in range(warmup + runs)]
+    for images_batch in batches[:warmup]:
+        detector(images_batch)
+
+    latencies = []
+    for images_batch in batches[warmup:]:
+        start = time.perf_counter()
+        detector(images_batch)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    return {
+        'format': detector.format,
+        'threads': detector.threads,
+        'batch': batch,
+        'imgsz': detector.imgsz,
+        'images_per_s': batch * runs / (latencies.sum() / 1000),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+    }
+
+def detect(detector, imgPaths, batch=1, conf=0.25, iou=0.7):
+    """
+        Run detection over many images.
+        Returns:
+            - records: Generator of dictionaries with the image path, its detections
+              (x1, y1, x2, y2, confidence, class id and class name) and the error message if
+              the image could not be read, in input order.
+    """
+    for start in range(0, len(imgPaths), batch):
+        records, images = [], []
+        for path in imgPaths[start:start + batch]:
+            record = {'path': path, 'detections': [], 'error': None}
+            try:
+                images.append(detector.read_image(path))
+            except ValueError as e:
+                record['error'] = str(e)
+            records.append(record)
+
+        results = iter(detector(images, conf=conf, iou=iou) if images else [])
+        for record in records:
+            if record['error'] is None:
+                record['detections'] = [
+                    {'box': [round(float(v), 1) for v in d[:4]], 'confidence': round(float(d[4]), 4), 'class': int(d[5]),
+                     'name': detector.names.get(int(d[5])) if detector.names else None}
+                    for d in next(results)]
+            yield record
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU inference: export, detect and benchmark")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export best.pt to CPU formats')
+    export_parser.add_argument('--weights', type=str, required=True)
+    export_parser.add_argument('--formats', type=str, nargs='+', default=['onnx'], choices=FORMATS)
+    export_parser.add_argument('--imgsz', type=int, default=1000)
+
+    detect_parser = subparsers.add_parser('detect', help='Detect objects in preprocessed images')
+    detect_parser.add_argument('--model', type=str, required=True, help='.pt, .onnx, .torchscript or _openvino_model')
+    detect_parser.add_argument('--source', type=str, required=True, help='Image or directory')
+    detect_parser.add_argument('--output', type=str, default='detections.jsonl')
+    detect_parser.add_argument('--conf', type=float, default=0.25)
+    detect_parser.add_argument('--iou', type=float, default=0.7)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Compare the exported formats with PyTorch')
+    benchmark_parser.add_argument('--weights', type=str, required=True)
+    benchmark_parser.add_argument('--formats', type=str, nargs='+', default=['onnx'], choices=FORMATS)
+    benchmark_parser.add_argument('--source', type=str, required=True, help='Image or directory')
+    benchmark_parser.add_argument('--runs', type=int, default=50)
+    benchmark_parser.add_argument('--output', type=str, default=None, help='JSON report')
+
+    for sub in (detect_parser, benchmark_parser):
+        sub.add_argument('--imgsz', type=int, default=1000)
+        sub.add_argument('--threads', type=int, default=None, help='CPU threads (default: library default)')
+        sub.add_argument('--batch', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        for model_format, path in export_model(args.weights, args.formats, args.imgsz).items():
+            print(f"{model_format}: {path}")
+        return
+
+    imgPaths = list_images(args.source)
+    if not imgPaths:
+        parser.error(f"no images in {args.source}")
+
+    if args.command == 'detect':
+        detector = load_detector(args.model, args.imgsz, args.threads)
+        start = time.perf_counter()
+        errors = 0
+        with open(args.output, 'w') as f:
+            for record in detect(detector, imgPaths, args.batch, args.conf, args.iou):
+                f.write(json.dumps(record) + '\n')
+                if record['error'] is not None:
+                    errors += 1
+                    print(record['error'])
+        elapsed = time.perf_counter() - start
+        print(f"{len(imgPaths)} images ({errors} unreadable) in {elapsed:.1f} s "
+              f"({len(imgPaths) / elapsed:.1f} img/s) -> {args.output}")
+        return
+
+    paths = {'pytorch': args.weights}
+    paths.update(export_model(args.weights, args.formats, args.imgsz))
+    results = []
+    print(f"{'format':<12} {'img/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for model_format, path in paths.items():
+        stats = benchmark(load_detector(path, args.imgsz, args.threads), imgPaths, args.runs, batch=args.batch)
+        results.append(stats)
+        print(f"{model_format:<12} {stats['images_per_s']:8.2f} {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == "__main__":
+    main()
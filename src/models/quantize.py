@@ -0,0 +1,226 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import resource
+
+from inference import OnnxDetector, benchmark, export_model, list_images, model_imgsz, preprocess, read_image
+
+DEFAULT_CALIBRATION_IMAGES = 200
+
+class CalibrationReader:
+    """
+        ONNX Runtime calibration data reader over a sample of preprocessed images, fed one
+        letterboxed image at a time like at inference.
+    """
+
+    def __init__(self, imgPaths, input_name, imgsz, channels=3):
+        self.imgPaths = list(imgPaths)
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.channels = channels
+        self._next = 0
+
+    def get_next(self):
+        if self._next >= len(self.imgPaths):
+            return None
+        path = self.imgPaths[self._next]
+        self._next += 1
+        batch, _ = preprocess([read_image(path, self.channels)], self.imgsz)
+        return {self.input_name: batch}
+
+    def rewind(self):
+        self._next = 0
+
+def calibration_sample(source, size=DEFAULT_CALIBRATION_IMAGES, seed=0):
+    """
+        Draw the calibration images.
+        Parameters:
+            - source: Directory of preprocessed images (e.g. the train split of the dataset).
+            - size: Number of images.
+            - seed: Seed of the draw, so a quantized model can be rebuilt identically.
+        Returns:
+            - imgPaths: Sorted list of image paths.
+    """
+    imgPaths = list_images(source)
+    if not imgPaths:
+        raise FileNotFoundError(f"No images found in {source}")
+    return sorted(random.Random(seed).sample(imgPaths, min(size, len(imgPaths))))
+
+def head_nodes(model_path):
+    """
+        Return the nodes of the detection head (the last /model.N/ block): the box decoding
+        and class scores are sensitive to INT8 and cheap, so they stay in float.
+    """
+    import onnx
+
+    names = [node.name for node in onnx.load(model_path).graph.node]
+    blocks = [int(m.group(1)) for m in (re.match(r'/model\.(\d+)/', name) for name in names) if m]
+    if not blocks:
+        return []
+    prefix = f"/model.{max(blocks)}/"
+    return [name for name in names if name.startswith(prefix)]
+
+def quantize_model(onnx_path, calibration_paths, output_path=None, imgsz=1000, per_channel=True,
+                   exclude_head=True, method='minmax'):
+    """
+        Static INT8 quantization of an exported ONNX model.
+        Parameters:
+            - onnx_path: FP32 model (inference.export_model).
+            - calibration_paths: Calibration images (calibration_sample).
+            - output_path: INT8 model path (default: <name>_int8.onnx next to the FP32 model).
+            - imgsz: Calibration input size.
+            - per_channel: Quantize the weights per output channel.
+            - exclude_head: Keep the detection head in float (head_nodes).
+            - method: Activation range calibration, 'minmax', 'entropy' or 'percentile'.
+        Returns:
+            - output_path: Path to the INT8 model.
+    """
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    output_path = output_path or f"{os.path.splitext(onnx_path)[0]}_int8.onnx"
+    prepared_path = f"{os.path.splitext(onnx_path)[0]}_prepared.onnx"
+    quant_pre_process(onnx_path, prepared_path)
+
+    session = onnxruntime.InferenceSession(prepared_path, providers=['CPUExecutionProvider'])
+    channels = int(session.get_modelmeta().custom_metadata_map.get('channels', 3))
+    reader = CalibrationReader(calibration_paths, session.get_inputs()[0].name, model_imgsz(imgsz), channels)
+    del session
+
+    methods = {'minmax': CalibrationMethod.MinMax, 'entropy': CalibrationMethod.Entropy,
+               'percentile': CalibrationMethod.Percentile}
+    quantize_static(
+        prepared_path, output_path, reader,
+        quant_format=QuantFormat.QDQ,
+        per_channel=per_channel,
+        weight_type=QuantType.QInt8,
+        activation_type=QuantType.QUInt8,
+        calibrate_method=methods[method],
+        nodes_to_exclude=head_nodes(prepared_path) if exclude_head else [],
+    )
+    os.remove(prepared_path)
+    return output_path
+
+def _evaluate(model_path, data, imgsz, threads, benchmark_paths, runs, results):
+    """
+        Evaluate one model in a fresh process, so its peak memory is its own: per-class AP on
+        the test split (ultralytics val) and CPU latency (inference.benchmark).
+    """
+    from ultralytics import YOLO
+
+    metrics = YOLO(model_path, task='detect').val(data=data, split='test', imgsz=model_imgsz(imgsz), batch=1,
+                                                  device='cpu', plots=False, verbose=False)
+    per_class = {}
+    for i, class_index in enumerate(metrics.box.ap_class_index):
+        per_class[metrics.names[int(class_index)]] = {'ap50': float(metrics.box.ap50[i]),
+                                                      'ap50_95': float(metrics.box.ap[i])}
+
+    stats = benchmark(OnnxDetector(model_path, imgsz, threads), benchmark_paths, runs)
+    stats.update({
+        'model': model_path,
+        'size_mb': os.path.getsize(model_path) / 2**20,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'map50': float(metrics.box.map50),
+        'map50_95': float(metrics.box.map),
+        'per_class': per_class,
+    })
+    results.put(stats)
+
+def evaluate(model_path, data, imgsz=1000, threads=None, benchmark_paths=(), runs=50):
+    """
+        Run _evaluate in a spawned process and return its statistics.
+        Raises a RuntimeError if the process dies without returning them (an error in the
+        evaluation, or killed when out of memory).
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_evaluate, args=(model_path, data, imgsz, threads, list(benchmark_paths), runs, results))
+    process.start()
+    stats = None
+    while stats is None:
+        try:
+            stats = results.get(timeout=10)
+        except queue.Empty:
+            if not process.is_alive():
+                # statistics put just before exiting may still be in the pipe
+                try:
+                    stats = results.get(timeout=1)
+                except queue.Empty:
+                    process.join()
+                    raise RuntimeError(f"Evaluation of {model_path} exited with code {process.exitcode}")
+    process.join()
+    return stats
+
+def compare(fp32, int8):
+    """
+        Build the per-species comparison of an FP32 model and its INT8 version.
+        Returns:
+            - rows: List of dictionaries with the species, the AP of both models and the change.
+    """
+    rows = []
+    for name in sorted(set(fp32['per_class']) | set(int8['per_class'])):
+        before = fp32['per_class'].get(name, {'ap50': 0.0, 'ap50_95': 0.0})
+        after = int8['per_class'].get(name, {'ap50': 0.0, 'ap50_95': 0.0})
+        rows.append({'species': name, 'fp32_ap50': before['ap50'], 'int8_ap50': after['ap50'],
+                     'delta_ap50': after['ap50'] - before['ap50'],
+                     'fp32_ap50_95': before['ap50_95'], 'int8_ap50_95': after['ap50_95'],
+                     'delta_ap50_95': after['ap50_95'] - before['ap50_95']})
+    return rows
+
+def print_report(name, fp32, int8, rows):
+    print(f"\n{name}")
+    print(f"{'species':<28} {'AP50 fp32':>9} {'int8':>7} {'delta':>7}   {'AP50-95 fp32':>12} {'int8':>7} {'delta':>7}")
+    for row in rows:
+        print(f"{row['species']:<28} {row['fp32_ap50']:9.3f} {row['int8_ap50']:7.3f} {row['delta_ap50']:+7.3f}   "
+              f"{row['fp32_ap50_95']:12.3f} {row['int8_ap50_95']:7.3f} {row['delta_ap50_95']:+7.3f}")
+    for label, stats in (('fp32', fp32), ('int8', int8)):
+        print(f"{label}: mAP50 {stats['map50']:.3f}  mAP50-95 {stats['map50_95']:.3f}  "
+              f"{stats['images_per_s']:.2f} img/s  p50 {stats['p50_ms']:.0f} ms  p95 {stats['p95_ms']:.0f} ms  "
+              f"size {stats['size_mb']:.1f} MB  peak RSS {stats['peak_rss_mb']:.0f} MB")
+    print(f"int8 speedup {int8['images_per_s'] / fp32['images_per_s']:.2f}x, "
+          f"size {int8['size_mb'] / fp32['size_mb']:.2f}x, peak RSS {int8['peak_rss_mb'] / fp32['peak_rss_mb']:.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization with an accuracy/latency report")
+    parser.add_argument('--weights', type=str, nargs='+', required=True, help='best.pt of each model to compare')
+    parser.add_argument('--data', type=str, required=True, help='data.yaml with the labelled test split')
+    parser.add_argument('--calibration', type=str, required=True, help='Directory of preprocessed images to calibrate on')
+    parser.add_argument('--calibration-size', type=int, default=DEFAULT_CALIBRATION_IMAGES)
+    parser.add_argument('--method', type=str, default='minmax', choices=('minmax', 'entropy', 'percentile'))
+    parser.add_argument('--quantize-head', action='store_true', help='Also quantize the detection head')
+    parser.add_argument('--imgsz', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for the latency measurement')
+    parser.add_argument('--runs', type=int, default=50, help='Timed images per model')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='quantization_report.json')
+    args = parser.parse_args()
+
+    calibration_paths = calibration_sample(args.calibration, args.calibration_size, args.seed)
+    report = []
+    for weights in args.weights:
+        onnx_path = export_model(weights, ('onnx',), args.imgsz)['onnx']
+        int8_path = quantize_model(onnx_path, calibration_paths, imgsz=args.imgsz,
+                                   exclude_head=not args.quantize_head, method=args.method)
+        try:
+            fp32 = evaluate(onnx_path, args.data, args.imgsz, args.threads, calibration_paths, args.runs)
+            int8 = evaluate(int8_path, args.data, args.imgsz, args.threads, calibration_paths, args.runs)
+        except RuntimeError as e:
+            # a model that cannot be evaluated must not stop the other ones
+            print(f"\n{weights}: {e}")
+            report.append({'weights': weights, 'error': str(e)})
+            continue
+        rows = compare(fp32, int8)
+        print_report(weights, fp32, int8, rows)
+        report.append({'weights': weights, 'fp32': fp32, 'int8': int8, 'species': rows})
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"\nReport: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import json
+
+# one entry per architecture, replacing the copies of train.py and eval.py in each folder
+# - weights: pretrained checkpoint in <project root>/models
+# - version: value of the MLflow model_version tag
+# - eval_version: model_version tag of the test evaluations, when it differs from version
+# - runs: folder in <project root>/runs
+# - phase: default project_phase tag and runs/<runs>/<phase> folder
+# - early_stopping: whether --patience is passed to ultralytics
+# - eval_batch: batch size of the test evaluation
+REGISTRY = {
+    'yolo5n': {'weights': 'yolov5n.pt', 'version': 'yolov5n', 'eval_version': 'yolo5n', 'runs': 'yolov5n',
+              'phase': 'no_augmentation', 'early_stopping': True, 'eval_batch': 8},
+    'yolo5s': {'weights': 'yolov5su.pt', 'version': 'yolov5s', 'runs': 'yolov5s', 'phase': 'no_augmentation',
+              'early_stopping': True, 'eval_batch': 8},
+    'yolov8n': {'weights': 'yolov8n.pt', 'version': 'yolov8n', 'runs': 'yolov8n', 'phase': 'augmented',
+               'early_stopping': True, 'eval_batch': 8},
+    'yolov8s': {'weights': 'yolov8s.pt', 'version': 'yolov8s', 'runs': 'yolov8s', 'phase': 'augmented',
+               'early_stopping': True, 'eval_batch': 8},
+    'yolo11n': {'weights': 'yolo11n.pt', 'version': 'yolov11n', 'runs': 'yolo11n', 'phase': 'no_augmentation',
+               'early_stopping': False, 'eval_batch': 16},
+    'yolo11s': {'weights': 'yolo11s.pt', 'version': 'yolov11s', 'runs': 'yolo11s', 'phase': 'no_augmentation',
+               'early_stopping': True, 'eval_batch': 8},
+}
+
+def load_registry(path=None):
+    """
+        Return the model registry, optionally extended or overridden by a JSON file.
+        Parameters:
+            - path: JSON file mapping model names to entries; the fields of an existing model
+              that the file sets replace the defaults, new models need every field.
+        Returns:
+            - registry: Dictionary model name -> entry.
+    """
+    registry = {name: dict(entry) for name, entry in REGISTRY.items()}
+    if path is None:
+        return registry
+
+    with open(path) as f:
+        for name, entry in json.load(f).items():
+            registry.setdefault(name, {}).update(entry)
+
+    required = set(REGISTRY['yolo11n'])
+    for name, entry in registry.items():
+        missing = required - set(entry)
+        if missing:
+            raise ValueError(f"Model {name} in {path} is missing {sorted(missing)}")
+    return registry
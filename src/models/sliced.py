@@ -0,0 +1,382 @@
+import argparse
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from inference import load_detector, nms
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../preprocessing"))
+from tiled import open_image
+
+# tiles of the size of the training crops (crop_center(1500)), so objects keep their scale
+DEFAULT_TILE_SIZE = 1500
+DEFAULT_OVERLAP = 0.2
+# boxes closer than this to an inner tile edge are cut by it
+DEFAULT_EDGE_MARGIN = 4
+# overlap along a seam, as a fraction of the shorter box, of two fragments of one object
+SEAM_OVERLAP = 0.5
+
+def slice_windows(shape, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    """
+        Cover an image with overlapping square tiles.
+        Parameters:
+            - shape: (rows, cols) of the image.
+            - tile_size: Side of the tiles; images smaller than that give one smaller tile.
+            - overlap: Fraction of the tile shared with the next one.
+        Returns:
+            - windows: List of (x, y, w, h); the last row and column are aligned to the image edge.
+    """
+    rows, cols = shape[:2]
+    step = max(int(tile_size * (1 - overlap)), 1)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        return positions + [length - tile_size]
+
+    return [(x, y, min(tile_size, cols), min(tile_size, rows)) for y in starts(rows) for x in starts(cols)]
+
+def open_scene(path):
+    """
+        Open a frame or an orthomosaic for windowed reads.
+        Uncompressed TIFFs and .npy files are memory-mapped (tiled.open_image); compressed or
+        tiled GeoTIFFs are read window by window through tifffile's zarr store; other formats
+        are decoded whole.
+        Returns:
+            - scene: Array-like of shape (rows, cols[, channels]) in RGB order.
+    """
+    lower = path.lower()
+    if lower.endswith('.npy'):
+        return open_image(path)
+    if lower.endswith(('.tif', '.tiff')):
+        try:
+            return open_image(path)
+        except ValueError:
+            import tifffile
+            import zarr
+
+            return zarr.open(tifffile.imread(path, aszarr=True), mode='r')
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 and image.shape[2] == 3 else image
+
+def geo_transform(path):
+    """
+        Read the pixel to map transform of a GeoTIFF.
+        Returns:
+            - transform: (x0, pixel width, y0, pixel height) with map = (x0 + col * width,
+              y0 + row * height), or None if the file has no georeferencing.
+    """
+    if not path.lower().endswith(('.tif', '.tiff')):
+        return None
+    import tifffile
+
+    with tifffile.TiffFile(path) as tif:
+        tags = tif.pages[0].tags
+        if 'ModelTransformationTag' in tags:
+            m = tags['ModelTransformationTag'].value
+            return (m[3], m[0], m[7], m[5])
+        if 'ModelPixelScaleTag' in tags and 'ModelTiepointTag' in tags:
+            sx, sy = tags['ModelPixelScaleTag'].value[:2]
+            i, j, _, x, y = tags['ModelTiepointTag'].value[:5]
+            return (x - i * sx, sx, y + j * sy, -sy)
+    return None
+
+def read_tile(scene, window, channels=3):
+    """
+        Read one tile of a scene as a uint8 image with the channels the model expects.
+    """
+    x, y, w, h = window
+    tile = np.asarray(scene[y:y + h, x:x + w])
+    if tile.dtype != np.uint8:
+        raise ValueError(f"Sliced inference expects 8-bit images like the training data, got {tile.dtype}")
+    if tile.ndim == 2:
+        tile = np.repeat(tile[..., None], channels, axis=2)
+    return np.ascontiguousarray(tile[..., :channels])
+
+def _inner_edges(boxes, window, shape, margin):
+    """
+        Return which edges of their tile shared with another tile the boxes touch.
+        Parameters:
+            - boxes: (n, 4+) array in tile coordinates.
+        Returns:
+            - edges: (n, 4) bool array: left, top, right and bottom edge.
+    """
+    x, y, w, h = window
+    rows, cols = shape[:2]
+    edges = np.zeros((len(boxes), 4), dtype=bool)
+    if x > 0:
+        edges[:, 0] = boxes[:, 0] <= margin
+    if y > 0:
+        edges[:, 1] = boxes[:, 1] <= margin
+    if x + w < cols:
+        edges[:, 2] = boxes[:, 2] >= w - margin
+    if y + h < rows:
+        edges[:, 3] = boxes[:, 3] >= h - margin
+    return edges
+
+def _inner_edge_mask(boxes, window, shape, margin):
+    """
+        Return the boxes that do not touch an edge of their tile shared with another tile.
+        Parameters:
+            - boxes: (n, 4+) array in tile coordinates.
+    """
+    return ~_inner_edges(boxes, window, shape, margin).any(axis=1)
+
+def _seen_whole_elsewhere(boxes, window, windows, shape, margin):
+    """
+        Return the boxes, in scene coordinates, that another tile holds away from its inner
+        edges, so that tile sees the whole object. A box cut by its own tile can only be
+        dropped then: an object wider than the overlap is cut by every tile it is in, and
+        the cut boxes are all there is to detect it.
+    """
+    whole = np.zeros(len(boxes), dtype=bool)
+    for other in windows:
+        if other == window:
+            continue
+        x, y, w, h = other
+        local = boxes[:, :4] - np.array([x, y, x, y], dtype=boxes.dtype)
+        inside = (local[:, 0] >= 0) & (local[:, 1] >= 0) & (local[:, 2] <= w) & (local[:, 3] <= h)
+        whole |= inside & _inner_edge_mask(local, other, shape, margin)
+    return whole
+
+def _extent_overlap(start, end, starts, ends):
+    """
+        Return the overlap of the interval [start, end] with each of [starts, ends], as a
+        fraction of the shorter of the two.
+    """
+    inter = np.clip(np.minimum(end, ends) - np.maximum(start, starts), 0, None)
+    return inter / np.maximum(np.minimum(end - start, ends - starts), 1e-9)
+
+def stitch_seams(detections, edges, origins, windows, min_overlap=SEAM_OVERLAP):
+    """
+        Replace the fragments of an object cut by tile seams with their union box.
+        Two boxes of the same class are fragments of one object when they come from
+        overlapping tiles, touch the seam between them from both sides (the right edge of the
+        left tile and the left edge of the right tile, or the bottom and top edges), and
+        overlap along the seam. An object across several seams (a corner, or wider than a
+        tile) is stitched from all its fragments.
+        Parameters:
+            - detections: (n, 6) array with x1, y1, x2, y2, confidence, class, in scene pixels.
+            - edges: (n, 4) bool array of the inner tile edges each box touches (_inner_edges).
+            - origins: (n,) index of the window of each box in windows.
+            - windows: Tile windows (slice_windows).
+            - min_overlap: Overlap along the seam, as a fraction of the shorter box, above
+              which two fragments are stitched.
+        Returns:
+            - detections: (m, 6) array; a stitched box keeps the highest confidence.
+    """
+    cut = np.flatnonzero(edges.any(axis=1))
+    if len(cut) < 2:
+        return detections
+
+    tiles = np.array(windows, dtype=np.float64)[origins]
+    parent = np.arange(len(detections))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    boxes, tiles_cut, edges_cut = detections[cut], tiles[cut], edges[cut]
+    same_class = boxes[:, 5][:, None] == boxes[:, 5][None, :]
+    # axis 0: a vertical seam (right edge, then left edge), axis 1: a horizontal one
+    for axis in (0, 1):
+        other = 1 - axis
+        start, size = tiles_cut[:, axis], tiles_cut[:, axis + 2]
+        after = (start[None, :] > start[:, None]) & (start[None, :] < (start + size)[:, None])
+        pairs = same_class & after & edges_cut[:, axis + 2][:, None] & edges_cut[:, axis][None, :]
+        for a, b in zip(*np.nonzero(pairs)):
+            if _extent_overlap(boxes[a, other], boxes[a, other + 2], boxes[b, other], boxes[b, other + 2]) > min_overlap:
+                parent[find(cut[a])] = find(cut[b])
+
+    roots = np.array([find(i) for i in range(len(detections))])
+    if len(np.unique(roots)) == len(detections):
+        return detections
+    stitched = []
+    for root in np.unique(roots):
+        members = detections[roots == root]
+        stitched.append((members[:, 0].min(), members[:, 1].min(), members[:, 2].max(), members[:, 3].max(),
+                         members[:, 4].max(), members[0, 5]))
+    return np.array(stitched, dtype=detections.dtype).reshape(-1, 6)
+
+def _iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(area + areas - inter, 1e-9)
+
+def weighted_boxes_fusion(detections, iou=0.55):
+    """
+        Class-aware weighted boxes fusion: overlapping boxes of the same class, seen by
+        several tiles, are averaged weighted by their confidence instead of keeping only one.
+        Parameters:
+            - detections: (n, 6) array with x1, y1, x2, y2, confidence, class.
+            - iou: IoU above which a box joins a cluster.
+        Returns:
+            - fused: (m, 6) array; the confidence is the mean of the cluster.
+    """
+    fused = []
+    for cls in np.unique(detections[:, 5]):
+        boxes = detections[detections[:, 5] == cls]
+        boxes = boxes[np.argsort(-boxes[:, 4], kind='stable')]
+        clusters = []
+        merged = np.zeros((0, 4), dtype=np.float32)
+        for box in boxes:
+            overlaps = _iou(box, merged) if len(merged) else np.zeros(0)
+            best = int(overlaps.argmax()) if len(overlaps) else -1
+            if best >= 0 and overlaps[best] > iou:
+                clusters[best].append(box)
+                members = np.array(clusters[best])
+                merged[best] = (members[:, :4] * members[:, 4:5]).sum(axis=0) / members[:, 4].sum()
+            else:
+                clusters.append([box])
+                merged = np.vstack((merged, box[None, :4]))
+        for box, members in zip(merged, clusters):
+            fused.append(np.concatenate((box, [np.mean([m[4] for m in members]), cls])))
+    return np.array(fused, dtype=np.float32).reshape(-1, 6)
+
+def merge_detections(detections, method='nms', iou=0.5):
+    """
+        Merge the detections of overlapping tiles, in scene coordinates.
+        Parameters:
+            - detections: (n, 6) array with x1, y1, x2, y2, confidence, class.
+            - method: 'nms' (class-aware NMS) or 'wbf' (weighted boxes fusion).
+            - iou: IoU threshold.
+        Returns:
+            - merged: (m, 6) array, by decreasing confidence.
+    """
+    if len(detections) == 0:
+        return detections
+    if method == 'wbf':
+        merged = weighted_boxes_fusion(detections, iou)
+    elif method == 'nms':
+        merged = detections[nms(detections[:, :4], detections[:, 4], detections[:, 5], iou)]
+    else:
+        raise ValueError(f"Unknown merge method {method}, expected 'nms' or 'wbf'")
+    return merged[np.argsort(-merged[:, 4], kind='stable')]
+
+def sliced_detect(detector, scene, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, batch=4, conf=0.25,
+                  iou=0.7, merge='nms', merge_iou=0.5, edge_margin=DEFAULT_EDGE_MARGIN):
+    """
+        Detect objects in a scene larger than the model input, tile by tile.
+        Tiles are read lazily and sent to the model batch tiles at a time; the detections are
+        moved to scene coordinates, the ones cut by an inner tile edge dropped when another
+        tile sees the object whole, the fragments of objects wider than the overlap stitched
+        across the seams (stitch_seams), and the rest merged across tiles.
+        Parameters:
+            - detector: inference.Detector (a dynamic-batch ONNX/OpenVINO export batches best).
+            - scene: Array-like image (open_scene).
+            - tile_size, overlap: See slice_windows.
+            - batch: Tiles per model call.
+            - conf, iou: Confidence and per-tile NMS thresholds.
+            - merge, merge_iou: Cross-tile merge method and threshold (merge_detections).
+            - edge_margin: Margin of the inner tile edges, in pixels.
+        Returns:
+            - detections: (n, 6) array with x1, y1, x2, y2, confidence, class, in scene pixels.
+            - stats: Dictionary with the number of tiles and the tiles per second.
+    """
+    windows = slice_windows(scene.shape, tile_size, overlap)
+    found, found_edges, found_origins = [], [], []
+    start = time.perf_counter()
+    iterator = enumerate(windows)
+    while True:
+        chunk = list(islice(iterator, batch))
+        if not chunk:
+            break
+        tiles = [read_tile(scene, window, detector.channels) for _, window in chunk]
+        for (i, window), detections in zip(chunk, detector(tiles, conf=conf, iou=iou)):
+            edges = _inner_edges(detections, window, scene.shape, edge_margin)
+            detections[:, [0, 2]] += window[0]
+            detections[:, [1, 3]] += window[1]
+            cut = edges.any(axis=1)
+            if cut.any():
+                # objects larger than the overlap are cut in every tile: keep those, they are
+                # stitched back together across the seams
+                cut[cut] = _seen_whole_elsewhere(detections[cut], window, windows, scene.shape, edge_margin)
+                detections, edges = detections[~cut], edges[~cut]
+            found.append(detections)
+            found_edges.append(edges)
+            found_origins.append(np.full(len(detections), i))
+    elapsed = time.perf_counter() - start
+
+    if found:
+        detections = stitch_seams(np.concatenate(found), np.concatenate(found_edges), np.concatenate(found_origins),
+                                  windows)
+    else:
+        detections = np.zeros((0, 6), np.float32)
+    detections = merge_detections(detections, merge, merge_iou)
+    return detections, {'tiles': len(windows), 'seconds': elapsed, 'tiles_per_s': len(windows) / max(elapsed, 1e-9)}
+
+def to_geo(detections, transform):
+    """
+        Map (n, 6) pixel detections to map coordinates with a geo_transform.
+    """
+    x0, width, y0, height = transform
+    geo = detections.astype(np.float64)
+    geo[:, [0, 2]] = x0 + geo[:, [0, 2]] * width
+    geo[:, [1, 3]] = y0 + geo[:, [1, 3]] * height
+    return geo
+
+def to_geojson(detections, transform, names=None):
+    """
+        Build a GeoJSON FeatureCollection with one polygon per detection.
+    """
+    features = []
+    for x1, y1, x2, y2, confidence, cls in to_geo(detections, transform):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]]},
+            'properties': {'confidence': round(float(confidence), 4), 'class': int(cls),
+                           'name': names.get(int(cls)) if names else None},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+def main():
+    parser = argparse.ArgumentParser(description="Sliced inference on full frames and orthomosaics")
+    parser.add_argument('--model', type=str, required=True, help='.pt, .onnx, .torchscript or _openvino_model')
+    parser.add_argument('--source', type=str, required=True, help='Corrected full frame or orthomosaic')
+    parser.add_argument('--output', type=str, default='detections.json', help='Detections in pixels (JSON)')
+    parser.add_argument('--geojson', type=str, default=None, help='Also write map coordinates (GeoTIFF input)')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    parser.add_argument('--overlap', type=float, default=DEFAULT_OVERLAP)
+    parser.add_argument('--batch', type=int, nargs='+', default=[4], help='Tiles per model call; several values compare throughput')
+    parser.add_argument('--merge', type=str, default='nms', choices=('nms', 'wbf'))
+    parser.add_argument('--merge-iou', type=float, default=0.5)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--imgsz', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    detector = load_detector(args.model, args.imgsz, args.threads)
+    scene = open_scene(args.source)
+    for batch in args.batch:
+        detections, stats = sliced_detect(detector, scene, args.tile_size, args.overlap, batch, args.conf,
+                                          merge=args.merge, merge_iou=args.merge_iou)
+        print(f"batch {batch}: {stats['tiles']} tiles in {stats['seconds']:.1f} s "
+              f"({stats['tiles_per_s']:.2f} tiles/s), {len(detections)} detections")
+
+    with open(args.output, 'w') as f:
+        json.dump({'source': args.source, 'shape': list(scene.shape), 'names': detector.names,
+                   'detections': [[round(float(v), 2) for v in d] for d in detections]}, f)
+    if args.geojson:
+        transform = geo_transform(args.source)
+        if transform is None:
+            parser.error(f"{args.source} has no georeferencing")
+        with open(args.geojson, 'w') as f:
+            json.dump(to_geojson(detections, transform, detector.names), f)
+
+if __name__ == "__main__":
+    main()
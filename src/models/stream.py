@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from inference import load_detector
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../preprocessing"))
+from batch import list_images
+from calibration_cache import CalibrationCache
+from fusion import GS_ALPHA, PRODUCTS, capture_groups, fuse
+from metadata import ExifToolSession
+from pipeline import process_capture
+from warp_registry import WarpRegistry
+
+# stages of a capture, in order; correct, align and fuse run in the worker processes
+STAGES = ('correct', 'align', 'fuse', 'wait', 'detect', 'write')
+
+# rows per Parquet row group
+PARQUET_ROW_GROUP = 1000
+
+# per-process state, created once by _init_worker
+_worker = {}
+
+def _init_worker(fast_metadata=False, fused=False, cache_dir=None, warps=None, product='fused', alpha=GS_ALPHA):
+    """
+        Set up the long-lived state of one worker: an ExifTool session, a calibration cache
+        and optionally a warp registry, shared by every capture the worker processes.
+    """
+    _worker['session'] = ExifToolSession()
+    _worker['cache'] = CalibrationCache(cache_dir=cache_dir)
+    _worker['registry'] = WarpRegistry(warps) if warps else None
+    _worker['fast_metadata'] = fast_metadata
+    _worker['fused'] = fused
+    _worker['product'] = product
+    _worker['alpha'] = alpha
+
+def _prepare_capture(group):
+    """
+        Correct and align one capture in memory (pipeline.process_capture), then fuse it.
+        Parameters:
+            - group: Dictionary band -> raw image path (fusion.capture_groups).
+        Returns:
+            - item: Dictionary with the capture (path of its JPG), the fused image, the time
+              of each stage and the error message, if any.
+    """
+    item = {'capture': group['RGB'], 'image': None, 'error': None, 'seconds': {}}
+    try:
+        bands = process_capture(group, session=_worker['session'], fast_metadata=_worker['fast_metadata'],
+                                cache=_worker['cache'], fused=_worker['fused'], registry=_worker['registry'],
+                                seconds=item['seconds'])
+
+        start = time.perf_counter()
+        # the fusion expects the RGB frame as PIL reads it from the processed JPG
+        bands['RGB'] = cv2.cvtColor(bands['RGB'], cv2.COLOR_BGR2RGB)
+        item['image'] = fuse(bands, (_worker['product'],), _worker['alpha'])[_worker['product']]
+        item['seconds']['fuse'] = time.perf_counter() - start
+    except Exception as e:
+        # a bad capture must not stop the stream
+        item['error'] = f"{type(e).__name__}: {e}"
+    return item
+
+class StageTimer:
+    """
+        Stage timer
+        Accumulates the time and the number of items of each stage of the stream. The stages
+        that run in the worker processes add up the time of every worker, so with several
+        workers their total can exceed the wall time.
+
+        Usage:
+            timer = StageTimer()
+            timer.add('detect', 0.25, items=4)
+            print(timer.report(elapsed))
+    """
+
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.items = {stage: 0 for stage in STAGES}
+
+    def add(self, stage, seconds, items=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def report(self, elapsed):
+        """
+            Return the time of each stage, its throughput and its share of the wall time.
+        """
+        return {stage: {'items': self.items[stage], 'seconds': round(self.seconds[stage], 3),
+                        'items_per_s': round(self.items[stage] / self.seconds[stage], 2) if self.seconds[stage] else None,
+                        'share': round(self.seconds[stage] / elapsed, 3) if elapsed else None}
+                for stage in self.seconds}
+
+def prepare(groups, timer, workers=None, max_pending=None, fast_metadata=False, fused=False, cache_dir=None,
+            warps=None, product='fused', alpha=GS_ALPHA):
+    """
+        Stream the captures through correction, alignment and fusion.
+        The captures run on a process pool. At most max_pending are in flight, so a slow
+        consumer (the detector) holds the pool back instead of letting fused images pile up
+        in memory, and the items are yielded in the order of groups.
+        Parameters:
+            - groups: Iterable of capture groups (fusion.capture_groups).
+            - timer: StageTimer receiving the time of the stages; 'wait' is the time the
+              consumer spent blocked on the pool.
+            - workers: Number of worker processes (default: os.cpu_count()). With 1, the
+              captures are processed in the calling process.
+            - max_pending: Maximum number of captures submitted but not yet collected
+              (default: 2 * workers).
+            - fast_metadata, fused, cache_dir, warps, product, alpha: Passed to _init_worker.
+        Returns:
+            - items: Generator of the items returned by _prepare_capture.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    init_args = (fast_metadata, fused, cache_dir, warps, product, alpha)
+
+    def collect(item):
+        for stage, seconds in item.pop('seconds').items():
+            timer.add(stage, seconds)
+        return item
+
+    if workers == 1:
+        _init_worker(*init_args)
+        try:
+            for group in groups:
+                yield collect(_prepare_capture(group))
+        finally:
+            _worker['session'].close()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+        pending = deque()
+
+        def result():
+            start = time.perf_counter()
+            item = pending.popleft().result()
+            timer.add('wait', time.perf_counter() - start)
+            return collect(item)
+
+        for group in groups:
+            if len(pending) >= max_pending:
+                yield result()
+            pending.append(executor.submit(_prepare_capture, group))
+        while pending:
+            yield result()
+
+def detect_stream(items, detector, timer, batch=1, conf=0.25, iou=0.7):
+    """
+        Run the detector over a stream of fused images, batch images at a time.
+        Parameters:
+            - items: Iterable of items (prepare).
+            - detector: inference.Detector.
+            - timer: StageTimer.
+            - batch: Images per forward pass.
+            - conf, iou: See inference.postprocess.
+        Returns:
+            - records: Generator of dictionaries with the capture, its detections (as
+              inference.detect) and the error, in input order.
+    """
+    def flush(buffer):
+        images = [item['image'] for item in buffer if item['error'] is None]
+        detections = iter(())
+        if images:
+            start = time.perf_counter()
+            detections = iter(detector(images, conf=conf, iou=iou))
+            timer.add('detect', time.perf_counter() - start, len(images))
+        for item in buffer:
+            record = {'capture': item['capture'], 'detections': [], 'error': item['error']}
+            if item['error'] is None:
+                record['detections'] = [
+                    {'box': [round(float(v), 1) for v in d[:4]], 'confidence': round(float(d[4]), 4),
+                     'class': int(d[5]), 'name': detector.names.get(int(d[5])) if detector.names else None}
+                    for d in next(detections)]
+            yield record
+
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if sum(entry['error'] is None for entry in buffer) >= batch:
+            yield from flush(buffer)
+            buffer = []
+    if buffer:
+        yield from flush(buffer)
+
+def write_jsonl(records, path, timer):
+    """
+        Write the records as JSON lines, one capture per line, as they arrive.
+        Returns:
+            - count: Number of records written.
+    """
+    count = 0
+    with open(path, 'w') as f:
+        for record in records:
+            start = time.perf_counter()
+            f.write(json.dumps(record) + '\n')
+            timer.add('write', time.perf_counter() - start)
+            count += 1
+    return count
+
+def write_parquet(records, path, timer, row_group=PARQUET_ROW_GROUP):
+    """
+        Write the records to a Parquet file with one row per capture and the detections as
+        a list column, flushing a row group every row_group captures.
+        Returns:
+            - count: Number of records written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    detection = pa.struct([('box', pa.list_(pa.float32(), 4)), ('confidence', pa.float32()),
+                           ('class', pa.int32()), ('name', pa.string())])
+    schema = pa.schema([('capture', pa.string()), ('detections', pa.list_(detection)), ('error', pa.string())])
+
+    count = 0
+    rows = []
+    with pq.ParquetWriter(path, schema) as writer:
+        for record in records:
+            rows.append(record)
+            count += 1
+            if len(rows) >= row_group:
+                start = time.perf_counter()
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                timer.add('write', time.perf_counter() - start, len(rows))
+                rows = []
+        if rows:
+            start = time.perf_counter()
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            timer.add('write', time.perf_counter() - start, len(rows))
+    return count
+
+def run_stream(input_dir, model, output, workers=None, max_pending=None, batch=1, imgsz=1000, threads=None,
+               conf=0.25, iou=0.7, product='fused', alpha=GS_ALPHA, fast_metadata=False, fused=False,
+               cache_dir=None, warps=None):
+    """
+        Detect objects in a flight of raw captures without writing intermediate images:
+        raw files -> correction -> alignment -> fusion -> batched detection -> JSON lines or
+        Parquet. Each stage pulls from the previous one, so only max_pending captures and one
+        batch are held in memory at any time.
+        Parameters:
+            - input_dir: Directory with the raw .JPG and .TIF images.
+            - model: Trained model, in any format of inference.load_detector.
+            - output: Output file; .parquet writes Parquet, anything else JSON lines.
+            - workers, max_pending: See prepare.
+            - batch, imgsz, threads: Images per forward pass, input size and CPU threads of
+              the detector.
+            - conf, iou: See inference.postprocess.
+            - product, alpha: Image the model was trained on (fusion.PRODUCTS) and the boost
+              of the Gram-Schmidt fusion.
+            - fast_metadata, fused, cache_dir: See batch.process_many.
+            - warps: Optional WarpRegistry file to align with instead of a full ECC solve per
+              band (it is read, not updated).
+        Returns:
+            - summary: Dictionary with the number of captures, the wall time and the timer
+              report (StageTimer.report).
+    """
+    groups = capture_groups(list_images(input_dir))
+    detector = load_detector(model, imgsz, threads)
+    timer = StageTimer()
+
+    start = time.perf_counter()
+    items = prepare(groups, timer, workers, max_pending, fast_metadata, fused, cache_dir, warps, product, alpha)
+    records = detect_stream(items, detector, timer, batch, conf, iou)
+    write = write_parquet if output.endswith('.parquet') else write_jsonl
+    count = write(records, output, timer)
+    elapsed = time.perf_counter() - start
+    return {'captures': count, 'seconds': round(elapsed, 3), 'stages': timer.report(elapsed)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming detection from raw captures, without intermediate files")
+    parser.add_argument('--input', type=str, required=True, help='Directory with the raw images')
+    parser.add_argument('--model', type=str, required=True, help='.pt, .onnx, .torchscript or _openvino_model')
+    parser.add_argument('--output', type=str, default='detections.jsonl', help='.jsonl or .parquet')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=None, help='Captures in flight (default: 2 x workers)')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--imgsz', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads of the detector')
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iou', type=float, default=0.7)
+    parser.add_argument('--product', type=str, default='fused', choices=PRODUCTS)
+    parser.add_argument('--alpha', type=float, default=GS_ALPHA)
+    parser.add_argument('--fast-metadata', action='store_true', help='Read calibration in-process')
+    parser.add_argument('--fused', action='store_true', help='Use the fused single-pass correction')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to persist calibration maps')
+    parser.add_argument('--warps', type=str, default=None, help='WarpRegistry file to reuse the band warps')
+    parser.add_argument('--timings', type=str, default=None, help='JSON file for the per-stage timings')
+    args = parser.parse_args()
+
+    summary = run_stream(args.input, args.model, args.output, args.workers, args.max_pending, args.batch,
+                         args.imgsz, args.threads, args.conf, args.iou, args.product, args.alpha,
+                         args.fast_metadata, args.fused, args.cache_dir, args.warps)
+
+    print(f"{summary['captures']} captures in {summary['seconds']:.1f} s "
+          f"({summary['captures'] / max(summary['seconds'], 1e-9):.2f} captures/s) -> {args.output}")
+    print(f"{'stage':<8} {'items':>6} {'seconds':>8} {'items/s':>8} {'share':>6}")
+    for stage, stats in summary['stages'].items():
+        rate = f"{stats['items_per_s']:8.2f}" if stats['items_per_s'] else f"{'-':>8}"
+        share = f"{stats['share']:6.2f}" if stats['share'] is not None else f"{'-':>6}"
+        print(f"{stage:<8} {stats['items']:>6} {stats['seconds']:8.2f} {rate} {share}")
+    if args.timings:
+        with open(args.timings, 'w') as f:
+            json.dump(summary, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import argparse
+import glob
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import corrections
+import instrument
+from calibration_cache import DEFAULT_MAX_BYTES, CalibrationCache
+from manifest import Manifest, file_hash, is_unchanged, make_entry, stale_reason
+from metadata import ExifToolSession, get_xml_metadata
+from pipeline import process_image
+from xmp import CALIBRATION_TAGS
+
+IMAGE_PATTERNS = ('*.TIF', '*.JPG')
+
+# save the manifest every this many images, so an interrupted run keeps its progress
+MANIFEST_SAVE_EVERY = 500
+
+# per-process state, created once by _init_worker
+_worker = {}
+
+def _init_worker(fast_metadata=False, fused=False, cache_dir=None, max_cache_bytes=DEFAULT_MAX_BYTES,
+                 incremental=False, instrument_options=None):
+    """
+        Set up the long-lived state of one worker: an ExifTool session and a calibration cache,
+        shared by every image the worker processes. The ExifTool process is only started on
+        first use, and exits by itself when the worker dies and its stdin is closed.
+        instrument_options, if given, are passed to instrument.enable.
+    """
+    if instrument_options is not None:
+        instrument.enable(**instrument_options)
+    _worker['session'] = ExifToolSession()
+    _worker['cache'] = CalibrationCache(max_bytes=max_cache_bytes, cache_dir=cache_dir)
+    _worker['fast_metadata'] = fast_metadata
+    _worker['fused'] = fused
+    _worker['incremental'] = incremental
+
+def output_params(fused=False):
+    """
+        Return the processing options that change the processed images, as recorded in the
+        manifest.
+        Parameters:
+            - fused: Whether the fused single-pass correction is used.
+        Returns:
+            - params: Dictionary of options, including the precision set by
+              corrections.set_precision.
+    """
+    return {'fused': fused, 'precision': np.dtype(corrections.PRECISION).name}
+
+def output_path(imgPath, output_dir):
+    """
+        Return the path the processed version of imgPath is written to.
+        Parameters:
+            - imgPath: Path to the input image.
+            - output_dir: Output directory.
+        Returns:
+            - path: Path inside output_dir with the same file name as the input.
+    """
+    return os.path.join(output_dir, os.path.basename(imgPath))
+
+def _process_one(imgPath, output_dir, previous=None):
+    """
+        Run process_image on one image and write the result.
+        Parameters:
+            - imgPath: Path to the image file.
+            - output_dir: Output directory.
+            - previous: Manifest entry of the previous run (incremental runs only). If the source
+              hash and parameters match it, the image is skipped.
+        Returns:
+            - record: Dictionary with the input and output paths, the status ('ok', 'skipped'
+              or 'error'), the error message and the processing time. Incremental runs also
+              record the source hash and the calibration tags, and instrumented runs the
+              stage timings (instrument.image).
+    """
+    start = time.perf_counter()
+    record = {'path': imgPath, 'output': output_path(imgPath, output_dir), 'status': 'ok', 'error': None}
+    stages = None
+    try:
+        with instrument.image(imgPath) as stages:
+            if _worker['incremental']:
+                with instrument.stage('hash'):
+                    record['sha256'] = file_hash(imgPath)
+                params = output_params(_worker['fused'])
+                if previous is not None and stale_reason(imgPath, record['output'], previous, params, record['sha256']) is None:
+                    record['status'] = 'skipped'
+                    record['calibration'] = previous['calibration']
+                    record['seconds'] = time.perf_counter() - start
+                    return record
+
+            with instrument.stage('metadata'):
+                infoDict = get_xml_metadata(imgPath, session=_worker['session'], fast=_worker['fast_metadata'])
+            record['calibration'] = {tag: infoDict.get(tag) for tag in CALIBRATION_TAGS}
+            new_img = process_image(
+                imgPath,
+                cache=_worker['cache'],
+                fused=_worker['fused'],
+                infoDict=infoDict,
+            )
+            with instrument.stage('encode'):
+                if not cv2.imwrite(record['output'], new_img):
+                    raise OSError(f"could not write {record['output']}")
+    except Exception as e:
+        # a bad image must not abort the whole run
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+    record['seconds'] = time.perf_counter() - start
+    if stages is not None:
+        record['stages'] = stages
+    return record
+
+def process_many(imgPaths, output_dir, workers=None, max_pending=None, fast_metadata=False,
+                 fused=False, cache_dir=None, max_cache_bytes=DEFAULT_MAX_BYTES, incremental=False,
+                 instrument_options=None):
+    """
+        Process many images in parallel.
+        Each worker process reads the metadata, decodes, corrects and encodes its images, reusing
+        one ExifTool session and one calibration cache. At most max_pending images are in flight,
+        so memory stays flat whatever the number of images, and the records are yielded in the
+        order of imgPaths.
+        Parameters:
+            - imgPaths: Iterable of image paths.
+            - output_dir: Output directory, created if needed.
+            - workers: Number of worker processes (default: os.cpu_count()). With 1, images are
+              processed in the calling process.
+            - max_pending: Maximum number of images submitted but not yet collected
+              (default: 2 * workers).
+            - fast_metadata, fused: Passed to process_image.
+            - cache_dir, max_cache_bytes: Passed to each worker's CalibrationCache.
+            - incremental: If True, keep a manifest in output_dir and skip the images whose
+              source, parameters and pipeline version did not change since the last run.
+            - instrument_options: If given, enable the per-stage instrumentation in every
+              worker with these instrument.enable options.
+        Returns:
+            - records: Generator of the per-image records returned by _process_one.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    init_args = (fast_metadata, fused, cache_dir, max_cache_bytes, incremental, instrument_options)
+
+    if not incremental:
+        yield from _run(imgPaths, output_dir, workers, max_pending, init_args)
+        return
+
+    manifest = Manifest.load(output_dir)
+    params = output_params(fused)
+
+    def tasks():
+        for imgPath in imgPaths:
+            key = os.path.basename(imgPath)
+            entry = manifest.get(key)
+            if is_unchanged(imgPath, output_path(imgPath, output_dir), entry, params):
+                # same size and modification time: no need to hash or submit it
+                yield {'path': imgPath, 'output': entry['output'], 'status': 'skipped',
+                       'error': None, 'seconds': 0.0}
+            else:
+                yield imgPath, entry
+
+    try:
+        for i, record in enumerate(_run(tasks(), output_dir, workers, max_pending, init_args), 1):
+            if 'sha256' in record and record['status'] in ('ok', 'skipped'):
+                manifest.update(os.path.basename(record['path']), make_entry(
+                    record['path'], record['output'], params, record['sha256'], record['calibration']))
+            if i % MANIFEST_SAVE_EVERY == 0:
+                manifest.save()
+            yield record
+    finally:
+        manifest.save()
+
+def _run(tasks, output_dir, workers, max_pending, init_args):
+    """
+        Run _process_one over the tasks, in order, with at most max_pending in flight.
+        Parameters:
+            - tasks: Iterable of image paths or (image path, previous manifest entry) pairs.
+              Records (dictionaries) of images that need no work are passed through as is.
+            - output_dir: Output directory.
+            - workers: Number of worker processes.
+            - max_pending: Maximum number of images submitted but not yet collected.
+            - init_args: Arguments of _init_worker.
+        Returns:
+            - records: Generator of the per-image records.
+    """
+    def arguments(task):
+        imgPath, previous = task if isinstance(task, tuple) else (task, None)
+        return imgPath, output_dir, previous
+
+    if workers == 1:
+        _init_worker(*init_args)
+        try:
+            for task in tasks:
+                yield task if isinstance(task, dict) else _process_one(*arguments(task))
+        finally:
+            _worker['session'].close()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= max_pending:
+                yield _result(pending.popleft())
+            pending.append(task if isinstance(task, dict) else executor.submit(_process_one, *arguments(task)))
+        while pending:
+            yield _result(pending.popleft())
+
+def _result(item):
+    """
+        Return the record of a pending item: either a future or an already finished record.
+    """
+    return item if isinstance(item, dict) else item.result()
+
+def plan(imgPaths, output_dir, fused=False):
+    """
+        Report what an incremental run would do, without processing anything.
+        Parameters:
+            - imgPaths: Iterable of image paths.
+            - output_dir: Output directory holding the manifest.
+            - fused: Whether the fused single-pass correction would be used.
+        Returns:
+            - reasons: Dictionary mapping each stale reason (see manifest.stale_reason), or
+              'up to date', to the list of image paths.
+    """
+    manifest = Manifest.load(output_dir)
+    params = output_params(fused)
+    reasons = {}
+    for imgPath in imgPaths:
+        reason = stale_reason(imgPath, output_path(imgPath, output_dir),
+                              manifest.get(os.path.basename(imgPath)), params)
+        reasons.setdefault(reason or 'up to date', []).append(imgPath)
+    return reasons
+
+def list_images(input_dir, patterns=IMAGE_PATTERNS):
+    """
+        List the images of a directory in a deterministic (sorted) order.
+        Parameters:
+            - input_dir: Directory with the raw images.
+            - patterns: Glob patterns of the files to include.
+        Returns:
+            - imgPaths: Sorted list of paths.
+    """
+    imgPaths = []
+    for pattern in patterns:
+        imgPaths.extend(glob.glob(os.path.join(input_dir, pattern)))
+    return sorted(set(imgPaths))
+
+def process_directory(input_dir, output_dir, patterns=IMAGE_PATTERNS, **kwargs):
+    """
+        Process every image of a directory in parallel.
+        Parameters:
+            - input_dir: Directory with the raw images.
+            - output_dir: Output directory.
+            - patterns: Glob patterns of the files to include.
+            - kwargs: Passed to process_many.
+        Returns:
+            - records: List of per-image records, in sorted path order.
+    """
+    return list(process_many(list_images(input_dir, patterns), output_dir, **kwargs))
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel preprocessing of raw drone images")
+    parser.add_argument('--input', type=str, required=True, help='Directory with the raw images')
+    parser.add_argument('--output', type=str, required=True, help='Directory for the processed images')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=None, help='Images in flight (default: 2 x workers)')
+    parser.add_argument('--fast-metadata', action='store_true', help='Read calibration in-process')
+    parser.add_argument('--fused', action='store_true', help='Use the fused single-pass correction')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to persist calibration maps')
+    parser.add_argument('--report', type=str, default=None, help='JSON lines report (default: <output>/report.jsonl)')
+    parser.add_argument('--incremental', action='store_true', help='Skip images unchanged since the last run')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what an incremental run would do')
+    parser.add_argument('--instrument', type=str, default=None,
+                        help='Time every stage of every image and write the aggregated stats to this JSON file')
+    parser.add_argument('--prometheus', type=str, default=None,
+                        help='Also write the aggregated stats in the Prometheus text format to this file')
+    parser.add_argument('--memory', choices=('rss', 'tracemalloc'), default='rss',
+                        help='Memory recorded per stage: RSS growth, or allocations (slower)')
+    parser.add_argument('--profile', type=int, default=0, metavar='N',
+                        help='Keep cProfile dumps of the N slowest images (needs --instrument)')
+    parser.add_argument('--profile-dir', type=str, default=None,
+                        help='Directory of the cProfile dumps (default: <output>/profiles)')
+    args = parser.parse_args()
+
+    imgPaths = list_images(args.input)
+
+    if args.dry_run:
+        reasons = plan(imgPaths, args.output, fused=args.fused)
+        todo = len(imgPaths) - len(reasons.get('up to date', []))
+        print(f"{todo} of {len(imgPaths)} images would be processed")
+        for reason, paths in sorted(reasons.items()):
+            print(f"  {reason:<18} {len(paths)}")
+        return
+
+    report_path = args.report or os.path.join(args.output, 'report.jsonl')
+    instrument_options = None
+    if args.instrument or args.prometheus:
+        profile_dir = args.profile_dir or os.path.join(args.output, 'profiles')
+        instrument_options = {'memory': args.memory, 'profile': args.profile,
+                              'profile_dir': profile_dir if args.profile else None}
+        stats = instrument.StageStats(memory=args.memory)
+    print(f"Processing {len(imgPaths)} images from {args.input}")
+
+    start = time.perf_counter()
+    failed = 0
+    skipped = 0
+    records = process_many(
+        imgPaths, args.output,
+        workers=args.workers,
+        max_pending=args.max_pending,
+        fast_metadata=args.fast_metadata,
+        fused=args.fused,
+        cache_dir=args.cache_dir,
+        incremental=args.incremental,
+        instrument_options=instrument_options,
+    )
+    os.makedirs(args.output, exist_ok=True)
+    with open(report_path, 'w') as report:
+        for i, record in enumerate(records, 1):
+            report.write(json.dumps(record) + '\n')
+            if record['status'] == 'skipped':
+                skipped += 1
+            elif record['status'] != 'ok':
+                failed += 1
+                print(f"Error in {record['path']}: {record['error']}")
+            if i % 100 == 0:
+                print(f"{i}/{len(imgPaths)} processed")
+            if instrument_options is not None:
+                stats.add(record.get('stages'))
+
+    elapsed = time.perf_counter() - start
+    print(f"Done: {len(imgPaths) - failed - skipped} ok, {skipped} skipped, {failed} failed in {elapsed:.1f} s "
+          f"({len(imgPaths) / max(elapsed, 1e-9):.1f} img/s). Report: {report_path}")
+
+    if instrument_options is not None:
+        print(stats.table())
+        if args.instrument:
+            stats.save_json(args.instrument)
+        if args.prometheus:
+            stats.save_prometheus(args.prometheus)
+        if args.profile:
+            # each worker kept its own slowest images
+            dumps = instrument.prune_profiles(instrument_options['profile_dir'], args.profile)
+            print(f"Profiles of the {len(dumps)} slowest images in {instrument_options['profile_dir']} "
+                  f"(open with python -m pstats or snakeviz)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+import corrections
+from corrections import crop_correction_maps, geometry_maps, vignette_factor
+from xmp import CALIBRATION_TAGS
+
+# default memory budget for the cached maps (one 2592x1944 float32 map is ~20 MB)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def _calibration_key(infoDict):
+    """
+        Return the calibration values of infoDict as a hashable tuple.
+    """
+    return tuple(infoDict[tag] for tag in CALIBRATION_TAGS)
+
+class CalibrationCache:
+    """
+        Calibration cache
+        Stores per-camera correction maps that only depend on the calibration data, so every
+        frame of the same band and camera reuses them instead of recomputing them. Entries are
+        evicted least-recently-used first once max_bytes is exceeded. If cache_dir is set, maps
+        are also saved as .npy files (one directory per entry) and memory-mapped by later runs.
+
+        Usage:
+            cache = CalibrationCache(max_bytes=256 * 1024 * 1024, cache_dir='cache')
+            new_img = vig_correct(imgPath, infoDict, cache=cache)
+            new_img = undistort_align(new_img, infoDict, cache=cache)
+            print(cache.stats())
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key, compute):
+        """
+            Return the arrays cached under key, computing them on a miss.
+            Parameters:
+                - key: Hashable tuple identifying the calibration, starting with the map kind.
+                - compute: Callable with no arguments returning a tuple of NumPy arrays.
+            Returns:
+                - arrays: The tuple of cached arrays.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        self.misses += 1
+        arrays = self._load(key)
+        if arrays is None:
+            arrays = tuple(compute())
+            self._save(key, arrays)
+        else:
+            self.disk_hits += 1
+
+        self._store(key, arrays)
+        return arrays
+
+    def vignette_map(self, shape, centerX, centerY, k):
+        """
+            Return the vignette correction factor map for one calibration, in the precision
+            set by corrections.set_precision (float32 by default).
+            Parameters:
+                - shape: (rows, cols) of the image.
+                - centerX, centerY: Coordinates of the optical center.
+                - k: The six vignetting coefficients.
+            Returns:
+                - correction_factor: Read-only array of shape (rows, cols).
+        """
+        rows, cols = shape[:2]
+        key = ('vignette', rows, cols, centerX, centerY, tuple(k), np.dtype(corrections.PRECISION).name)
+        return self.get(key, lambda: (vignette_factor(rows, cols, centerX, centerY, k),))[0]
+
+    def geometry_maps(self, shape, infoDict):
+        """
+            Return the composed undistort + homography remap maps for one calibration.
+            Parameters:
+                - shape: (rows, cols) of the raw image.
+                - infoDict: Dictionary with the calibration data read by corrections.geometry_maps.
+            Returns:
+                - map1, map2: Read-only maps for cv2.remap.
+        """
+        rows, cols = shape[:2]
+        key = ('geometry', rows, cols) + _calibration_key(infoDict)
+        return self.get(key, lambda: geometry_maps((rows, cols), infoDict))
+
+    def crop_correction_maps(self, shape, infoDict, crop_size):
+        """
+            Return the fused crop maps and vignette gain for one calibration.
+            Parameters:
+                - shape: (rows, cols) of the raw image.
+                - infoDict: Dictionary with the calibration data read by
+                  corrections.crop_correction_maps.
+                - crop_size: Size of the square centre crop.
+            Returns:
+                - map1, map2, gain: Read-only arrays used by corrections.correct_crop.
+        """
+        rows, cols = shape[:2]
+        key = ('crop', rows, cols, crop_size, np.dtype(corrections.PRECISION).name) + _calibration_key(infoDict)
+        return self.get(key, lambda: crop_correction_maps((rows, cols), infoDict, crop_size))
+
+    def stats(self):
+        """
+            Return the cache statistics.
+            Returns:
+                - stats: Dictionary with hits, misses, disk hits, evictions, entries and bytes.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        """
+            Drop every in-memory entry. Files in cache_dir are kept.
+        """
+        self._entries.clear()
+        self.nbytes = 0
+
+    def _store(self, key, arrays):
+        """
+            Insert arrays in memory and evict the least recently used entries over budget.
+        """
+        size = sum(array.nbytes for array in arrays)
+        if size > self.max_bytes:
+            # larger than the whole budget: hand it back without caching it
+            return
+
+        for array in arrays:
+            array.flags.writeable = False
+        self._entries[key] = arrays
+        self.nbytes += size
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in evicted)
+            self.evictions += 1
+
+    def _path(self, key):
+        """
+            Return the directory of an entry in cache_dir, holding one .npy file per array.
+        """
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key[0]}_{digest}")
+
+    def _load(self, key):
+        """
+            Memory-map a previously saved entry, or return None if it is not on disk.
+        """
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return None
+        arrays = []
+        while os.path.exists(os.path.join(path, f"{len(arrays)}.npy")):
+            arrays.append(np.load(os.path.join(path, f"{len(arrays)}.npy"), mmap_mode='r'))
+        return tuple(arrays) if arrays else None
+
+    def _save(self, key, arrays):
+        """
+            Save an entry to cache_dir. The arrays are written to a temporary directory that is
+            renamed once complete, so readers (other workers sharing cache_dir) never see a
+            partial entry.
+        """
+        if self.cache_dir is None:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, array in enumerate(arrays):
+            with open(os.path.join(tmp_path, f"{i}.npy"), 'wb') as f:
+                np.save(f, array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process saved the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
@@ -2,6 +2,7 @@ import glob
 import math
 import os
 import subprocess
+import time
 from itertools import cycle, islice
 
 import cv2
@@ -9,7 +10,81 @@ import numpy as np
 from PIL import Image
 from scipy.ndimage import gaussian_filter
 
-def vig_correct(image_path, infoDict):
+import instrument
+
+# floating point precision of the corrections: np.float32 (default) or np.float64
+PRECISION = np.float32
+
+def set_precision(dtype):
+  """
+    Precision policy
+    This function sets the floating point type used for the correction factor maps, the
+    vignette multiplication, the Gaussian smoothing and the Sobel gradients.
+    Parameters:
+    - dtype: np.float32 (default, half the memory) or np.float64.
+  """
+
+  global PRECISION
+  dtype = np.dtype(dtype).type
+  if dtype not in (np.float32, np.float64):
+    raise ValueError(f"precision must be float32 or float64, got {np.dtype(dtype).name}")
+  PRECISION = dtype
+
+def _apply_gain(np_img, factor):
+  """
+    Multiply an image by a per-pixel gain in the current precision and cast back to uint16.
+  """
+  corrected_img = np_img.astype(PRECISION)
+  corrected_img *= factor[..., np.newaxis] if np_img.ndim == 3 else factor
+  return corrected_img.astype('uint16')
+
+def _vignette_params(infoDict):
+  """
+    Read the optical center and the vignetting coefficients from the calibration data.
+  """
+  centerX = int(float(infoDict['Calibrated Optical Center X']))
+  centerY = int(float(infoDict['Calibrated Optical Center Y']))
+  k = [float(elem.strip(",")) for elem in infoDict['Vignetting Data'].split()]
+  return centerX, centerY, k
+
+def _vignette_polynomial(r, k):
+  """
+    Evaluate the vignetting polynomial 1 + k0*r + ... + k5*r^6 for the distances r, with
+    Horner's scheme on a single buffer of the dtype of r.
+  """
+  correction_factor = r * k[5]
+  for coefficient in (k[4], k[3], k[2], k[1], k[0]):
+    correction_factor += coefficient
+    correction_factor *= r
+  correction_factor += 1.0
+  return correction_factor
+
+def vignette_factor(rows, cols, centerX, centerY, k):
+  """
+    Vignette correction factor
+    This function evaluates the vignetting polynomial for every pixel of an image.
+    Parameters:
+    - rows, cols: Shape of the image.
+    - centerX, centerY: Coordinates of the optical center.
+    - k: The six vignetting coefficients.
+    Returns:
+    - correction_factor: Array of shape (rows, cols), in the current precision, with the
+      factor for each pixel.
+  """
+
+  # Coordinates relative to the optical center, broadcast instead of a full meshgrid
+  x_coords = np.arange(cols, dtype=PRECISION) - centerX
+  y_coords = np.arange(rows, dtype=PRECISION)[:, np.newaxis] - centerY
+
+  # Calculate the distance r for each pixel
+  r = x_coords**2 + y_coords**2
+  np.sqrt(r, out=r)
+
+  # Calculate the correction factor
+  correction_factor = _vignette_polynomial(r, k)
+  return correction_factor
+
+def vig_correct(image_path, infoDict, cache=None):
   """
     Vignette Correction
     This function applies a vignette correction to an image based on the provided calibration data.
@@ -19,39 +94,81 @@ def vig_correct(image_path, infoDict):
         - 'Calibrated Optical Center X': X coordinate of the optical center.
         - 'Calibrated Optical Center Y': Y coordinate of the optical center.
         - 'Vignetting Data': Vignetting coefficients.
+    - cache: Optional CalibrationCache. When given, the correction factor map is computed once
+      per camera calibration and reused.
     Returns:
     - corrected_img: The vignette-corrected image as a NumPy array.
   """
 
-  centerX = int(float(infoDict['Calibrated Optical Center X']))
-  centerY = int(float(infoDict['Calibrated Optical Center Y']))
-  k = [float(elem.strip(",")) for elem in infoDict['Vignetting Data'].split()]
-
   # Load the image
-  image = Image.open(image_path)
-  np_img = np.array(image, dtype=np.uint16)
+  with instrument.stage('decode'):
+    image = Image.open(image_path)
+    np_img = np.array(image, dtype=np.uint16)
+
+  return vig_correct_array(np_img, infoDict, cache=cache)
+
+def vig_correct_array(np_img, infoDict, cache=None):
+  """
+    Vignette Correction of a decoded image
+    This function applies the vignette correction of vig_correct to an image already in memory,
+    e.g. decoded from prefetched bytes.
+    Parameters:
+    - np_img: The raw image as a NumPy array (cast to uint16).
+    - infoDict: Dictionary containing calibration data, see vig_correct.
+    - cache: Optional CalibrationCache, see vig_correct.
+    Returns:
+    - corrected_img: The vignette-corrected image as a NumPy array.
+  """
+
+  centerX, centerY, k = _vignette_params(infoDict)
+  np_img = np.asarray(np_img, dtype=np.uint16)
   rows, cols = np_img.shape[:2]
 
-  # Create meshgrid of coordinates
-  y_coords, x_coords = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+  with instrument.stage('vignette'):
+    if cache is not None:
+      correction_factor = cache.vignette_map((rows, cols), centerX, centerY, k)
+    else:
+      correction_factor = vignette_factor(rows, cols, centerX, centerY, k)
 
-  # Calculate the distance r for each pixel
-  r = np.sqrt((x_coords - centerX)**2 + (y_coords - centerY)**2)
+    # Apply the correction factor to the image
+    return _apply_gain(np_img, correction_factor)
 
-  # Calculate the correction factor
-  correction_factor = (
-      k[5] * r**6 +
-      k[4] * r**5 +
-      k[3] * r**4 +
-      k[2] * r**3 +
-      k[1] * r**2 +
-      k[0] * r +
-      1.0
-  )
-
-  # Apply the correction factor to the image
-  corrected_img = np_img * correction_factor[..., np.newaxis] if np_img.ndim == 3 else np_img * correction_factor
-  return corrected_img.astype('uint16')
+def _camera_model(infoDict):
+  """
+    Camera model
+    This function builds the OpenCV camera matrix and distortion coefficients from the
+    calibration data.
+    Parameters:
+    - infoDict: Dictionary containing 'Calibrated Optical Center X/Y' and 'Dewarp Data'.
+    Returns:
+    - camera_matrix: 3x3 camera matrix.
+    - dist_coeffs: Distortion coefficients (k1, k2, p1, p2, k3).
+  """
+
+  centerX = int(float(infoDict['Calibrated Optical Center X']))
+  centerY = int(float(infoDict['Calibrated Optical Center Y']))
+
+  dewarp_args = [float(elem) for elem in infoDict['Dewarp Data'].split(";")[1].split(",")]
+  dist_coeffs = np.asarray(dewarp_args[4:])
+  tuple0 = (dewarp_args[0], 0, centerX + dewarp_args[2])
+  tuple1 = (0, dewarp_args[1], centerY + dewarp_args[3])
+  tuple2 = (0, 0, 1)
+  camera_matrix = np.asarray([tuple0, tuple1, tuple2])
+  return camera_matrix, dist_coeffs
+
+def _homography(infoDict):
+  """
+    Read the 'Calibrated H Matrix' as a 3x3 array.
+  """
+  return np.asarray([float(elem) for elem in infoDict['Calibrated H Matrix'].split(",")]).reshape(3,3)
+
+def _undistort_roi(camera_matrix, dist_coeffs, shape):
+  """
+    Return the (x, y, w, h) crop that undistort keeps, for a raw image of the given shape.
+  """
+  h,  w = shape[:2]
+  _, roi=cv2.getOptimalNewCameraMatrix(camera_matrix,dist_coeffs,(w,h),1,(w,h))
+  return roi
 
 def undistort(new_img, infoDict):
   """
@@ -67,15 +184,7 @@ def undistort(new_img, infoDict):
     - dst: The undistorted image as a NumPy array.
   """
 
-  centerX = int(float(infoDict['Calibrated Optical Center X']))
-  centerY = int(float(infoDict['Calibrated Optical Center Y']))
-
-  dewarp_args = [float(elem) for elem in infoDict['Dewarp Data'].split(";")[1].split(",")]
-  dist_coeffs = np.asarray(dewarp_args[4:])
-  tuple0 = (dewarp_args[0], 0, centerX + dewarp_args[2])
-  tuple1 = (0, dewarp_args[1], centerY + dewarp_args[3])
-  tuple2 = (0, 0, 1)
-  camera_matrix = np.asarray([tuple0, tuple1, tuple2])
+  camera_matrix, dist_coeffs = _camera_model(infoDict)
 
   h,  w = new_img.shape[:2]
   _, roi=cv2.getOptimalNewCameraMatrix(camera_matrix,dist_coeffs,(w,h),1,(w,h))
@@ -103,11 +212,152 @@ def align_phase_rotation(new_img, infoDict):
   """
   
   rows, cols = new_img.shape
-  H = np.asarray([float(elem) for elem in infoDict['Calibrated H Matrix'].split(",")]).reshape(3,3)
+  H = _homography(infoDict)
   new_img = cv2.warpPerspective(new_img, H, (cols, rows))
   return new_img
 
 
+def geometry_maps(shape, infoDict):
+  """
+    Geometry maps
+    This function composes the distortion correction, the crop done by undistort and the
+    homography of align_phase_rotation into a single pair of cv2.remap maps.
+    Parameters:
+    - shape: (rows, cols) of the raw image.
+    - infoDict: Dictionary containing 'Calibrated Optical Center X/Y', 'Dewarp Data' and
+      'Calibrated H Matrix'.
+    Returns:
+    - map1, map2: Fixed-point maps (CV_16SC2 and its interpolation table) for cv2.remap.
+      The output has the shape of the undistort crop.
+  """
+
+  camera_matrix, dist_coeffs = _camera_model(infoDict)
+  H = _homography(infoDict)
+  x,y,w,h = _undistort_roi(camera_matrix, dist_coeffs, shape)
+
+  # output pixel -> crop (inverse homography) -> undistorted image (crop offset) -> normalized
+  # camera coordinates. initUndistortRectifyMap inverts camera_matrix @ R, so R carries the
+  # homography and the crop offset.
+  crop_offset = np.asarray([(1, 0, -x), (0, 1, -y), (0, 0, 1)], dtype=np.float64)
+  R = np.linalg.inv(camera_matrix) @ H @ crop_offset @ camera_matrix
+
+  return cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs, R, camera_matrix, (w, h), cv2.CV_16SC2)
+
+def undistort_align(new_img, infoDict, cache=None):
+  """
+    Distortion correction and alignment in one pass
+    This function gives the result of align_phase_rotation(undistort(new_img, infoDict), infoDict)
+    resampling the image only once, with maps that can be cached per calibration.
+    Parameters:
+    - new_img: The input image (e.g. the output of vig_correct).
+    - infoDict: Dictionary containing 'Calibrated Optical Center X/Y', 'Dewarp Data' and
+      'Calibrated H Matrix'.
+    - cache: Optional CalibrationCache. When given, the remap maps are computed once per
+      calibration.
+    Returns:
+    - new_img: The undistorted and aligned image as a NumPy array.
+  """
+
+  if cache is not None:
+    map1, map2 = cache.geometry_maps(new_img.shape[:2], infoDict)
+  else:
+    map1, map2 = geometry_maps(new_img.shape[:2], infoDict)
+  return cv2.remap(new_img, map1, map2, cv2.INTER_LINEAR)
+
+
+def output_shape(shape, infoDict):
+  """
+    Return the (rows, cols) of the output of undistort_align for a raw image of the given shape.
+  """
+  camera_matrix, dist_coeffs = _camera_model(infoDict)
+  _, _, w, h = _undistort_roi(camera_matrix, dist_coeffs, shape)
+  return h, w
+
+def window_maps(shape, infoDict, window):
+  """
+    Window maps
+    This function builds the float remap maps of geometry_maps for a window of the output only.
+    Parameters:
+    - shape: (rows, cols) of the raw image.
+    - infoDict: Dictionary with 'Calibrated Optical Center X/Y', 'Dewarp Data' and
+      'Calibrated H Matrix'.
+    - window: (x, y, w, h) of the window in the output of undistort_align.
+    Returns:
+    - map_x, map_y: float32 source coordinates of each pixel of the window.
+  """
+
+  camera_matrix, dist_coeffs = _camera_model(infoDict)
+  H = _homography(infoDict)
+  x,y,_,_ = _undistort_roi(camera_matrix, dist_coeffs, shape)
+  start_x, start_y, window_w, window_h = window
+
+  # as in geometry_maps, with the window offset applied to the output pixel first
+  crop_offset = np.asarray([(1, 0, -x), (0, 1, -y), (0, 0, 1)], dtype=np.float64)
+  window_offset = np.asarray([(1, 0, -start_x), (0, 1, -start_y), (0, 0, 1)], dtype=np.float64)
+  R = np.linalg.inv(camera_matrix) @ window_offset @ H @ crop_offset @ camera_matrix
+
+  return cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs, R, camera_matrix, (window_w, window_h), cv2.CV_32FC1)
+
+def crop_correction_maps(shape, infoDict, crop_size):
+  """
+    Crop correction maps
+    This function builds the maps of correct_crop: the remap maps of geometry_maps restricted
+    to the centre crop_size x crop_size window that crop_center keeps, and the vignette gain
+    evaluated at the source pixel each output pixel is sampled from.
+    Parameters:
+    - shape: (rows, cols) of the raw image.
+    - infoDict: Dictionary with the calibration data ('Calibrated Optical Center X/Y',
+      'Vignetting Data', 'Dewarp Data' and 'Calibrated H Matrix').
+    - crop_size: Size of the square centre crop.
+    Returns:
+    - map1, map2: Fixed-point maps for cv2.remap producing the crop directly.
+    - gain: Vignette gain for each pixel of the crop, in the current precision.
+  """
+
+  centerX, centerY, k = _vignette_params(infoDict)
+  h, w = output_shape(shape, infoDict)
+
+  # same window as crop_center applied to the (h, w) output of undistort_align
+  start_x = max(w // 2 - crop_size // 2, 0)
+  start_y = max(h // 2 - crop_size // 2, 0)
+  crop_w = min(crop_size, w - start_x)
+  crop_h = min(crop_size, h - start_y)
+
+  map_x, map_y = window_maps(shape, infoDict, (start_x, start_y, crop_w, crop_h))
+
+  # vignette gain at the source coordinates, only for the pixels that are kept
+  r = (map_x - centerX)**2 + (map_y - centerY)**2
+  gain = _vignette_polynomial(np.sqrt(r, out=r).astype(PRECISION, copy=False), k)
+
+  map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+  return map1, map2, gain
+
+def correct_crop(raw_img, infoDict, crop_size=1500, cache=None):
+  """
+    Fused correction
+    This function gives the result of
+    crop_center(undistort_align(vig_correct(...), infoDict), crop_size) in a single pass over
+    the raw image: the geometry and the vignette gain are only evaluated for the pixels of the
+    final crop, and no full-size intermediate image is created.
+    Parameters:
+    - raw_img: The raw image as a NumPy array (e.g. np.array(Image.open(image_path))).
+    - infoDict: Dictionary with the calibration data ('Calibrated Optical Center X/Y',
+      'Vignetting Data', 'Dewarp Data' and 'Calibrated H Matrix').
+    - crop_size: Size of the square centre crop.
+    - cache: Optional CalibrationCache. When given, the maps are computed once per calibration.
+    Returns:
+    - new_img: The corrected crop as a uint16 NumPy array.
+  """
+
+  if cache is not None:
+    map1, map2, gain = cache.crop_correction_maps(raw_img.shape[:2], infoDict, crop_size)
+  else:
+    map1, map2, gain = crop_correction_maps(raw_img.shape[:2], infoDict, crop_size)
+
+  new_img = cv2.remap(np.asarray(raw_img, dtype=np.uint16), map1, map2, cv2.INTER_LINEAR)
+  return _apply_gain(new_img, gain)
+
+
 def _smooth_image(image, sigma=1):
     """
         Apply Gaussian smoothing to the image.
@@ -115,9 +365,9 @@ def _smooth_image(image, sigma=1):
             - image: The input image to be smoothed.
             - sigma: Standard deviation for Gaussian kernel.
         Returns:
-            - smoothed_image: The smoothed image as a NumPy array.
+            - smoothed_image: The smoothed image as a NumPy array, in the current precision.
     """
-    return gaussian_filter(image, sigma=sigma)
+    return gaussian_filter(image, sigma=sigma, output=PRECISION)
 
 def _edge_detection(image):
     """
@@ -125,66 +375,173 @@ def _edge_detection(image):
         Parameters:
             - image: The input image to be processed.
         Returns:
-            - magnitude: The magnitude of the gradient, representing edge strength.
+            - magnitude: The magnitude of the gradient, representing edge strength, in the
+              current precision.
     """
 
-    grad_x = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3)
-    grad_y = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3)
+    ddepth = cv2.CV_32F if PRECISION is np.float32 else cv2.CV_64F
+    grad_x = cv2.Sobel(image, ddepth, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(image, ddepth, 0, 1, ksize=3)
     magnitude = cv2.magnitude(grad_x, grad_y)
     return magnitude
 
-def align_images_using_ecc(reference_image, target_image, jpg=False):
+def ecc_edges(image, jpg=False):
     """
-        Align two images using the Enhanced Correlation Coefficient (ECC) algorithm.
+        Prepare an image for the ECC algorithm: smoothing and Sobel edge magnitude.
         Parameters:
-            - reference_image: The reference image to align to.
-            - target_image: The target image to be aligned.
-            - jpg: Boolean indicating if the target image is a JPG file.
+            - image: The input image.
+            - jpg: Boolean indicating if the image is a (colour) JPG file.
         Returns:
-            - aligned_image: The aligned target image as a NumPy array.
+            - edges: float32 edge magnitude image.
     """
     # JPG images do not have the same exif data as the reference TIFF images,
     # therefore they need a different treatment
     if jpg:
-        # save colored jpg
-        colored_jpg = target_image
         # create temporary greyscale img
-        target_image = cv2.cvtColor(target_image, cv2.COLOR_BGR2GRAY) 
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) 
     
-    # smooth the images
-    reference_image_smoothed = _smooth_image(reference_image)
-    target_image_smoothed = _smooth_image(target_image)
+    # smooth the image and apply edge detection
+    edges = _edge_detection(_smooth_image(image))
 
-    # apply edge detection
-    base_edges = _edge_detection(reference_image_smoothed)
-    target_edges = _edge_detection(target_image_smoothed)
+    # convert to float32 for ECC algorithm
+    return edges.astype(np.float32, copy=False)
+
+def _scale_warp(warp_matrix, factor):
+    """
+        Rescale a homography to an image scaled by factor (e.g. 0.5 for one pyramid level down).
+    """
+    warp_matrix = warp_matrix.copy()
+    warp_matrix[0, 2] *= factor
+    warp_matrix[1, 2] *= factor
+    warp_matrix[2, 0] /= factor
+    warp_matrix[2, 1] /= factor
+    return warp_matrix
+
+def _corner_shift(old_warp, new_warp, shape):
+    """
+        Largest displacement, in pixels, of the image corners between two homographies.
+    """
+    rows, cols = shape[:2]
+    corners = np.float32([[0, 0], [cols - 1, 0], [0, rows - 1], [cols - 1, rows - 1]]).reshape(-1, 1, 2)
+    old_corners = cv2.perspectiveTransform(corners, old_warp.astype(np.float64))
+    new_corners = cv2.perspectiveTransform(corners, new_warp.astype(np.float64))
+    return float(np.max(np.linalg.norm(old_corners - new_corners, axis=-1)))
+
+def ecc_warp(reference_image, target_image, jpg=False, warp_matrix=None, levels=1, tolerance=None,
+             number_of_iterations=None, refine_iterations=None):
+    """
+        Estimate the homography between two images with the Enhanced Correlation Coefficient
+        (ECC) algorithm, optionally coarse-to-fine.
+        Parameters:
+            - reference_image: The reference image to align to.
+            - target_image: The target image to be aligned.
+            - jpg: Boolean indicating if the target image is a JPG file.
+            - warp_matrix: Initial 3x3 warp matrix (e.g. the one of the previous frame of the
+              flight line, or a cached band-to-band estimate). Defaults to the identity.
+            - levels: Number of pyramid levels. With 1, ECC runs only at full resolution, as
+              align_images_using_ecc always did; each extra level halves the resolution of the
+              first solve.
+            - tolerance: Early exit threshold in full-resolution pixels. When a level moves the
+              image corners by less than this, the finer levels are skipped. None never exits
+              early.
+            - number_of_iterations: ECC iterations at the coarsest level (default: 500 for JPG,
+              25 otherwise).
+            - refine_iterations: ECC iterations at each finer level, which start close to the
+              solution (default: a fifth of number_of_iterations, at least 5).
+        Returns:
+            - warp_matrix: The estimated float32 3x3 warp matrix.
+            - stats: Dictionary with the final correlation 'cc', 'early_exit', the total
+              'seconds' and, in 'levels', the scale, correlation, corner shift and time of each
+              level solved.
+    """
+    start = time.perf_counter()
+
+    base_edges = ecc_edges(reference_image)
+    target_edges = ecc_edges(target_image, jpg=jpg)
 
-    # convert images to float32 for ECC algorithm
-    base_edges = base_edges.astype(np.float32)
-    target_edges = target_edges.astype(np.float32)
-    
     # define the motion model
     warp_mode = cv2.MOTION_HOMOGRAPHY
-    warp_matrix = np.eye(3, 3, dtype=np.float32)
+    if warp_matrix is None:
+        warp_matrix = np.eye(3, 3, dtype=np.float32)
+    warp_matrix = np.asarray(warp_matrix, dtype=np.float32)
 
     # set the number of iterations and termination criteria
-    if jpg:
-        # increase iterations for jpg images, beacause they went through lees processing
-        number_of_iterations = 500 
-    else:
-        number_of_iterations = 25
+    if number_of_iterations is None:
+        if jpg:
+            # increase iterations for jpg images, beacause they went through lees processing
+            number_of_iterations = 500 
+        else:
+            number_of_iterations = 25
+    if refine_iterations is None:
+        refine_iterations = max(number_of_iterations // 5, 5)
     termination_eps = 1e-10
 
-    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
+    # build the pyramids, finest level first
+    base_pyramid = [base_edges]
+    target_pyramid = [target_edges]
+    for _ in range(levels - 1):
+        base_pyramid.append(cv2.pyrDown(base_pyramid[-1]))
+        target_pyramid.append(cv2.pyrDown(target_pyramid[-1]))
 
+    stats = {'cc': None, 'early_exit': False, 'levels': []}
+    warp_matrix = _scale_warp(warp_matrix, 0.5 ** (levels - 1))
+    for level in reversed(range(levels)):
+        level_start = time.perf_counter()
+        previous_warp = warp_matrix
+        iterations = number_of_iterations if level == levels - 1 else refine_iterations
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, termination_eps)
+        try:
+            # apply the ECC algorithm to find the warp matrix
+            cc, warp_matrix = cv2.findTransformECC(base_pyramid[level], target_pyramid[level], warp_matrix, warp_mode, criteria)
+        except cv2.error:
+            # a coarse level may not converge; the finer levels start from the previous estimate
+            if level == 0:
+                raise
+            cc = None
 
-    # apply the ECC algorithm to find the warp matrix
-    cc, warp_matrix = cv2.findTransformECC(base_edges, target_edges, warp_matrix, warp_mode, criteria)
-    
-    if jpg:
-        target_image = colored_jpg
+        shift = _corner_shift(previous_warp, warp_matrix, base_pyramid[level].shape) * 2 ** level
+        stats['cc'] = cc
+        stats['levels'].append({
+            'scale': 0.5 ** level,
+            'iterations': iterations,
+            'cc': cc,
+            'shift_px': shift,
+            'seconds': time.perf_counter() - level_start,
+        })
+
+        if level > 0:
+            warp_matrix = _scale_warp(warp_matrix, 2.0)
+            if tolerance is not None and cc is not None and shift < tolerance:
+                # the estimate is already stable: skip the finer, more expensive levels
+                warp_matrix = _scale_warp(warp_matrix, 2.0 ** (level - 1))
+                stats['early_exit'] = True
+                break
+
+    stats['seconds'] = time.perf_counter() - start
+    return warp_matrix, stats
+
+def align_images_using_ecc(reference_image, target_image, jpg=False, warp_matrix=None, levels=1,
+                           tolerance=None, return_stats=False):
+    """
+        Align two images using the Enhanced Correlation Coefficient (ECC) algorithm.
+        Parameters:
+            - reference_image: The reference image to align to.
+            - target_image: The target image to be aligned.
+            - jpg: Boolean indicating if the target image is a JPG file.
+            - warp_matrix, levels, tolerance: Initial warp, pyramid levels and early exit
+              threshold, see ecc_warp. The defaults run a single full-resolution solve from
+              the identity.
+            - return_stats: If True, also return the warp matrix and the ecc_warp statistics.
+        Returns:
+            - aligned_image: The aligned target image as a NumPy array.
+            - warp_matrix, stats: Only when return_stats is True.
+    """
+    warp_matrix, stats = ecc_warp(reference_image, target_image, jpg=jpg, warp_matrix=warp_matrix,
+                                  levels=levels, tolerance=tolerance)
 
     # warp the target image to align with the base image
     aligned_image = cv2.warpPerspective(target_image, warp_matrix, (reference_image.shape[1], reference_image.shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
     
-    return aligned_image
\ No newline at end of file
+    if return_stats:
+        return aligned_image, warp_matrix, stats
+    return aligned_image
@@ -0,0 +1,260 @@
+import argparse
+import glob
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+# bands of one capture: _D.JPG then _MS_G, _MS_NIR, _MS_R, _MS_RE
+BAND_ORDER = ('RGB', 'G', 'NIR', 'R', 'RE')
+# DJI file name of one band of a capture: <capture>_D.JPG, <capture>_MS_G.TIF, ...
+CAPTURE_PATTERN = re.compile(r'^(?P<capture>.+)_(?P<band>D|MS_G|MS_NIR|MS_R|MS_RE)\.(?:JPG|TIF)$')
+CAPTURE_BANDS = {'D': 'RGB', 'MS_G': 'G', 'MS_NIR': 'NIR', 'MS_R': 'R', 'MS_RE': 'RE'}
+# the 8-bit RGB frame is scaled down before it is mixed with the multispectral bands
+JPG_SCALE = 0.125
+# boost of the multispectral intensity in the Gram-Schmidt fusion
+GS_ALPHA = 2
+
+PRODUCTS = ('fused', 'rgb', 'ndvi', 'ndre', 'rgb-ndvi', 'rgb-ndre', 'fused-ndvi', 'fused-ndre')
+
+def capture_key(imgPath):
+    """
+        Return the capture an image belongs to and its band.
+        Parameters:
+            - imgPath: Path of a raw or processed image.
+        Returns:
+            - key: (directory, capture name), or (directory, file name) for a file that does
+              not follow the DJI naming.
+            - band: Band of BAND_ORDER, or None.
+    """
+    directory, name = os.path.split(imgPath)
+    match = CAPTURE_PATTERN.match(name)
+    if match is None:
+        return (directory, name), None
+    return (directory, match['capture']), CAPTURE_BANDS[match['band']]
+
+def capture_groups(imgPaths):
+    """
+        Group the images of a flight by capture, from the capture name and band suffix of their
+        file names (capture_key). Captures missing a band and files that do not follow the DJI
+        naming are skipped with a warning, so one missing file cannot shift the bands of the
+        following captures.
+        Parameters:
+            - imgPaths: Paths of the images.
+        Returns:
+            - groups: List of dictionaries mapping each band of BAND_ORDER to its path, in
+              capture name order.
+    """
+    captures = {}
+    unnamed = []
+    for imgPath in imgPaths:
+        key, band = capture_key(imgPath)
+        if band is None:
+            unnamed.append(imgPath)
+        else:
+            captures.setdefault(key, {})[band] = imgPath
+
+    groups = []
+    incomplete = []
+    for key in sorted(captures):
+        bands = captures[key]
+        if len(bands) == len(BAND_ORDER):
+            groups.append({band: bands[band] for band in BAND_ORDER})
+        else:
+            incomplete.append(f"{key[1]} (missing {', '.join(b for b in BAND_ORDER if b not in bands)})")
+    if incomplete:
+        print(f"Warning: skipping {len(incomplete)} incomplete captures: {'; '.join(incomplete)}")
+    if unnamed:
+        print(f"Warning: skipping {len(unnamed)} files without a DJI band suffix: "
+              f"{', '.join(sorted(os.path.basename(p) for p in unnamed))}")
+    return groups
+
+def load_bands(group):
+    """
+        Read the bands of one capture.
+        Parameters:
+            - group: Dictionary band -> path, see capture_groups.
+        Returns:
+            - bands: Dictionary band -> NumPy array.
+    """
+    return {band: np.asarray(Image.open(path)) for band, path in group.items()}
+
+def stack_scenes(scenes):
+    """
+        Stack the bands of several captures of the same size into one batch.
+        Parameters:
+            - scenes: List of band dictionaries (load_bands).
+        Returns:
+            - bands: Dictionary band -> array with a leading batch axis.
+    """
+    return {band: np.stack([scene[band] for scene in scenes]) for band in scenes[0]}
+
+def index_image(a, b):
+    """
+        Normalized difference of a and b scaled to uint8, as calculate_ndvi / calculate_ndre
+        of the vegetation_index notebook: ((index + 1) / 2 * 255) truncated. The arithmetic is
+        kept in float64, in the same order, so the truncation gives the same values.
+        Parameters:
+            - a, b: Arrays of the same shape (e.g. NIR and R), of any batch shape.
+        Returns:
+            - index: uint8 array, 127 where a + b is 0.
+    """
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    denominator = a + b
+    index = np.subtract(a, b, out=a)
+    np.divide(index, denominator, out=index, where=denominator != 0)
+    index[denominator == 0] = 0
+    index += 1
+    index /= 2
+    index *= 255
+    return index.astype(np.uint8)
+
+def gram_schmidt_fusion(bands, alpha=GS_ALPHA):
+    """
+        Intensity substitution fusion of the fuse_imgs notebook, without stacking the bands.
+        The pseudo-RGB image (R, G, NIR) is scaled by alpha times the ratio of the mean of all
+        the bands (G, the three scaled RGB channels, NIR, R and RE) to its own mean.
+        Parameters:
+            - bands: Dictionary with the 'RGB', 'G', 'NIR', 'R' and 'RE' arrays, of shape
+              (..., H, W) ((..., H, W, 3) for 'RGB').
+            - alpha: Boost factor of the multispectral intensity.
+        Returns:
+            - fused: uint8 array of shape (..., H, W, 3).
+    """
+    g = bands['G'].astype(np.float32)
+    nir = bands['NIR'].astype(np.float32)
+    r = bands['R'].astype(np.float32)
+    rgb = bands['RGB']
+
+    # channel means, summed in the same order as np.mean over the stacked channels
+    intensity_ms = g + (rgb[..., 0] * JPG_SCALE).astype(np.float32)
+    for channel in (rgb[..., 1], rgb[..., 2]):
+        intensity_ms += (channel * JPG_SCALE).astype(np.float32)
+    intensity_ms += nir
+    intensity_ms += r
+    intensity_ms += bands['RE'].astype(np.float32)
+    intensity_ms /= 7
+
+    intensity_rgb = r + g
+    intensity_rgb += nir
+    intensity_rgb /= 3
+    intensity_rgb += 1e-8
+
+    ratio = np.multiply(intensity_ms, alpha, out=intensity_ms)
+    ratio /= intensity_rgb
+
+    fused = np.empty(g.shape + (3,), dtype=np.uint8)
+    for c, channel in enumerate((r, g, nir)):
+        channel *= ratio
+        np.clip(channel, 0, 255, out=channel)
+        fused[..., c] = channel
+    return fused
+
+def fuse(bands, products=PRODUCTS, alpha=GS_ALPHA):
+    """
+        Build the training images of one capture or of a batch of captures.
+        Parameters:
+            - bands: Dictionary band -> array (load_bands or stack_scenes).
+            - products: Names of the images to build, from PRODUCTS.
+            - alpha: Boost factor of the Gram-Schmidt fusion.
+        Returns:
+            - images: Dictionary product -> uint8 array; stacks add the index as a last channel.
+    """
+    unknown = set(products) - set(PRODUCTS)
+    if unknown:
+        raise ValueError(f"Unknown products {sorted(unknown)}, expected some of {PRODUCTS}")
+
+    images = {}
+    if any(p.startswith('fused') for p in products):
+        images['fused'] = gram_schmidt_fusion(bands, alpha)
+    if any(p.startswith('rgb') for p in products):
+        images['rgb'] = np.asarray(bands['RGB'], dtype=np.uint8)
+    if any(p.endswith('ndvi') for p in products):
+        images['ndvi'] = index_image(bands['NIR'], bands['R'])
+    if any(p.endswith('ndre') for p in products):
+        images['ndre'] = index_image(bands['NIR'], bands['RE'])
+
+    for product in products:
+        if '-' in product:
+            base, index = product.split('-')
+            images[product] = np.concatenate((images[base], images[index][..., None]), axis=-1)
+    return {product: images[product] for product in products}
+
+def output_name(rgbPath, product):
+    """
+        Return the file name of a product, following the names of the notebooks.
+        Parameters:
+            - rgbPath: Path of the _D.JPG frame of the capture.
+            - product: Product name, from PRODUCTS.
+        Returns:
+            - name: e.g. DJI_0010_D_GS.jpg, DJI_0010_RGB.jpg or DJI_0010_NDVI.TIF.
+    """
+    stem = os.path.splitext(os.path.basename(rgbPath))[0]
+    if product == 'fused':
+        return f"{stem}_GS.jpg"
+    if product == 'rgb':
+        return f"{stem[:-2]}_RGB.jpg"
+    return f"{stem.replace('_D', '_' + product.upper().replace('-', '_'))}.TIF"
+
+def write_products(rgbPath, images, output_dir):
+    """
+        Write the products of one capture to output_dir/<product>-imgs.
+    """
+    for product, image in images.items():
+        product_dir = os.path.join(output_dir, f"{product}-imgs")
+        os.makedirs(product_dir, exist_ok=True)
+        path = os.path.join(product_dir, output_name(rgbPath, product))
+        if path.endswith('.TIF'):
+            tifffile.imwrite(path, image)
+        else:
+            Image.fromarray(image).save(path)
+
+def fuse_capture(group, output_dir, products=PRODUCTS, alpha=GS_ALPHA):
+    """
+        Read, fuse and write one capture.
+    """
+    write_products(group['RGB'], fuse(load_bands(group), products, alpha), output_dir)
+
+def fuse_directory(input_dir, output_dir, products=PRODUCTS, workers=None, alpha=GS_ALPHA):
+    """
+        Fuse every capture of a directory of processed images.
+        The captures run on a thread pool: decoding, the NumPy passes and encoding release the
+        GIL. Each capture is fused on its own rather than stacked into a batch, since the
+        passes are memory-bound and larger arrays only fall out of the cache.
+        Parameters:
+            - input_dir: Directory with the processed .JPG and .TIF images.
+            - output_dir: Directory receiving one <product>-imgs subdirectory per product.
+            - products: Names of the images to build, from PRODUCTS.
+            - workers: Number of threads (default: os.cpu_count()).
+            - alpha: Boost factor of the Gram-Schmidt fusion.
+        Returns:
+            - count: Number of captures fused.
+    """
+    imgPaths = glob.glob(os.path.join(input_dir, '*.JPG')) + glob.glob(os.path.join(input_dir, '*.TIF'))
+    groups = capture_groups(imgPaths)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        # list() re-raises the first error
+        list(executor.map(lambda group: fuse_capture(group, output_dir, products, alpha), groups))
+    return len(groups)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuse processed multispectral captures into training images")
+    parser.add_argument('--input', type=str, required=True, help='Directory with the processed images')
+    parser.add_argument('--output', type=str, required=True, help='Directory for the <product>-imgs folders')
+    parser.add_argument('--products', type=str, nargs='+', default=['fused', 'rgb'], choices=PRODUCTS)
+    parser.add_argument('--workers', type=int, default=None, help='Threads (default: all cores)')
+    parser.add_argument('--alpha', type=float, default=GS_ALPHA)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = fuse_directory(args.input, args.output, args.products, args.workers, args.alpha)
+    elapsed = time.perf_counter() - start
+    print(f"Fused {count} captures in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.1f} captures/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+
+from batch import IMAGE_PATTERNS, list_images, output_path
+from calibration_cache import DEFAULT_MAX_BYTES, CalibrationCache
+from fusion import BAND_ORDER, capture_key
+from metadata import EXIFTOOL_PATH, _parse_tag_line, read_fast_metadata
+from pipeline import correct_image, decode_image
+from xmp import CALIBRATION_TAGS, has_calibration
+
+# seconds between two scans of the flight directories
+SCAN_INTERVAL = 2.0
+# a file is ready once its size and modification time have not changed for this long
+SETTLE_SECONDS = 2.0
+# files read at the same time
+IO_CONCURRENCY = 16
+# ExifTool processes answering metadata requests at the same time
+EXIFTOOL_SESSIONS = 2
+
+# per-process state, created once by _init_worker
+_worker = {}
+
+def _init_worker(fused=False, cache_dir=None, max_cache_bytes=DEFAULT_MAX_BYTES):
+    """
+        Set up the long-lived state of one worker: a calibration cache shared by every image
+        the worker corrects. The workers do no file I/O, the event loop reads and writes for
+        them.
+    """
+    _worker['cache'] = CalibrationCache(max_bytes=max_cache_bytes, cache_dir=cache_dir)
+    _worker['fused'] = fused
+    cv2.setNumThreads(1)
+
+def _correct_one(imgPath, data, infoDict):
+    """
+        Decode, correct and encode one image from its bytes.
+        Parameters:
+            - imgPath: Path of the image, for its format.
+            - data: Bytes of the file.
+            - infoDict: Metadata of the image.
+        Returns:
+            - encoded: Bytes of the processed image, in the format of imgPath.
+            - seconds: CPU time spent on the image.
+    """
+    start = time.process_time()
+    jpg = imgPath[-3:] == 'JPG'
+    new_img = correct_image(decode_image(data, jpg), infoDict, jpg, cache=_worker['cache'], fused=_worker['fused'])
+    ok, encoded = cv2.imencode(os.path.splitext(imgPath)[1].lower(), new_img)
+    if not ok:
+        raise ValueError(f"could not encode {imgPath}")
+    return encoded.tobytes(), time.process_time() - start
+
+class FlightWatcher:
+    """
+        Flight watcher
+        Finds the new captures of flight directories that may still be filling up, e.g. while
+        a card is copied to a network volume. A file is ready once its size and modification
+        time have stayed the same for settle seconds, and a capture once all the bands of
+        fusion.BAND_ORDER are ready. Files that do not follow the DJI naming are captures of
+        their own.
+
+        Usage:
+            watcher = FlightWatcher(['/mnt/flights/2024-05-01'])
+            captures = await watcher.scan()
+    """
+
+    def __init__(self, flight_dirs, patterns=IMAGE_PATTERNS, settle=SETTLE_SECONDS):
+        self.flight_dirs = flight_dirs
+        self.patterns = patterns
+        self.settle = settle
+        self._seen = {}
+        self._done = set()
+        self._partial = {}
+        self._last_change = time.monotonic()
+
+    def _stat(self, flight_dir):
+        """
+            List a flight directory with the size and modification time of every image.
+        """
+        files = {}
+        for imgPath in list_images(flight_dir, self.patterns):
+            try:
+                stat = os.stat(imgPath)
+            except FileNotFoundError:
+                continue
+            files[imgPath] = (stat.st_size, stat.st_mtime)
+        return files
+
+    async def scan(self, final=False):
+        """
+            List the flight directories (in threads, as listing a network volume blocks) and
+            return the captures that became ready since the last scan.
+            Parameters:
+                - final: Treat every file as ready and also return the incomplete captures,
+                  for the last scan of a flight.
+            Returns:
+                - captures: List of captures, each a list of image paths in BAND_ORDER.
+        """
+        listings = await asyncio.gather(*(asyncio.to_thread(self._stat, d) for d in self.flight_dirs))
+        now = time.time()
+        ready = []
+        for files in listings:
+            for imgPath, signature in files.items():
+                if imgPath in self._done:
+                    continue
+                previous = self._seen.get(imgPath)
+                if previous != signature:
+                    self._last_change = time.monotonic()
+                settled = previous == signature and now - signature[1] >= self.settle
+                self._seen[imgPath] = signature
+                if settled or final:
+                    self._done.add(imgPath)
+                    ready.append(imgPath)
+
+        captures = []
+        for imgPath in sorted(ready):
+            key, band = capture_key(imgPath)
+            if band is None:
+                captures.append([imgPath])
+                continue
+            bands = self._partial.setdefault(key, {})
+            bands[band] = imgPath
+            if len(bands) == len(BAND_ORDER):
+                captures.append([bands[b] for b in BAND_ORDER])
+                del self._partial[key]
+        if final:
+            for key in sorted(self._partial):
+                bands = self._partial.pop(key)
+                captures.append([bands[b] for b in BAND_ORDER if b in bands])
+        return captures
+
+    def idle_seconds(self):
+        """
+            Return the time since a file last appeared or changed in the flight directories.
+        """
+        return time.monotonic() - self._last_change
+
+class AsyncExifToolPool:
+    """
+        Async ExifTool pool
+        Keeps a few ExifTool processes open (-stay_open, as metadata.ExifToolSession) and
+        reads metadata through them from the event loop, one request per process at a time,
+        so the ExifTool calls of several images overlap with each other and with the reads.
+
+        Usage:
+            async with AsyncExifToolPool(2) as pool:
+                infoDict = await pool.get_metadata(imgPath)
+    """
+
+    def __init__(self, size=EXIFTOOL_SESSIONS, exifToolPath=EXIFTOOL_PATH):
+        self.size = size
+        self.exifToolPath = exifToolPath
+        self._idle = None
+        self._processes = []
+        self._command_id = 0
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """
+            Start the ExifTool processes if they are not running yet.
+        """
+        async with self._lock:
+            if self._idle is not None:
+                return self
+            idle = asyncio.Queue()
+            for _ in range(self.size):
+                idle.put_nowait(await self._spawn())
+            self._idle = idle
+        return self
+
+    async def _spawn(self):
+        process = await asyncio.create_subprocess_exec(
+            self.exifToolPath, '-stay_open', 'True', '-@', '-',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        self._processes.append(process)
+        return process
+
+    async def get_metadata(self, imgPath):
+        """
+            Read the metadata of one image, with the same keys and values as
+            metadata.get_xml_metadata.
+        """
+        if self._idle is None:
+            await self.start()
+        # None stands for a process discarded by an earlier request, replaced here
+        process = await self._idle.get()
+        if process is None:
+            try:
+                process = await self._spawn()
+            except BaseException:
+                self._idle.put_nowait(None)
+                raise
+
+        done = False
+        try:
+            self._command_id += 1
+            command_id = self._command_id
+            process.stdin.write(f'{imgPath}\n-execute{command_id}\n'.encode())
+            await process.stdin.drain()
+
+            infoDict = {}
+            ready = '{ready%d}' % command_id
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    raise RuntimeError(f'ExifTool exited while reading {imgPath}')
+                tag = line.decode('utf-8', errors='replace')
+                if tag.strip() == ready:
+                    done = True
+                    return infoDict
+                _parse_tag_line(tag, infoDict)
+        finally:
+            if done:
+                self._idle.put_nowait(process)
+            else:
+                # cancelled or failed mid-request: the rest of its output is still unread and
+                # would be parsed by the next request, so the process is not reused
+                if process.returncode is None:
+                    process.kill()
+                self._idle.put_nowait(None)
+
+    async def close(self):
+        for process in self._processes:
+            if process.returncode is None:
+                try:
+                    process.stdin.write(b'-stay_open\nFalse\n')
+                    await process.stdin.drain()
+                    await asyncio.wait_for(process.wait(), timeout=10)
+                except (OSError, asyncio.TimeoutError):
+                    process.kill()
+                    await process.wait()
+        self._processes = []
+        self._idle = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+def _read_file(imgPath):
+    with open(imgPath, 'rb') as f:
+        return f.read()
+
+def _write_file(path, data):
+    # write then rename, so a reader of the output volume never sees half an image
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+async def ingest(flight_dirs, output_dir, workers=None, io_concurrency=IO_CONCURRENCY, max_pending=None,
+                 fast_metadata=False, fused=False, cache_dir=None, max_cache_bytes=DEFAULT_MAX_BYTES,
+                 exiftool_sessions=EXIFTOOL_SESSIONS, watch=False, interval=SCAN_INTERVAL,
+                 settle=SETTLE_SECONDS, idle_timeout=None):
+    """
+        Correct the images of flight directories as they arrive.
+        The event loop finds the new captures (FlightWatcher), reads their files and metadata
+        with up to io_concurrency reads in flight, and hands the bytes to a process pool that
+        decodes, corrects and encodes them; the loop then writes the results. Reads, metadata
+        requests and writes of the next images overlap with the corrections, so the workers
+        are not left waiting on slow (network) storage. At most max_pending images are read
+        but not written yet, which bounds the memory.
+        Parameters:
+            - flight_dirs: Directories with the raw images.
+            - output_dir: Output directory, created if needed. The processed images keep the
+              file name of their source, as with batch.py.
+            - workers: Number of worker processes (default: os.cpu_count()).
+            - io_concurrency: Files read at the same time.
+            - max_pending: Maximum number of images read but not written yet
+              (default: 2 * workers + io_concurrency).
+            - fast_metadata: If True, read the calibration from the prefetched bytes and only
+              ask ExifTool when a tag is missing (as get_xml_metadata(fast=True)).
+            - fused, cache_dir, max_cache_bytes: See batch.process_many.
+            - exiftool_sessions: ExifTool processes of the AsyncExifToolPool.
+            - watch: If True, keep scanning for new captures every interval seconds; else
+              process what is there and stop.
+            - interval, settle: Scan period and settle time of the FlightWatcher.
+            - idle_timeout: In watch mode, stop after this many seconds without a new file
+              (default: never).
+        Returns:
+            - records: Async generator of per-image records, in completion order: input and
+              output paths, status ('ok' or 'error'), error message, calibration tags, and the
+              read, metadata, queue, correction (CPU) and total seconds.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers + io_concurrency
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(io_concurrency + len(flight_dirs)))
+
+    watcher = FlightWatcher(flight_dirs, settle=settle)
+    slots = asyncio.Semaphore(max_pending)
+    reads = asyncio.Semaphore(io_concurrency)
+    records = asyncio.Queue()
+    tasks = set()
+
+    async def process(imgPath):
+        start = time.perf_counter()
+        record = {'path': imgPath, 'output': output_path(imgPath, output_dir), 'status': 'ok', 'error': None}
+        try:
+            async with reads:
+                data = await asyncio.to_thread(_read_file, imgPath)
+            record['read_seconds'] = time.perf_counter() - start
+
+            mark = time.perf_counter()
+            infoDict = read_fast_metadata(io.BytesIO(data)) if fast_metadata else {}
+            if not has_calibration(infoDict):
+                infoDict = await exiftool.get_metadata(imgPath)
+            record['calibration'] = {tag: infoDict.get(tag) for tag in CALIBRATION_TAGS}
+            record['metadata_seconds'] = time.perf_counter() - mark
+
+            mark = time.perf_counter()
+            encoded, cpu_seconds = await loop.run_in_executor(executor, _correct_one, imgPath, data, infoDict)
+            del data
+            record['correct_seconds'] = cpu_seconds
+            # time in the pool queue and in transfers to and from the worker
+            record['queue_seconds'] = time.perf_counter() - mark - cpu_seconds
+
+            await asyncio.to_thread(_write_file, record['output'], encoded)
+        except Exception as e:
+            # a bad image must not stop the ingest
+            record['status'] = 'error'
+            record['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            slots.release()
+        record['seconds'] = time.perf_counter() - start
+        await records.put(record)
+
+    async def submit(captures):
+        for capture in captures:
+            for imgPath in capture:
+                # wait for a slot before reading, so the prefetched bytes stay bounded
+                await slots.acquire()
+                task = asyncio.create_task(process(imgPath))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    async def discover():
+        if watch:
+            while idle_timeout is None or watcher.idle_seconds() <= idle_timeout:
+                await submit(await watcher.scan())
+                await asyncio.sleep(interval)
+        # the flight is over: incomplete captures too
+        await submit(await watcher.scan(final=True))
+        await asyncio.gather(*tasks)
+        await records.put(None)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(fused, cache_dir, max_cache_bytes)) as executor:
+        async with AsyncExifToolPool(exiftool_sessions) as exiftool:
+            discovery = asyncio.create_task(discover())
+            try:
+                while (record := await records.get()) is not None:
+                    yield record
+                await discovery
+            finally:
+                if not discovery.done():
+                    discovery.cancel()
+                    for task in list(tasks):
+                        task.cancel()
+                    await asyncio.gather(discovery, *tasks, return_exceptions=True)
+
+async def _run(args, report_path):
+    """
+        Run ingest with the command line options, writing the report and the progress.
+        Returns:
+            - summary: Dictionary with the counts, the wall time and the summed stage times.
+    """
+    summary = {'ok': 0, 'failed': 0, 'read_seconds': 0.0, 'metadata_seconds': 0.0, 'queue_seconds': 0.0,
+               'correct_seconds': 0.0}
+    start = time.perf_counter()
+    records = ingest(args.input, args.output, args.workers, args.io_concurrency, args.max_pending,
+                     args.fast_metadata, args.fused, args.cache_dir, exiftool_sessions=args.exiftool_sessions,
+                     watch=args.watch, interval=args.interval, settle=args.settle, idle_timeout=args.idle_timeout)
+    with open(report_path, 'w') as report:
+        async for record in records:
+            report.write(json.dumps(record) + '\n')
+            if record['status'] == 'ok':
+                summary['ok'] += 1
+            else:
+                summary['failed'] += 1
+                print(f"Error in {record['path']}: {record['error']}")
+            for key in ('read_seconds', 'metadata_seconds', 'queue_seconds', 'correct_seconds'):
+                summary[key] += record.get(key, 0.0)
+            done = summary['ok'] + summary['failed']
+            if done % 100 == 0:
+                print(f"{done} processed")
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Asynchronous ingest and preprocessing of flight directories")
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='Flight directories with the raw images')
+    parser.add_argument('--output', type=str, required=True, help='Directory for the processed images')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--io-concurrency', type=int, default=IO_CONCURRENCY, help='Files read at the same time')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='Images read but not written yet (default: 2 x workers + io concurrency)')
+    parser.add_argument('--exiftool-sessions', type=int, default=EXIFTOOL_SESSIONS, help='ExifTool processes')
+    parser.add_argument('--fast-metadata', action='store_true', help='Read calibration from the prefetched bytes')
+    parser.add_argument('--fused', action='store_true', help='Use the fused single-pass correction')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to persist calibration maps')
+    parser.add_argument('--watch', action='store_true', help='Keep processing new captures as they arrive')
+    parser.add_argument('--interval', type=float, default=SCAN_INTERVAL, help='Seconds between scans')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help='Seconds a file must stay unchanged before it is read')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='With --watch, stop after this many seconds without new files')
+    parser.add_argument('--report', type=str, default=None, help='JSON lines report (default: <output>/report.jsonl)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = args.report or os.path.join(args.output, 'report.jsonl')
+    summary = asyncio.run(_run(args, report_path))
+
+    count = summary['ok'] + summary['failed']
+    elapsed = summary['seconds']
+    workers = args.workers or os.cpu_count() or 1
+    print(f"Done: {summary['ok']} ok, {summary['failed']} failed in {elapsed:.1f} s "
+          f"({count / max(elapsed, 1e-9):.1f} img/s). Report: {report_path}")
+    # share of the workers' time spent correcting: close to 1 when the I/O keeps up
+    print(f"read {summary['read_seconds']:.1f} s, metadata {summary['metadata_seconds']:.1f} s, "
+          f"correction {summary['correct_seconds']:.1f} s CPU "
+          f"(worker utilization {summary['correct_seconds'] / max(elapsed * workers, 1e-9):.2f})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import cProfile
+import functools
+import glob
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+# set by enable(); every timing call checks it first, so a disabled layer does no work
+_enabled = False
+_memory = 'rss'
+_profile = 0
+_profile_dir = None
+
+# stage records of the image being processed, and the open stages (innermost last)
+_current = None
+_stack = []
+
+# (seconds, profile path) of the slowest images profiled by this process
+_profiled = []
+
+class _NullStage:
+    """
+        Context manager doing nothing, returned by stage() while instrumentation is off.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL = _NullStage()
+
+class _Stage:
+    """
+        Context manager measuring one stage and adding it to the record of the current image.
+    """
+    __slots__ = ('name', 'wall', 'cpu', 'memory', 'peak')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _memory == 'tracemalloc':
+            if _stack:
+                # the peak reached so far belongs to the enclosing stage too
+                _stack[-1].peak = max(_stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            self.memory = tracemalloc.get_traced_memory()[0]
+            self.peak = self.memory
+            tracemalloc.reset_peak()
+        elif self.name != 'total':
+            self.memory = current_rss()
+        _stack.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _stack.pop()
+        if _memory == 'tracemalloc':
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            memory = peak - self.memory
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, peak)
+        elif self.name == 'total':
+            # the peak of the process while the image was processed
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        else:
+            # ru_maxrss only ever grows, so a stage records how much it grew the resident memory
+            memory = max(0, current_rss() - self.memory)
+
+        record = _current.setdefault(self.name, [0.0, 0.0, 0, 0])
+        record[0] += wall
+        record[1] += cpu
+        record[2] = max(record[2], memory)
+        record[3] += 1
+        return False
+
+def current_rss():
+    """
+        Return the current resident set size of this process, in bytes (the peak so far,
+        ru_maxrss, where /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def enable(memory='rss', profile=0, profile_dir=None):
+    """
+        Turn the instrumentation on in this process.
+        Parameters:
+            - memory: 'rss' to record the growth of the resident memory across each stage
+              and the peak resident memory of the process per image (cheap), or
+              'tracemalloc' to record the peak of the memory allocated during each stage
+              (NumPy arrays included; slows the run down).
+            - profile: Keep cProfile dumps of the slowest this many images (0: no profiling).
+            - profile_dir: Directory of the .prof files, required with profile.
+    """
+    global _enabled, _memory, _profile, _profile_dir
+    if memory not in ('rss', 'tracemalloc'):
+        raise ValueError(f"memory must be 'rss' or 'tracemalloc', got {memory}")
+    if profile and profile_dir is None:
+        raise ValueError("profile_dir is required to profile the slowest images")
+    if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile:
+        os.makedirs(profile_dir, exist_ok=True)
+    _memory, _profile, _profile_dir = memory, profile, profile_dir
+    _enabled = True
+
+def disable():
+    """
+        Turn the instrumentation off.
+    """
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def is_enabled():
+    return _enabled
+
+def stage(name):
+    """
+        Time a block as one stage of the current image.
+
+        Usage:
+            with instrument.stage('decode'):
+                np_img = np.array(Image.open(image_path))
+    """
+    if not _enabled or _current is None:
+        return _NULL
+    return _Stage(name)
+
+def timed(name):
+    """
+        Decorator timing every call of a function as a stage, see stage().
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled or _current is None:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class image:
+    """
+        Image record
+        Collects the stages run while processing one image. The record is a plain dictionary,
+        so worker processes can return it to the process aggregating them (StageStats.add).
+        With profiling on, the image also runs under cProfile, and the profile is kept if the
+        image is among the slowest ones.
+
+        Usage:
+            with instrument.image(imgPath) as record:
+                new_img = process_image(imgPath)
+            stats.add(record)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.record = None
+
+    def __enter__(self):
+        global _current
+        if not _enabled:
+            return None
+        _current = {}
+        self.record = {'image': self.path, 'stages': _current}
+        self._profiler = cProfile.Profile() if _profile else None
+        self._stage = _Stage('total')
+        self._stage.__enter__()
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _current
+        if self.record is None:
+            return False
+        if self._profiler is not None:
+            self._profiler.disable()
+        self._stage.__exit__(exc_type, exc_value, traceback)
+        wall, cpu, memory, _ = _current.pop('total')
+        self.record.update({'seconds': wall, 'cpu_seconds': cpu, 'peak_bytes': memory})
+        self.record['stages'] = {name: {'seconds': v[0], 'cpu_seconds': v[1], 'peak_bytes': v[2], 'calls': v[3]}
+                                 for name, v in _current.items()}
+        _current = None
+        if self._profiler is not None:
+            _keep_profile(self._profiler, self.path, wall)
+        return False
+
+def _keep_profile(profiler, path, seconds):
+    """
+        Dump the profile of an image if it is among the _profile slowest of this process, and
+        delete the dump it replaces.
+    """
+    if len(_profiled) >= _profile and seconds <= _profiled[0][0]:
+        return
+    dump = os.path.join(_profile_dir, f"{seconds:09.3f}s-{os.getpid()}-{os.path.basename(path)}.prof")
+    profiler.dump_stats(dump)
+    _profiled.append((seconds, dump))
+    _profiled.sort()
+    if len(_profiled) > _profile:
+        _, evicted = _profiled.pop(0)
+        if os.path.exists(evicted):
+            os.remove(evicted)
+
+def prune_profiles(profile_dir, keep):
+    """
+        Keep the dumps of the slowest keep images of a run, when several processes each kept
+        their own slowest ones.
+        Returns:
+            - dumps: Paths of the dumps kept, slowest first.
+    """
+    # the names start with the zero-padded time, so they sort by time
+    dumps = sorted(glob.glob(os.path.join(profile_dir, '*.prof')), reverse=True)
+    for dump in dumps[keep:]:
+        os.remove(dump)
+    return dumps[:keep]
+
+class StageStats:
+    """
+        Stage statistics
+        Aggregates the image records of a run: per stage, the number of images and calls, the
+        total and percentile wall time, the total CPU time and the highest memory peak.
+
+        Usage:
+            stats = StageStats(memory='rss')
+            for record in records:
+                stats.add(record.get('stages'))
+            stats.save_json('stages.json')
+            stats.save_prometheus('stages.prom')
+    """
+
+    def __init__(self, memory=None):
+        # memory mode the records were made with, for the reports (default: this process's)
+        self.memory = memory or _memory
+        self.images = 0
+        self._stages = {}
+
+    def add(self, record):
+        """
+            Add the record of one image (image()); None (instrumentation off) is ignored.
+        """
+        if record is None:
+            return
+        self.images += 1
+        stages = dict(record['stages'])
+        stages['total'] = {'seconds': record['seconds'], 'cpu_seconds': record['cpu_seconds'],
+                           'peak_bytes': record['peak_bytes'], 'calls': 1}
+        for name, values in stages.items():
+            stats = self._stages.setdefault(name, {'images': 0, 'calls': 0, 'cpu_seconds': 0.0, 'peak_bytes': 0,
+                                                   'samples': []})
+            stats['images'] += 1
+            stats['calls'] += values['calls']
+            stats['cpu_seconds'] += values['cpu_seconds']
+            stats['peak_bytes'] = max(stats['peak_bytes'], values['peak_bytes'])
+            stats['samples'].append(values['seconds'])
+
+    def summary(self):
+        """
+            Return the aggregated statistics, stages in decreasing total time.
+        """
+        stages = {}
+        for name, stats in self._stages.items():
+            samples = np.array(stats['samples'])
+            stages[name] = {
+                'images': stats['images'],
+                'calls': stats['calls'],
+                'seconds': float(samples.sum()),
+                'mean_ms': float(samples.mean() * 1000),
+                'p50_ms': float(np.percentile(samples, 50) * 1000),
+                'p95_ms': float(np.percentile(samples, 95) * 1000),
+                'max_ms': float(samples.max() * 1000),
+                'cpu_seconds': stats['cpu_seconds'],
+                'peak_bytes': stats['peak_bytes'],
+            }
+        order = sorted(stages, key=lambda name: (name != 'total', -stages[name]['seconds']))
+        return {'images': self.images, 'memory': self.memory, 'stages': {name: stages[name] for name in order}}
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def prometheus(self, prefix='preprocessing'):
+        """
+            Return the statistics in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        metrics = (
+            ('stage_seconds_total', 'counter', 'Wall time spent in the stage', 'seconds'),
+            ('stage_cpu_seconds_total', 'counter', 'CPU time spent in the stage', 'cpu_seconds'),
+            ('stage_calls_total', 'counter', 'Number of times the stage ran', 'calls'),
+            ('stage_peak_bytes', 'gauge', f"Highest memory peak of the stage ({summary['memory']})", 'peak_bytes'),
+        )
+        lines = [f"# HELP {prefix}_images_total Images processed",
+                 f"# TYPE {prefix}_images_total counter",
+                 f"{prefix}_images_total {summary['images']}"]
+        for metric, kind, description, key in metrics:
+            lines.append(f"# HELP {prefix}_{metric} {description}")
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, stats in summary['stages'].items():
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {stats[key]}')
+        lines.append(f"# HELP {prefix}_stage_seconds Wall time of the stage per image")
+        lines.append(f"# TYPE {prefix}_stage_seconds summary")
+        for name, stats in summary['stages'].items():
+            for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms')):
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"}} {stats[key] / 1000}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["images"]}')
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, path, prefix='preprocessing'):
+        with open(path, 'w') as f:
+            f.write(self.prometheus(prefix))
+
+    def table(self):
+        """
+            Return the statistics as a text table.
+        """
+        summary = self.summary()
+        total = summary['stages'].get('total', {}).get('seconds') or 1e-9
+        lines = [f"{'stage':<18} {'images':>7} {'total s':>9} {'share':>6} {'p50 ms':>8} {'p95 ms':>8} "
+                 f"{'cpu/wall':>8} {'peak MB':>8}"]
+        for name, stats in summary['stages'].items():
+            lines.append(f"{name:<18} {stats['images']:>7} {stats['seconds']:9.2f} {stats['seconds'] / total:6.2f} "
+                         f"{stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} "
+                         f"{stats['cpu_seconds'] / max(stats['seconds'], 1e-9):8.2f} {stats['peak_bytes'] / 2**20:8.1f}")
+        return '\n'.join(lines)
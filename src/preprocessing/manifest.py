@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+
+from pipeline import PIPELINE_VERSION
+
+MANIFEST_NAME = 'manifest.json'
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+        Compute the SHA-256 of a file, reading it in chunks.
+        Parameters:
+            - path: Path to the file.
+            - chunk_size: Number of bytes read at a time.
+        Returns:
+            - digest: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_entry(imgPath, outputPath, params, source_hash, calibration=None):
+    """
+        Build the manifest entry of one processed image.
+        Parameters:
+            - imgPath: Path to the source image.
+            - outputPath: Path to the processed image.
+            - params: Dictionary with the processing options that change the output.
+            - source_hash: SHA-256 of the source file.
+            - calibration: Dictionary with the calibration tags used for the corrections.
+        Returns:
+            - entry: Dictionary stored in the manifest.
+    """
+    stat = os.stat(imgPath)
+    return {
+        'source': os.path.abspath(imgPath),
+        'output': os.path.abspath(outputPath),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': source_hash,
+        'params': params,
+        'calibration': calibration,
+        'pipeline_version': PIPELINE_VERSION,
+    }
+
+def is_unchanged(imgPath, outputPath, entry, params):
+    """
+        Cheap staleness check that only looks at file sizes and modification times.
+        Parameters:
+            - imgPath: Path to the source image.
+            - outputPath: Path to the processed image.
+            - entry: Manifest entry of the previous run, or None.
+            - params: Dictionary with the current processing options.
+        Returns:
+            - True if the image is up to date without having to hash the source.
+    """
+    if entry is None or entry['pipeline_version'] != PIPELINE_VERSION or entry['params'] != params:
+        return False
+    if not os.path.exists(outputPath):
+        return False
+    stat = os.stat(imgPath)
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+def stale_reason(imgPath, outputPath, entry, params, source_hash=None):
+    """
+        Decide whether an image has to be processed again.
+        The calibration data is stored in the image itself, so an unchanged source hash also
+        means unchanged calibration parameters.
+        Parameters:
+            - imgPath: Path to the source image.
+            - outputPath: Path to the processed image.
+            - entry: Manifest entry of the previous run, or None.
+            - params: Dictionary with the current processing options.
+            - source_hash: SHA-256 of the source, computed here if needed and not given.
+        Returns:
+            - reason: None if the image is up to date, otherwise one of 'new', 'pipeline version',
+              'parameters', 'missing output' or 'source changed'.
+    """
+    if entry is None:
+        return 'new'
+    if entry['pipeline_version'] != PIPELINE_VERSION:
+        return 'pipeline version'
+    if entry['params'] != params:
+        return 'parameters'
+    if not os.path.exists(outputPath):
+        return 'missing output'
+    if is_unchanged(imgPath, outputPath, entry, params):
+        return None
+    if source_hash is None:
+        source_hash = file_hash(imgPath)
+    return None if source_hash == entry['sha256'] else 'source changed'
+
+class Manifest:
+    """
+        Manifest
+        JSON file in the output directory recording, for each output, the source file hash,
+        the calibration and processing parameters and the pipeline version that produced it.
+
+        Usage:
+            manifest = Manifest.load(output_dir)
+            entry = manifest.get(os.path.basename(imgPath))
+            ...
+            manifest.save()
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, output_dir):
+        """
+            Load the manifest of an output directory, or start an empty one.
+            Parameters:
+                - output_dir: Output directory of the preprocessing run.
+            Returns:
+                - manifest: Manifest object.
+        """
+        path = os.path.join(output_dir, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            return cls(path, json.load(f)['entries'])
+
+    def get(self, key):
+        """
+            Return the entry of an output file name, or None.
+        """
+        return self.entries.get(key)
+
+    def update(self, key, entry):
+        """
+            Store the entry of an output file name.
+        """
+        self.entries[key] = entry
+
+    def save(self):
+        """
+            Write the manifest, replacing the previous file atomically.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'pipeline_version': PIPELINE_VERSION, 'entries': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
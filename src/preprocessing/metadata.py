@@ -1,21 +1,157 @@
+import struct
 import subprocess
 
-def get_xml_metadata(imgPath):
+from xmp import has_calibration, read_dji_metadata
+
+EXIFTOOL_PATH = 'exiftool'
+
+def _parse_tag_line(tag, infoDict):
+  """
+      parse tag line
+      This function parses one line of ExifTool's default output into the metadata dictionary.
+      Parameters:
+      - tag: A "Tag Name : value" line printed by ExifTool.
+      - infoDict: Dictionary the parsed tag is stored into.
+  """
+
+  line = tag.strip().split(':')
+  infoDict[line[0].strip()] = line[-1].strip()
+
+def read_fast_metadata(source):
+  """
+      read fast metadata
+      This function reads the DJI calibration tags in-process with xmp.read_dji_metadata, and
+      returns an empty dictionary when the header cannot be parsed (unknown container,
+      truncated file), so the caller falls back to ExifTool.
+      Parameters:
+      - source: Path to the image file, or a binary file object over its bytes.
+      Returns:
+      - infoDict: Dictionary containing the tags read, possibly empty.
+  """
+
+  try:
+    return read_dji_metadata(source)
+  except (OSError, ValueError, struct.error):
+    return {}
+
+def get_xml_metadata(imgPath, session=None, fast=False):
   """
       get XML metadata
       This function retrieves metadata from an image file using ExifTool.
       Parameters:
       - imgPath: Path to the image file.
+      - session: Optional open ExifToolSession. When given, the long-lived ExifTool process is
+        reused instead of starting a new one for this image.
+      - fast: If True, first try to read the DJI calibration tags in-process with
+        xmp.read_dji_metadata. ExifTool is only used when some calibration tag is missing.
       Returns:
       - infoDict: Dictionary containing metadata tags and their values.
   """
 
+  if fast:
+    infoDict = read_fast_metadata(imgPath)
+    if has_calibration(infoDict):
+      return infoDict
+
+  if session is not None:
+    return session.get_metadata(imgPath)
+
   infoDict = {}
-  exifToolPath = 'exiftool'
+  exifToolPath = EXIFTOOL_PATH
   ''' use Exif tool to get the metadata '''
   process = subprocess.Popen([exifToolPath,imgPath],stdout=subprocess.PIPE, stderr=subprocess.STDOUT,universal_newlines=True)
   ''' get the tags in dict '''
   for tag in process.stdout:
-      line = tag.strip().split(':')
-      infoDict[line[0].strip()] = line[-1].strip()
-  return infoDict
\ No newline at end of file
+      _parse_tag_line(tag, infoDict)
+  process.wait()
+  return infoDict
+
+def get_xml_metadata_batch(imgPaths, session=None):
+  """
+      get XML metadata in batch
+      This function retrieves the metadata of many image files through a single ExifTool process.
+      Parameters:
+      - imgPaths: Iterable of paths to the image files.
+      - session: Optional open ExifToolSession. If omitted, a session is opened for the call and
+        closed at the end.
+      Returns:
+      - infoDicts: List of metadata dictionaries, in the same order as imgPaths.
+  """
+
+  if session is None:
+    with ExifToolSession() as session:
+      return [session.get_metadata(imgPath) for imgPath in imgPaths]
+  return [session.get_metadata(imgPath) for imgPath in imgPaths]
+
+class ExifToolSession:
+  """
+      ExifTool session
+      Keeps one ExifTool process open (-stay_open) and sends it one command per image, so the
+      Perl startup cost is paid once instead of once per image. The returned dictionaries have the
+      same keys and values as get_xml_metadata.
+
+      Usage:
+          with ExifToolSession() as session:
+              infoDict = session.get_metadata(imgPath)
+  """
+
+  def __init__(self, exifToolPath=EXIFTOOL_PATH):
+    self.exifToolPath = exifToolPath
+    self.process = None
+    self._command_id = 0
+
+  def start(self):
+    """
+        Start the ExifTool process if it is not running yet.
+    """
+    if self.process is None or self.process.poll() is not None:
+      self.process = subprocess.Popen(
+          [self.exifToolPath, '-stay_open', 'True', '-@', '-'],
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+          universal_newlines=True)
+    return self
+
+  def get_metadata(self, imgPath):
+    """
+        Read the metadata of one image through the running ExifTool process.
+        Parameters:
+            - imgPath: Path to the image file.
+        Returns:
+            - infoDict: Dictionary containing metadata tags and their values.
+    """
+    self.start()
+    self._command_id += 1
+    ready = '{ready%d}' % self._command_id
+
+    # one argument per line, terminated by a numbered -execute
+    self.process.stdin.write(f'{imgPath}\n-execute{self._command_id}\n')
+    self.process.stdin.flush()
+
+    infoDict = {}
+    for tag in self.process.stdout:
+      if tag.strip() == ready:
+        return infoDict
+      _parse_tag_line(tag, infoDict)
+    raise RuntimeError(f'ExifTool exited while reading {imgPath}')
+
+  def close(self):
+    """
+        Ask ExifTool to exit and wait for the process to finish.
+    """
+    if self.process is None:
+      return
+    if self.process.poll() is None:
+      try:
+        self.process.stdin.write('-stay_open\nFalse\n')
+        self.process.stdin.flush()
+        self.process.wait(timeout=10)
+      except (OSError, subprocess.TimeoutExpired):
+        self.process.kill()
+        self.process.wait()
+    self.process = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -1,43 +1,155 @@
+import io
+import time
+
 import cv2
+import numpy as np
+from PIL import Image
 
 from metadata import get_xml_metadata
-from corrections import vig_correct, undistort, align_phase_rotation
+from corrections import align_images_using_ecc, correct_crop, undistort_align, vig_correct_array
+import instrument
 from tranforms import zoom_center, crop_center
+from warp_registry import registry_key
+
+# bump whenever a change to the corrections changes the processed images
+PIPELINE_VERSION = '2'
+# side of the final crop, once the bands are aligned to G
+ALIGNED_SIZE = 1000
 
-def process_image(imgPath):
+def decode_image(source, jpg=False):
     """
-        Process the image by applying vignette correction, undistortion, and alignment.
+        Decode a raw image the way process_image reads it.
         Parameters:
-            - imgPath: Path to the image file.
+            - source: Path to the image file, or its bytes (e.g. prefetched by ingest.py).
+            - jpg: True for the RGB frame (.JPG), read as 8-bit BGR by OpenCV; the bands are
+              read by PIL.
+        Returns:
+            - np_img: The decoded image as a NumPy array.
+    """
+    with instrument.stage('decode'):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            if jpg:
+                return cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)
+            return np.array(Image.open(io.BytesIO(source)))
+        if jpg:
+            return cv2.imread(source)
+        return np.array(Image.open(source))
+
+def correct_image(np_img, infoDict, jpg=False, cache=None, fused=False):
+    """
+        Apply the corrections of process_image to an image already decoded (decode_image).
+        Parameters:
+            - np_img: The raw image as a NumPy array.
+            - infoDict: Metadata read with get_xml_metadata.
+            - jpg: True for the RGB frame, which is only zoomed, resized and cropped.
+            - cache, fused: See process_image.
         Returns:
             - new_img: The processed image as a NumPy array.
     """
-    
+
     # constant for the reference image size
     IMG_REF_SHAPE = (2570, 1925)
 
-    # get xml metadata for camera corrections
-    infoDict = get_xml_metadata(imgPath)
-
     # custom pipeline for jpg images, because they have a different resolution 
-    if imgPath[-3:] == 'JPG':
-            new_img = cv2.imread(imgPath)
-            new_img = zoom_center(new_img, 1.3)
-            new_img = cv2.resize(new_img, IMG_REF_SHAPE)
-            new_img = crop_center(new_img, 1500)
+    if jpg:
+            with instrument.stage('resize'):
+                new_img = zoom_center(np_img, 1.3)
+                new_img = cv2.resize(new_img, IMG_REF_SHAPE)
+            with instrument.stage('crop'):
+                new_img = crop_center(new_img, 1500)
             return new_img
 
 
-    # apply vignette correction
-    new_img = vig_correct(imgPath, infoDict)
+    if fused:
+        # vignette, undistortion, alignment and crop in one pass over the raw image
+        with instrument.stage('correct_crop'):
+            return correct_crop(np_img, infoDict, 1500, cache=cache)
 
-    # undistort image
-    new_img = undistort(new_img, infoDict)
+    # apply vignette correction
+    new_img = vig_correct_array(np_img, infoDict, cache=cache)
 
-    # align phase and rotation
-    new_img = align_phase_rotation(new_img, infoDict)
+    # undistort image and align phase and rotation in a single resampling pass
+    with instrument.stage('undistort_align'):
+        new_img = undistort_align(new_img, infoDict, cache=cache)
     
     # crop center
-    new_img = crop_center(new_img, 1500)
+    with instrument.stage('crop'):
+        new_img = crop_center(new_img, 1500)
+
+    return new_img
+
+def process_image(imgPath, session=None, fast_metadata=False, cache=None, fused=False, infoDict=None):
+    """
+        Process the image by applying vignette correction, undistortion, and alignment.
+        Parameters:
+            - imgPath: Path to the image file.
+            - session: Optional ExifToolSession reused to read the metadata.
+            - fast_metadata: If True, read the calibration tags in-process before falling back
+              to ExifTool.
+            - cache: Optional CalibrationCache holding the per-camera correction and remap maps.
+            - fused: If True, produce the centre crop directly from the raw image with
+              correct_crop instead of correcting the full frame first.
+            - infoDict: Metadata already read with get_xml_metadata. If omitted, it is read here.
+        Returns:
+            - new_img: The processed image as a NumPy array.
+    """
+
+    # get xml metadata for camera corrections
+    if infoDict is None:
+        with instrument.stage('metadata'):
+            infoDict = get_xml_metadata(imgPath, session=session, fast=fast_metadata)
+
+    jpg = imgPath[-3:] == 'JPG'
+    return correct_image(decode_image(imgPath, jpg), infoDict, jpg, cache=cache, fused=fused)
+
+def align_capture(images, registry=None, infoDicts=None):
+    """
+        Align the bands of one capture to the G band, normalize them to uint8 and crop them,
+        as the driver of the process_imgs notebook does before saving.
+        Parameters:
+            - images: Dictionary band -> processed image (process_image), with the bands of
+              fusion.BAND_ORDER: 'RGB' (the BGR frame of the JPG), 'G', 'NIR', 'R' and 'RE'.
+            - registry: Optional WarpRegistry reusing the warps of previous captures.
+            - infoDicts: Metadata of each band, needed to build the registry keys.
+        Returns:
+            - aligned: Dictionary band -> uint8 image of ALIGNED_SIZE x ALIGNED_SIZE.
+    """
+    ref_img = images['G']
+    aligned = {}
+    for band, image in images.items():
+        if band != 'G':
+            jpg = band == 'RGB'
+            with instrument.stage('align'):
+                if registry is None:
+                    image = align_images_using_ecc(ref_img, image, jpg)
+                else:
+                    image = registry.align(ref_img, image, registry_key(infoDicts[band], ('G', band)), jpg=jpg)
+        with instrument.stage('normalize'):
+            image = cv2.normalize(image, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            aligned[band] = crop_center(image, ALIGNED_SIZE)
+    return aligned
+
+def process_capture(group, session=None, fast_metadata=False, cache=None, fused=False, registry=None, seconds=None):
+    """
+        Process the five images of one capture in memory: process_image on each band, then
+        align_capture. The result is what the notebook writes as processed-<name>.
+        Parameters:
+            - group: Dictionary band -> raw image path (fusion.capture_groups).
+            - session, fast_metadata, cache, fused: Passed to process_image.
+            - registry: Optional WarpRegistry, see align_capture.
+            - seconds: Optional dictionary receiving the wall time of the 'correct' (metadata
+              and process_image of every band) and 'align' steps.
+        Returns:
+            - aligned: Dictionary band -> uint8 image, 'RGB' in BGR order.
+    """
+    seconds = {} if seconds is None else seconds
+    start = time.perf_counter()
+    infoDicts = {band: get_xml_metadata(path, session=session, fast=fast_metadata) for band, path in group.items()}
+    images = {band: process_image(path, cache=cache, fused=fused, infoDict=infoDicts[band])
+              for band, path in group.items()}
+    seconds['correct'] = time.perf_counter() - start
 
-    return new_img
\ No newline at end of file
+    start = time.perf_counter()
+    aligned = align_capture(images, registry, infoDicts)
+    seconds['align'] = time.perf_counter() - start
+    return aligned
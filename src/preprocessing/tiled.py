@@ -0,0 +1,152 @@
+import argparse
+import math
+
+import cv2
+import numpy as np
+
+from corrections import _apply_gain, _vignette_params, output_shape, vignette_factor, window_maps
+from metadata import get_xml_metadata
+
+DEFAULT_TILE_SIZE = 1024
+# extra source pixels read around each tile, enough for bilinear interpolation
+DEFAULT_HALO = 2
+
+def open_image(path):
+    """
+        Open an image for windowed reads, without loading it into memory.
+        Parameters:
+            - path: Path to a .npy file or an uncompressed TIFF.
+        Returns:
+            - image: Read-only memory-mapped array; slicing it only reads the window.
+    """
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+
+    import tifffile
+
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError as e:
+        raise ValueError(f"{path} cannot be memory-mapped (compressed or tiled TIFF); "
+                         "convert it to an uncompressed TIFF or .npy first") from e
+
+def iter_tiles(shape, tile_size=DEFAULT_TILE_SIZE):
+    """
+        Iterate over the tiles of an image in row-major order.
+        Parameters:
+            - shape: (rows, cols) of the image.
+            - tile_size: Size of the square tiles; the last row and column may be smaller.
+        Returns:
+            - windows: Generator of (x, y, w, h) windows.
+    """
+    rows, cols = shape[:2]
+    for y in range(0, rows, tile_size):
+        for x in range(0, cols, tile_size):
+            yield x, y, min(tile_size, cols - x), min(tile_size, rows - y)
+
+def correct_tile(source, infoDict, window, halo=DEFAULT_HALO):
+    """
+        Tile correction
+        This function computes one window of undistort_align(vig_correct(...)) reading only the
+        part of the source it needs: the bounding box of the source coordinates of the window,
+        plus a halo for the interpolation.
+        Parameters:
+            - source: Raw image, as a NumPy or memory-mapped array.
+            - infoDict: Dictionary with the calibration data ('Calibrated Optical Center X/Y',
+              'Vignetting Data', 'Dewarp Data' and 'Calibrated H Matrix').
+            - window: (x, y, w, h) of the tile in the output of undistort_align.
+            - halo: Number of extra source pixels read around the bounding box.
+        Returns:
+            - tile: The corrected uint16 tile, of shape (h, w).
+    """
+    rows, cols = source.shape[:2]
+    _, _, window_w, window_h = window
+    map_x, map_y = window_maps(source.shape, infoDict, window)
+
+    # source window needed by this tile, clipped to the image
+    x0 = max(int(math.floor(np.nanmin(map_x))) - halo, 0)
+    y0 = max(int(math.floor(np.nanmin(map_y))) - halo, 0)
+    x1 = min(int(math.ceil(np.nanmax(map_x))) + halo + 1, cols)
+    y1 = min(int(math.ceil(np.nanmax(map_y))) + halo + 1, rows)
+    if x0 >= x1 or y0 >= y1:
+        # the whole tile maps outside the source, like the black borders of undistort
+        return np.zeros((window_h, window_w) + source.shape[2:], dtype=np.uint16)
+
+    # vignette correction of the source window, as vig_correct does it, with the optical
+    # center moved to the window coordinates
+    centerX, centerY, k = _vignette_params(infoDict)
+    correction_factor = vignette_factor(y1 - y0, x1 - x0, centerX - x0, centerY - y0, k)
+    source_tile = _apply_gain(np.asarray(source[y0:y1, x0:x1], dtype=np.uint16), correction_factor)
+
+    # resample with the maps moved to the source window
+    map_x -= x0
+    map_y -= y0
+    map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    return cv2.remap(source_tile, map1, map2, cv2.INTER_LINEAR)
+
+def correct_tiled(source, infoDict, tile_size=DEFAULT_TILE_SIZE, halo=DEFAULT_HALO):
+    """
+        Tiled correction
+        This function runs vig_correct, undistort and align_phase_rotation tile by tile, so the
+        peak memory depends on the tile size and not on the image size.
+        Parameters:
+            - source: Raw image, as a NumPy or memory-mapped array (see open_image).
+            - infoDict: Dictionary with the calibration data.
+            - tile_size: Size of the square output tiles.
+            - halo: Number of extra source pixels read around each tile.
+        Returns:
+            - shape: (rows, cols) of the corrected image.
+            - tiles: Generator of ((x, y, w, h), tile) pairs, in row-major order.
+    """
+    shape = output_shape(source.shape, infoDict)
+
+    def tiles():
+        for window in iter_tiles(shape, tile_size):
+            yield window, correct_tile(source, infoDict, window, halo)
+
+    return shape, tiles()
+
+def write_tiled(output_path, shape, tiles, tile_size=DEFAULT_TILE_SIZE):
+    """
+        Write corrected tiles to disk without assembling the image in memory.
+        Parameters:
+            - output_path: Output .npy file (memory-mapped while writing) or tiled TIFF.
+            - shape: (rows, cols) of the image.
+            - tiles: Iterable of ((x, y, w, h), tile) pairs in row-major order, as returned by
+              correct_tiled.
+            - tile_size: Size of the tiles; must be a multiple of 16 for TIFF output.
+    """
+    if output_path.lower().endswith('.npy'):
+        out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint16, shape=tuple(shape))
+        for (x, y, w, h), tile in tiles:
+            out[y:y + h, x:x + w] = tile
+        out.flush()
+        del out
+        return
+
+    import tifffile
+
+    def padded():
+        # TIFF tiles all have the same size: pad the last row and column
+        for (_, _, w, h), tile in tiles:
+            full = np.zeros((tile_size, tile_size) + tile.shape[2:], dtype=np.uint16)
+            full[:h, :w] = tile
+            yield full
+
+    tifffile.imwrite(output_path, padded(), shape=tuple(shape), dtype=np.uint16, tile=(tile_size, tile_size))
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled correction of large images")
+    parser.add_argument('--input', type=str, required=True, help='Uncompressed TIFF or .npy raw image')
+    parser.add_argument('--output', type=str, required=True, help='Output tiled TIFF or .npy')
+    parser.add_argument('--metadata', type=str, default=None, help='Image to read the calibration from (default: --input)')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+
+    infoDict = get_xml_metadata(args.metadata or args.input, fast=True)
+    shape, tiles = correct_tiled(open_image(args.input), infoDict, args.tile_size)
+    write_tiled(args.output, shape, tiles, args.tile_size)
+    print(f"Wrote {shape[1]}x{shape[0]} image to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+from corrections import _scale_warp, ecc_edges, ecc_warp
+
+# altitude bucket size, in metres
+DEFAULT_ALTITUDE_BUCKET = 10.0
+# minimum ECC correlation of a cached warp for it to be reused
+DEFAULT_MIN_CC = 0.9
+
+def registry_key(infoDict, band_pair, altitude_bucket=DEFAULT_ALTITUDE_BUCKET):
+    """
+        Build the registry key of a band pair from the image metadata.
+        Parameters:
+            - infoDict: Metadata of the target image (get_xml_metadata).
+            - band_pair: (reference band, target band), e.g. ('G', 'NIR').
+            - altitude_bucket: Bucket size of the relative altitude, in metres.
+        Returns:
+            - key: (camera serial, reference band, target band, altitude bucket).
+    """
+    serial = infoDict.get('Serial Number') or infoDict.get('Camera Serial Number')
+    if not serial:
+        # pooling the warps of every camera under one key would reuse them across aircraft
+        raise KeyError("No camera serial number in the metadata ('Serial Number'); "
+                       "the warp registry cannot tell the cameras apart")
+    try:
+        altitude = float(infoDict.get('Relative Altitude', 0))
+    except ValueError:
+        altitude = 0.0
+    return (serial, band_pair[0], band_pair[1], int(math.floor(altitude / altitude_bucket)))
+
+class WarpRegistry:
+    """
+        Warp registry
+        Stores the ECC warp matrix solved for each (camera serial, band pair, altitude bucket).
+        On one aircraft the homography between bands is nearly constant, so a stored warp is
+        reused directly when a quick correlation check at low resolution passes. The full ECC
+        solve, warm-started from the stored warp, only runs when drift is detected.
+
+        Usage:
+            registry = WarpRegistry('warps.json')
+            key = registry_key(infoDict, ('G', 'NIR'))
+            aligned_nir = registry.align(ref_img, target_nir, key)
+            registry.save()
+            print(registry.stats())
+    """
+
+    def __init__(self, path=None, min_cc=DEFAULT_MIN_CC, check_levels=2, levels=3, tolerance=None):
+        """
+            Parameters:
+                - path: Optional JSON file the warps are loaded from and saved to.
+                - min_cc: Minimum correlation of the quick check for a stored warp to be reused.
+                - check_levels: Number of halvings of the resolution for the quick check.
+                - levels, tolerance: Passed to ecc_warp for the full solve.
+        """
+        self.path = path
+        self.min_cc = min_cc
+        self.check_levels = check_levels
+        self.levels = levels
+        self.tolerance = tolerance
+        self.hits = 0
+        self.fallbacks = 0
+        self.misses = 0
+        self._warps = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for entry in json.load(f):
+                    self._warps[tuple(entry['key'])] = np.float32(entry['warp_matrix'])
+
+    def get(self, key):
+        """
+            Return the stored warp matrix of a key, or None.
+        """
+        return self._warps.get(tuple(key))
+
+    def check(self, reference_image, target_image, warp_matrix, jpg=False):
+        """
+            Quick check of a warp matrix: the ECC correlation of the edge images at low
+            resolution, without iterating.
+            Parameters:
+                - reference_image: The reference image.
+                - target_image: The target image.
+                - warp_matrix: Candidate 3x3 warp matrix, at full resolution.
+                - jpg: Boolean indicating if the target image is a JPG file.
+            Returns:
+                - cc: The correlation coefficient.
+        """
+        reference_small = reference_image
+        target_small = target_image
+        for _ in range(self.check_levels):
+            reference_small = cv2.pyrDown(reference_small)
+            target_small = cv2.pyrDown(target_small)
+
+        base_edges = ecc_edges(reference_small)
+        target_edges = ecc_edges(target_small, jpg=jpg)
+        warp_small = _scale_warp(np.float32(warp_matrix), 0.5 ** self.check_levels)
+        warped = cv2.warpPerspective(target_edges, warp_small, (base_edges.shape[1], base_edges.shape[0]),
+                                     flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+        return cv2.computeECC(base_edges, warped)
+
+    def solve(self, reference_image, target_image, key, jpg=False):
+        """
+            Return the warp matrix of target_image for a key, reusing the stored one when it
+            still fits.
+            Parameters:
+                - reference_image: The reference image to align to.
+                - target_image: The target image to be aligned.
+                - key: Registry key, see registry_key.
+                - jpg: Boolean indicating if the target image is a JPG file.
+            Returns:
+                - warp_matrix: The 3x3 warp matrix.
+                - info: Dictionary with 'source' ('hit', 'fallback' or 'miss') and the
+                  correlation 'cc' of the check or of the solve.
+        """
+        key = tuple(key)
+        stored = self._warps.get(key)
+        if stored is not None:
+            cc = self.check(reference_image, target_image, stored, jpg=jpg)
+            if cc >= self.min_cc:
+                self.hits += 1
+                return stored, {'source': 'hit', 'cc': cc}
+            # drift: solve again, starting from the stored warp
+            self.fallbacks += 1
+            source = 'fallback'
+        else:
+            self.misses += 1
+            source = 'miss'
+
+        warp_matrix, stats = ecc_warp(reference_image, target_image, jpg=jpg, warp_matrix=stored,
+                                      levels=self.levels, tolerance=self.tolerance)
+        self._warps[key] = warp_matrix
+        return warp_matrix, {'source': source, 'cc': stats['cc']}
+
+    def align(self, reference_image, target_image, key, jpg=False):
+        """
+            Align target_image to reference_image like align_images_using_ecc, using the
+            registry for the warp matrix.
+            Parameters:
+                - reference_image: The reference image to align to.
+                - target_image: The target image to be aligned.
+                - key: Registry key, see registry_key.
+                - jpg: Boolean indicating if the target image is a JPG file.
+            Returns:
+                - aligned_image: The aligned target image as a NumPy array.
+        """
+        warp_matrix, _ = self.solve(reference_image, target_image, key, jpg=jpg)
+        return cv2.warpPerspective(target_image, warp_matrix, (reference_image.shape[1], reference_image.shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+
+    def stats(self):
+        """
+            Return the registry statistics.
+            Returns:
+                - stats: Dictionary with hits, fallbacks (drift detected), misses (no stored
+                  warp), the hit rate and the number of stored warps.
+        """
+        lookups = self.hits + self.fallbacks + self.misses
+        return {
+            'hits': self.hits,
+            'fallbacks': self.fallbacks,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._warps),
+        }
+
+    def save(self, path=None):
+        """
+            Write the stored warps to a JSON file.
+            Parameters:
+                - path: Output path (default: the path given at construction).
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the warp registry to: pass one here or to WarpRegistry()")
+        entries = [{'key': list(key), 'warp_matrix': warp.tolist()} for key, warp in sorted(self._warps.items())]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmp_path, path)
@@ -0,0 +1,206 @@
+import io
+import re
+import struct
+
+# TIFF tags read from the first IFD
+TIFF_TAGS = {
+    256: 'Image Width',
+    257: 'Image Height',
+    258: 'Bits Per Sample',
+}
+TIFF_XMP_TAG = 700
+TIFF_EXIF_IFD_TAG = 34665
+
+# bytes per value of each TIFF field type, and the struct format of the integer types
+# (SHORT, LONG and IFD, the type some writers give the EXIF IFD pointer)
+_FIELD_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+_INT_FORMATS = {3: 'H', 4: 'I', 13: 'I'}
+
+# tags read from the EXIF IFD (BodySerialNumber, used by warp_registry.registry_key)
+EXIF_TAGS = {
+    42033: 'Serial Number',
+}
+
+# calibration tags used by corrections.py
+CALIBRATION_TAGS = (
+    'Calibrated Optical Center X',
+    'Calibrated Optical Center Y',
+    'Vignetting Data',
+    'Dewarp Data',
+    'Calibrated H Matrix',
+)
+
+_JPEG_XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+_JPEG_EXIF_HEADER = b'Exif\x00\x00'
+_XMP_ATTRIBUTE = re.compile(r'drone-dji:(\w+)="([^"]*)"')
+_XMP_ELEMENT = re.compile(r'<drone-dji:(\w+)>([^<]*)</drone-dji:\1>')
+_CAMEL_CASE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+# maximum number of bytes scanned for an XMP packet when the container is not recognized
+HEADER_SCAN_SIZE = 1 << 20
+
+def _tag_name(name):
+    """
+        Convert a camel case XMP name into the tag name printed by ExifTool.
+        Parameters:
+            - name: XMP property name, e.g. 'CalibratedHMatrix'.
+        Returns:
+            - tag_name: ExifTool style name, e.g. 'Calibrated H Matrix'.
+    """
+    return _CAMEL_CASE.sub(' ', name)
+
+def _read_ifd(f, byte_order, offset):
+    """
+        Read the entries of one IFD.
+        Returns:
+            - entries: List of (tag, field type, count, value field) tuples.
+    """
+    f.seek(offset)
+    (n_entries,) = struct.unpack(byte_order + 'H', f.read(2))
+    entries = f.read(12 * n_entries)
+    return [struct.unpack(byte_order + 'HHI4s', entries[12 * i:12 * (i + 1)]) for i in range(n_entries)]
+
+def _read_value(f, byte_order, field_type, count, value):
+    """
+        Read the value of an IFD entry: a string for ASCII, an int for SHORT, LONG and IFD (a
+        tuple of ints when count > 1), the raw bytes for the other types. The value is stored
+        in the value field when its count times the type size fits in 4 bytes, elsewhere in
+        the file otherwise.
+    """
+    size = count * _FIELD_SIZES.get(field_type, 1)
+    if size <= 4:
+        # values are left-justified in the value field
+        data = value[:size]
+    else:
+        f.seek(struct.unpack(byte_order + 'I', value)[0])
+        data = f.read(size)
+    if field_type in _INT_FORMATS:
+        values = struct.unpack(byte_order + str(count) + _INT_FORMATS[field_type], data)
+        return values[0] if count == 1 else values
+    if field_type == 2:
+        return data.split(b'\x00', 1)[0].decode('ascii', errors='replace').strip()
+    return data
+
+def _read_tiff_header(f):
+    """
+        Read the first IFD of a TIFF file, and its EXIF IFD if it has one.
+        Parameters:
+            - f: Binary file object positioned anywhere.
+        Returns:
+            - tags: Dictionary with the TIFF tags in TIFF_TAGS and the EXIF tags in EXIF_TAGS.
+            - xmp: The raw XMP packet, or None when the file has no XMP tag.
+    """
+    f.seek(0)
+    header = f.read(8)
+    byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byte_order is None or struct.unpack(byte_order + 'H', header[2:4])[0] != 42:
+        raise ValueError('not a classic TIFF file')
+
+    tags = {}
+    xmp = None
+    exif_offset = None
+    for tag, field_type, count, value in _read_ifd(f, byte_order, struct.unpack(byte_order + 'I', header[4:8])[0]):
+        if tag in TIFF_TAGS:
+            tag_value = _read_value(f, byte_order, field_type, count, value)
+            # ExifTool prints the values of a multi-valued tag separated by spaces, e.g. '8 8 8'
+            tags[TIFF_TAGS[tag]] = ' '.join(map(str, tag_value)) if isinstance(tag_value, tuple) else str(tag_value)
+        elif tag == TIFF_XMP_TAG:
+            xmp = _read_value(f, byte_order, field_type, count, value)
+        elif tag == TIFF_EXIF_IFD_TAG:
+            exif_offset = _read_value(f, byte_order, field_type, count, value)
+
+    if isinstance(exif_offset, int):
+        for tag, field_type, count, value in _read_ifd(f, byte_order, exif_offset):
+            if tag in EXIF_TAGS:
+                tags[EXIF_TAGS[tag]] = _read_value(f, byte_order, field_type, count, value)
+    return tags, xmp
+
+def _read_jpeg_header(f):
+    """
+        Read the EXIF tags and the XMP packet of a JPEG file, stopping at the start of the
+        compressed data.
+        Parameters:
+            - f: Binary file object.
+        Returns:
+            - tags: Dictionary with the EXIF tags in EXIF_TAGS.
+            - xmp: The raw XMP packet, or None when the file has no XMP segment.
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('not a JPEG file')
+
+    tags = {}
+    xmp = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] == 0xDA:
+            # end of file or start of scan: there is no more metadata
+            return tags, xmp
+        (length,) = struct.unpack('>H', f.read(2))
+        segment = f.read(length - 2)
+        if marker[1] != 0xE1:
+            continue
+        if segment.startswith(_JPEG_XMP_HEADER):
+            xmp = segment[len(_JPEG_XMP_HEADER):]
+        elif segment.startswith(_JPEG_EXIF_HEADER):
+            # the EXIF segment holds a TIFF header, with offsets relative to its start
+            exif_tags, _ = _read_tiff_header(io.BytesIO(segment[len(_JPEG_EXIF_HEADER):]))
+            tags.update({name: exif_tags[name] for name in EXIF_TAGS.values() if name in exif_tags})
+
+def _read_xmp(f, infoDict):
+    """
+        Read the XMP packet of a TIFF, a JPEG or an unknown container, storing the TIFF and
+        EXIF tags into infoDict.
+    """
+    f.seek(0)
+    magic = f.read(2)
+    if magic in (b'II', b'MM'):
+        tags, xmp = _read_tiff_header(f)
+        infoDict.update(tags)
+        return xmp
+    if magic == b'\xff\xd8':
+        tags, xmp = _read_jpeg_header(f)
+        infoDict.update(tags)
+        return xmp
+    f.seek(0)
+    return f.read(HEADER_SCAN_SIZE)
+
+def read_dji_metadata(imgPath):
+    """
+        Read DJI metadata
+        This function reads the DJI XMP calibration data and the main TIFF tags of an image
+        without starting an ExifTool process. Only the file header and the XMP packet are
+        read, the pixel data is never touched.
+        Parameters:
+            - imgPath: Path to the image file (TIFF or JPG), or a binary file object over its
+              bytes (e.g. io.BytesIO of a prefetched file).
+        Returns:
+            - infoDict: Dictionary with the same tag names and value formatting that ExifTool
+              prints, e.g. 'Calibrated Optical Center X', 'Vignetting Data', 'Dewarp Data',
+              'Calibrated H Matrix' and the camera 'Serial Number'.
+    """
+    infoDict = {}
+    if hasattr(imgPath, 'read'):
+        xmp = _read_xmp(imgPath, infoDict)
+    else:
+        with open(imgPath, 'rb') as f:
+            xmp = _read_xmp(f, infoDict)
+
+    if not xmp:
+        return infoDict
+
+    packet = xmp.decode('utf-8', errors='replace')
+    for regex in (_XMP_ATTRIBUTE, _XMP_ELEMENT):
+        for name, value in regex.findall(packet):
+            infoDict[_tag_name(name)] = value.strip()
+    return infoDict
+
+def has_calibration(infoDict):
+    """
+        Check whether a metadata dictionary has all the tags used by the corrections.
+        Parameters:
+            - infoDict: Metadata dictionary.
+        Returns:
+            - True if every tag in CALIBRATION_TAGS is present.
+    """
+    return all(tag in infoDict for tag in CALIBRATION_TAGS)